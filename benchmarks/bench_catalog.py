@@ -0,0 +1,144 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import shutil
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from landsat.google_download import GoogleDownload
+from landsat.update_landsat_metadata import SatMetaData
+from landsat.wrs_index import WrsIndex, load_index, index_file
+
+# (satellite, start, end) spanning each mission's whole record
+QUERIES = {'LANDSAT_5': (5, '1984-03-01', '2013-06-05'),
+           'LANDSAT_8': (8, '2013-03-18', '2021-12-31')}
+PATH_ROW = (38, 27)
+# a point on the synthetic grid covered by four overlapping path/rows
+LAT_LON = (46.1, -107.5)
+
+
+@pytest.fixture(scope='module')
+def downloads(scenes_dir, wrs_shapefile):
+    load_index(wrs_shapefile)
+    return dict((name, GoogleDownload(start, end, sat, path=PATH_ROW[0], row=PATH_ROW[1],
+                                      scenes_dir=scenes_dir, wrs_shapefile=wrs_shapefile))
+                for name, (sat, start, end) in QUERIES.items())
+
+
+def test_split_list(benchmark, peak_memory, index_csv, tmp_path):
+    scenes = str(tmp_path / 'scenes')
+
+    def setup():
+        shutil.rmtree(scenes, ignore_errors=True)
+        os.mkdir(scenes)
+
+    def split():
+        SatMetaData(sat='landsat', scenes_dir=scenes).split_list(source=index_csv)
+
+    setup()
+    peak_memory(split)
+    benchmark.pedantic(split, setup=setup, rounds=2, iterations=1)
+    assert sorted(os.listdir(scenes))[:2] == ['LANDSAT_1', 'LANDSAT_2']
+
+
+@pytest.mark.parametrize('sat', sorted(QUERIES))
+def test_candidate_scenes(benchmark, peak_memory, downloads, sat):
+    g = downloads[sat]
+    peak_memory(g.candidate_scenes)
+    benchmark(g.candidate_scenes)
+    assert g.scenes_all.shape[0] > 0
+    assert set(g.scenes_all.WRS_PATH) == {PATH_ROW[0]}
+
+
+def test_candidate_scenes_lat_lon(benchmark, peak_memory, scenes_dir, wrs_shapefile):
+    sat, start, end = QUERIES['LANDSAT_8']
+    g = GoogleDownload(start, end, sat, latitude=LAT_LON[0], longitude=LAT_LON[1], scenes_dir=scenes_dir,
+                       wrs_shapefile=wrs_shapefile)
+    peak_memory(g.candidate_scenes)
+    benchmark(g.candidate_scenes)
+    assert len(g.path_rows) > 1
+
+
+@pytest.mark.parametrize('drop_overlap', [False, True])
+def test_aoi_query(benchmark, peak_memory, scenes_dir, wrs_shapefile, drop_overlap):
+    # a watershed-sized area around LAT_LON, resolved to its path/rows and queried
+    sat, start, end = QUERIES['LANDSAT_8']
+    lat, lon = LAT_LON
+    aoi = (lon - 1.5, lat - 1., lon + 1.5, lat + 1.)
+
+    def query():
+        return GoogleDownload(start, end, sat, aoi=aoi, scenes_dir=scenes_dir, wrs_shapefile=wrs_shapefile,
+                              drop_overlap=drop_overlap)
+
+    peak_memory(query)
+    g = benchmark(query)
+    assert len(g.tiles) > 1
+    benchmark.extra_info['scenes'] = g.scenes_low_cloud.shape[0]
+
+
+@pytest.mark.parametrize('mode', ['frame', 'stream'])
+def test_continental_query(benchmark, peak_memory, scenes_dir, wrs_shapefile, mode):
+    # every path/row over Landsat 5's record: the frames of candidate_scenes against iter_scenes
+    sat, start, end = QUERIES['LANDSAT_5']
+    g = GoogleDownload(start, end, sat, path=list(range(1, 234)), row=list(range(1, 249)), scenes_dir=scenes_dir,
+                       wrs_shapefile=wrs_shapefile, lazy=True)
+
+    def query():
+        if mode == 'frame':
+            g.candidate_scenes()
+            return g.scenes_low_cloud.shape[0]
+        return sum(1 for _ in g.iter_scenes())
+
+    peak_memory(query)
+    assert benchmark(query) > 0
+
+
+@pytest.mark.parametrize('n', [10, 100])
+def test_select_scenes(benchmark, peak_memory, downloads, n):
+    g = downloads['LANDSAT_5']
+    peak_memory(lambda: g.select_scenes(n))
+    benchmark(g.select_scenes, n)
+    assert g.selected_scenes.shape[0] == min(n, g.scenes_all.shape[0])
+
+
+@pytest.mark.parametrize('bins', ['month', '48D'])
+def test_select_scenes_bins(benchmark, peak_memory, downloads, bins):
+    g = downloads['LANDSAT_5']
+    peak_memory(lambda: g.select_scenes(bins=bins, per_bin=2, rank=['cloud', 'centre']))
+    benchmark(g.select_scenes, bins=bins, per_bin=2, rank=['cloud', 'centre'])
+    assert g.selected_scenes.shape[0] > 0
+
+
+def test_get_path_row(benchmark, peak_memory, downloads):
+    g = downloads['LANDSAT_8']
+    g.lat, g.lon = LAT_LON
+
+    peak_memory(g._get_path_row)
+    benchmark(g._get_path_row)
+    assert len(g.p) > 1
+
+
+def test_load_wrs_index(benchmark, peak_memory, wrs_shapefile):
+    load_index(wrs_shapefile)
+    path = index_file(wrs_shapefile)
+
+    peak_memory(lambda: WrsIndex.load(path))
+    index = benchmark(WrsIndex.load, path)
+    assert index.paths.shape[0] > 25000
+
+# ===============================================================================
@@ -0,0 +1,49 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from download_throughput import build_catalog, measure_download
+from tests.storage_stand_in import StorageStandIn
+
+MB = 1000000
+# server behaviour: StorageStandIn arguments
+SERVERS = {'fast': {},
+           'latency': {'latency': .05},
+           'slow_links': {'bandwidth': 20 * MB},
+           'faults': {'fault_rates': {429: .03, 503: .03, 'truncate': .02}}}
+
+
+@pytest.mark.parametrize('workers', [1, 8])
+@pytest.mark.parametrize('server', sorted(SERVERS))
+def test_download_throughput(benchmark, tmp_path, server, workers):
+    reports = []
+
+    def setup():
+        storage = StorageStandIn(band_size=4 * MB, seed=len(reports), **SERVERS[server])
+        scenes_dir, output = build_catalog(storage, 2, str(tmp_path))
+        return (storage, scenes_dir, output), {'workers': workers}
+
+    def download(*args, **kwargs):
+        reports.append(measure_download(*args, **kwargs))
+
+    benchmark.pedantic(download, setup=setup, rounds=3)
+    report = reports[-1]
+    benchmark.extra_info.update(dict((k, report[k]) for k in ['files_per_sec', 'MB_per_sec', 'retries']))
+    assert report['failed'] == 0
+
+# ===============================================================================
@@ -0,0 +1,160 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import sys
+import json
+import time
+import shutil
+import tracemalloc
+from threading import Thread, Event
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from synthetic_catalog import write_index, write_wrs_shapefile
+
+MEMORY_BASELINE = os.path.join('.benchmarks', 'memory.json')
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('landsat578 benchmarks')
+    group.addoption('--catalog-rows', type=int, default=2000000,
+                    help='rows in the synthetic index.csv.gz (default 2000000)')
+    group.addoption('--catalog-seed', type=int, default=0, help='seed of the synthetic index')
+    group.addoption('--memory-save', action='store_true', default=False,
+                    help='record the peak memory of each benchmark as the baseline in {}'.format(MEMORY_BASELINE))
+    group.addoption('--memory-compare-fail', type=float, default=None, metavar='PERCENT',
+                    help='fail a benchmark whose peak memory exceeds its baseline by more than PERCENT')
+
+
+@pytest.fixture(scope='session')
+def index_csv(request):
+    """ Synthetic index.csv.gz, kept in the pytest cache between runs. """
+    rows, seed = request.config.getoption('catalog_rows'), request.config.getoption('catalog_seed')
+    path = os.path.join(str(request.config.cache.mkdir('landsat578')), 'index_{}_{}.csv.gz'.format(rows, seed))
+    if not os.path.isfile(path):
+        write_index(path + '.part', rows, seed=seed)
+        os.replace(path + '.part', path)
+    return path
+
+
+@pytest.fixture(scope='session')
+def scenes_dir(request, index_csv):
+    """ Catalog built from index_csv by SatMetaData.split_list, kept alongside it. """
+    from landsat.update_landsat_metadata import SatMetaData, CATALOG_VERSION
+
+    path = '{}_catalog_v{}'.format(index_csv[:-len('.csv.gz')], CATALOG_VERSION)
+    meta = SatMetaData(sat='landsat', scenes_dir=path)
+    if not meta.catalog_is_current():
+        shutil.rmtree(path, ignore_errors=True)
+        os.mkdir(path)
+        meta.split_list(source=index_csv)
+    return path
+
+
+@pytest.fixture(scope='session')
+def wrs_shapefile(request):
+    path = os.path.join(str(request.config.cache.mkdir('landsat578')), 'wrs2', 'wrs2_synthetic.shp')
+    if not os.path.isfile(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_wrs_shapefile(path, wrs=2)
+    return path
+
+
+class PeakMemory(object):
+    """ Peak Python heap (tracemalloc) and Arrow memory pool use inside a with block.
+
+    Arrow allocates outside the Python heap, so its pool is sampled from a thread.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.python = 0
+        self.arrow = 0
+
+    def __enter__(self):
+        import pyarrow as pa
+
+        self._pa = pa
+        self._base = pa.total_allocated_bytes()
+        self._stop = Event()
+        self._sampler = Thread(target=self._sample)
+        self._sampler.daemon = True
+        tracemalloc.start()
+        self._sampler.start()
+        return self
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.arrow = max(self.arrow, self._pa.total_allocated_bytes() - self._base)
+            time.sleep(self.interval)
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._sampler.join()
+        self.arrow = max(self.arrow, self._pa.total_allocated_bytes() - self._base)
+        self.python = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    @property
+    def total(self):
+        return self.python + self.arrow
+
+
+@pytest.fixture
+def peak_memory(request, benchmark):
+    """ measure(func): run func once under PeakMemory, report the peak with the benchmark
+    and check it against the saved baseline. """
+    config = request.config
+    key = '{}[rows={}]'.format(request.node.name, config.getoption('catalog_rows'))
+
+    def measure(func):
+        with PeakMemory() as peak:
+            func()
+        benchmark.extra_info['peak_python_mb'] = round(peak.python / 1e6, 1)
+        benchmark.extra_info['peak_arrow_mb'] = round(peak.arrow / 1e6, 1)
+
+        baseline = _load_baseline()
+        if config.getoption('memory_save'):
+            baseline[key] = peak.total
+            _save_baseline(baseline)
+
+        tolerance = config.getoption('memory_compare_fail')
+        if tolerance is not None and key in baseline:
+            limit = baseline[key] * (1 + tolerance / 100.)
+            assert peak.total <= limit, 'peak memory of {} grew from {:.1f} to {:.1f} MB'.format(
+                key, baseline[key] / 1e6, peak.total / 1e6)
+        return peak
+
+    return measure
+
+
+def _load_baseline():
+    try:
+        with open(MEMORY_BASELINE) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save_baseline(baseline):
+    if not os.path.isdir(os.path.dirname(MEMORY_BASELINE)):
+        os.makedirs(os.path.dirname(MEMORY_BASELINE))
+    with open(MEMORY_BASELINE, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+
+# ===============================================================================
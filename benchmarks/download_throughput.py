@@ -0,0 +1,105 @@
+# =============================================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================================
+from __future__ import print_function, absolute_import
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from landsat.google_download import GoogleDownload
+from landsat.update_landsat_metadata import SatMetaData
+from landsat.metrics import metrics
+from tests.storage_stand_in import StorageStandIn
+
+START, END = '2015-01-01', '2021-12-31'
+
+
+def build_catalog(storage, scenes, root):
+    """ Add scenes scenes of one path/row to storage and build their catalog under root.
+
+    :return: (scenes directory, empty output directory)
+    """
+    scenes_dir, output = os.path.join(root, 'scenes'), os.path.join(root, 'out')
+    for d in [scenes_dir, output]:
+        shutil.rmtree(d, ignore_errors=True)
+        os.makedirs(d)
+
+    storage.add_scenes(scenes, start='2015-01-02')
+    index = storage.write_index(os.path.join(root, 'index.csv.gz'))
+    SatMetaData(sat='landsat', scenes_dir=scenes_dir).split_list(source=index)
+    return scenes_dir, output
+
+
+def measure_download(storage, scenes_dir, output, **download_kwargs):
+    """ Download the scenes of build_catalog from storage with GoogleDownload.download.
+
+    :param storage: tests.storage_stand_in.StorageStandIn, not yet started
+    :param download_kwargs: passed to GoogleDownload, e.g. workers, segments, retries, zipped
+    :return: dict of files, MB, seconds, files_per_sec, MB_per_sec, failed, retries and
+        the server's request counts by status
+    """
+    with storage:
+        g = GoogleDownload(START, END, 8, path=38, row=27, output_path=output, scenes_dir=scenes_dir,
+                           **download_kwargs)
+        metrics.reset()
+        start = time.time()
+        failed = g.download()
+        seconds = time.time() - start
+
+    files = len(g.scenes_low_cloud) * len(g.band_map.file_suffixes[g.sat_name]) - len(failed)
+    mb = metrics.counters.get('download_bytes', 0) / 1e6
+    return {'files': files, 'MB': round(mb, 1), 'seconds': round(seconds, 3),
+            'files_per_sec': round(files / seconds, 2), 'MB_per_sec': round(mb / seconds, 1),
+            'failed': len(failed), 'retries': metrics.counters.get('retries', 0),
+            'server': dict((str(k), v) for k, v in storage.stats.items() if k != 'bytes')}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Download throughput against a local stand-in for the '
+                                                 'public Landsat bucket')
+    parser.add_argument('--scenes', type=int, default=4)
+    parser.add_argument('--band-mb', type=float, default=8., help='size of every band file')
+    parser.add_argument('--latency', type=float, default=0., help='seconds before each response')
+    parser.add_argument('--bandwidth-mb', type=float, default=None, help='MB/s per connection')
+    parser.add_argument('--fault-rate', type=float, default=0.,
+                        help='probability of each of 429, 503 and truncation per request')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--segments', type=int, default=1)
+    parser.add_argument('--retries', type=int, default=5)
+    parser.add_argument('--zipped', action='store_true')
+    args = parser.parse_args()
+
+    faults = dict((f, args.fault_rate) for f in (429, 503, 'truncate')) if args.fault_rate else None
+    stand_in = StorageStandIn(band_size=args.band_mb * 1e6, latency=args.latency,
+                              bandwidth=args.bandwidth_mb * 1e6 if args.bandwidth_mb else None, fault_rates=faults)
+    work = tempfile.mkdtemp(prefix='landsat578_throughput_')
+    try:
+        scenes_dir, output = build_catalog(stand_in, args.scenes, work)
+        report = measure_download(stand_in, scenes_dir, output, workers=args.workers, segments=args.segments,
+                                  retries=args.retries, zipped=args.zipped)
+    finally:
+        shutil.rmtree(work)
+    print('\n' + metrics.profile() + '\n')
+    for key in sorted(report):
+        print('{:<16}{}'.format(key, report[key]))
+
+# ========================= EOF ================================================================
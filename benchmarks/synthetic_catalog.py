@@ -0,0 +1,178 @@
+# =============================================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================================
+from __future__ import print_function, absolute_import
+
+import os
+import gzip
+
+import numpy as np
+
+INDEX_COLUMNS = ['SCENE_ID', 'PRODUCT_ID', 'SPACECRAFT_ID', 'SENSOR_ID', 'DATE_ACQUIRED', 'COLLECTION_NUMBER',
+                 'COLLECTION_CATEGORY', 'SENSING_TIME', 'DATA_TYPE', 'WRS_PATH', 'WRS_ROW', 'CLOUD_COVER',
+                 'NORTH_LAT', 'SOUTH_LAT', 'WEST_LON', 'EAST_LON', 'TOTAL_SIZE', 'BASE_URL']
+
+# spacecraft, product code, sensor, first and last acquisition, share of the archive
+MISSIONS = [('LANDSAT_1', 'LM01', 'MSS', '1972-07-25', '1978-01-06', .03),
+            ('LANDSAT_2', 'LM02', 'MSS', '1975-01-22', '1982-02-25', .04),
+            ('LANDSAT_3', 'LM03', 'MSS', '1978-03-05', '1983-03-31', .02),
+            ('LANDSAT_4', 'LT04', 'TM', '1982-08-22', '1993-12-14', .02),
+            ('LANDSAT_5', 'LT05', 'TM', '1984-03-01', '2013-06-05', .35),
+            ('LANDSAT_7', 'LE07', 'ETM', '1999-05-28', '2021-12-31', .30),
+            ('LANDSAT_8', 'LC08', 'OLI_TIRS', '2013-03-18', '2021-12-31', .24)]
+
+# paths and daytime (descending) rows of the two reference systems
+WRS_GRID = {1: (251, 119), 2: (233, 122)}
+
+# share of path/rows over land, where nearly all scenes are; the western US is always land,
+# so the benchmark queries there always have scenes
+LAND_SHARE = .35
+ALWAYS_LAND = ((10, 50), (20, 45))
+
+BLOCK_ROWS = 250000
+
+
+def wrs_version(spacecraft):
+    return 1 if spacecraft in ('LANDSAT_1', 'LANDSAT_2', 'LANDSAT_3') else 2
+
+
+def scene_bounds(wrs, paths, rows):
+    """ Approximate (west, south, east, north) of path/row scenes on the synthetic grid. """
+    n_paths, n_rows = WRS_GRID[wrs]
+    step = 360. / n_paths
+    lat = 81.8 - (np.asarray(rows) - 1) * (163.6 / (n_rows - 1))
+    lon = (-64.6 - (np.asarray(paths) - 1) * step + 180.) % 360. - 180.
+    half_h = 1.43 * .65
+    half_w = np.minimum(step * .65 / np.maximum(np.cos(np.radians(lat)), .1), 30.)
+    return lon - half_w, lat - half_h, lon + half_w, lat + half_h
+
+
+def land_path_rows(wrs, seed=0):
+    """ (paths, rows) arrays of the path/rows the synthetic scenes are spread over. """
+    n_paths, n_rows = WRS_GRID[wrs]
+    paths, rows = [a.ravel() for a in np.meshgrid(np.arange(1, n_paths + 1), np.arange(1, n_rows + 1))]
+    (p0, p1), (r0, r1) = ALWAYS_LAND
+    land = np.random.RandomState(seed + wrs).uniform(size=paths.size) < LAND_SHARE
+    land |= (paths >= p0) & (paths <= p1) & (rows >= r0) & (rows <= r1)
+    return paths[land], rows[land]
+
+
+def write_index(path, rows, seed=0, block_rows=BLOCK_ROWS):
+    """ Write a gzipped index.csv like the one published with the public Landsat data,
+    with rows scenes spread over MISSIONS in proportion to their share of the archive and
+    over the path/rows of land_path_rows.
+
+    Identifiers, dates, path/rows and cloud cover follow the real formats, so the file
+    can be fed to SatMetaData.split_list; it is generated in blocks, so millions of rows
+    only take as much memory as block_rows of them.
+    """
+    from pyarrow import csv
+
+    rng = np.random.RandomState(seed)
+    shares = np.array([m[5] for m in MISSIONS])
+    counts = np.bincount(rng.choice(len(MISSIONS), size=rows, p=shares / shares.sum()),
+                         minlength=len(MISSIONS))
+    land = dict((wrs, land_path_rows(wrs, seed)) for wrs in WRS_GRID)
+
+    # gzip's fastest level; the file is read far more often than it is written
+    with gzip.open(path, 'wb', compresslevel=1) as stream:
+        writer = None
+        for mission, count in zip(MISSIONS, counts):
+            for start in range(0, count, block_rows):
+                table = _index_block(rng, mission, min(block_rows, count - start),
+                                     land[wrs_version(mission[0])])
+                if writer is None:
+                    writer = csv.CSVWriter(stream, table.schema,
+                                           write_options=csv.WriteOptions(quoting_style='none'))
+                writer.write_table(table)
+        if writer is not None:
+            writer.close()
+
+    return counts
+
+
+def _index_block(rng, mission, n, land):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    sat, code, sensor, first, last, _ = mission
+    wrs = wrs_version(sat)
+
+    t0, t1 = np.datetime64(first, 's').astype(np.int64), np.datetime64(last, 's').astype(np.int64)
+    seconds = rng.randint(t0, t1, size=n).astype(np.int64) // 86400 * 86400 + rng.randint(36000, 68400, size=n)
+    # numpy formats dates far faster than pc.strftime
+    acquired = seconds.astype('datetime64[s]')
+    date = pa.array(np.datetime_as_string(acquired, unit='D'))
+    doy = (acquired.astype('datetime64[D]') - acquired.astype('datetime64[Y]')).astype(int) + 1
+
+    cells = rng.randint(0, land[0].size, size=n)
+    paths, rows = land[0][cells], land[1][cells]
+    cloud = np.round(rng.uniform(0, 100, size=n), 2)
+    cloud[rng.uniform(size=n) < .01] = -1.
+    # pre-collection scenes have no product id
+    collection = np.where(rng.uniform(size=n) < .05, 'PRE', '01')
+    category = rng.choice(['T1', 'T2', 'RT'], size=n, p=[.7, .25, .05])
+
+    pad = lambda values, width: pc.utf8_lpad(pc.cast(pa.array(values), pa.string()), width, '0')
+    path_str, row_str = pad(paths, 3), pad(rows, 3)
+    day = pc.replace_substring(date, '-', '')
+    product_id = pc.binary_join_element_wise(code, '_L1TP_', path_str, row_str, '_', day, '_20170101_',
+                                             pa.array(collection), '_', pa.array(category), '')
+    product_id = pc.if_else(pc.equal(pa.array(collection), 'PRE'), pa.scalar(None, pa.string()), product_id)
+    station = pad(rng.randint(0, 3, size=n), 2)
+    scene_id = pc.binary_join_element_wise('L', code[1], code[3], path_str, row_str,
+                                           pc.utf8_slice_codeunits(date, 0, 4), pad(doy, 3), 'LGN', station, '')
+    base_url = pc.binary_join_element_wise('gs://gcp-public-data-landsat/', code, '/01/', path_str, '/',
+                                           row_str, '/', pc.coalesce(product_id, scene_id), '')
+    west, south, east, north = scene_bounds(wrs, paths, rows)
+
+    return pa.table([scene_id, product_id, pa.array([sat] * n), pa.array([sensor] * n),
+                     date, pa.array(collection), pa.array(category),
+                     pc.binary_join_element_wise(pa.array(np.datetime_as_string(acquired, unit='s')),
+                                                 '.1234560Z', ''),
+                     pa.array(['L1TP'] * n), pa.array(paths), pa.array(rows), pa.array(cloud),
+                     pa.array(np.round(north, 5)), pa.array(np.round(south, 5)), pa.array(np.round(west, 5)),
+                     pa.array(np.round(east, 5)), rng.randint(50000000, 1000000000, size=n), base_url],
+                    names=INDEX_COLUMNS)
+
+
+def write_wrs_shapefile(path, wrs=2):
+    """ Write a shapefile of PATH/ROW polygons on a grid the size of WRS-1 or WRS-2, with
+    neighbouring scenes overlapping as the real ones do. """
+    import geopandas as gpd
+    import shapely
+
+    n_paths, n_rows = WRS_GRID[wrs]
+    paths, rows = [a.ravel() for a in np.meshgrid(np.arange(1, n_paths + 1), np.arange(1, n_rows + 1))]
+    west, south, east, north = scene_bounds(wrs, paths, rows)
+    polygons = shapely.box(west, south, east, north)
+    frame = gpd.GeoDataFrame({'PATH': paths, 'ROW': rows, 'WRSPR': paths * 1000 + rows},
+                             geometry=polygons, crs='EPSG:4326')
+    frame.to_file(path)
+    return path
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Write a synthetic Landsat index.csv.gz')
+    parser.add_argument('path', help='output file, e.g. index.csv.gz')
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    write_index(args.path, args.rows, seed=args.seed)
+    print('Wrote {} rows to {} ({:.1f} MB)'.format(args.rows, args.path, os.path.getsize(args.path) / 1e6))
+
+# ========================= EOF ================================================================
@@ -0,0 +1,226 @@
+# =============================================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================================
+from __future__ import print_function, absolute_import
+
+import os
+import time
+import errno
+import shutil
+import sqlite3
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+from landsat.metrics import metrics
+
+CACHE_ENV = 'LANDSAT578_CACHE'
+INDEX_NAME = 'cache_index.sqlite'
+LOCK_SUFFIX = '.lock'
+# linux FICLONE ioctl, a copy-on-write clone on btrfs, xfs and other reflink filesystems
+FICLONE = 0x40049409
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    checksum TEXT,
+    verified TEXT,
+    last_used REAL NOT NULL);
+'''
+
+
+def default_cache_dir():
+    """ Cache directory from $LANDSAT578_CACHE, or None. """
+    return os.environ.get(CACHE_ENV) or None
+
+
+def cache_key(url):
+    """ 'PRODUCT_ID/band file' of a band url; objects in the public bucket never change. """
+    parts = urlparse(url).path.rstrip('/').split('/')
+    return '/'.join(parts[-2:])
+
+
+@contextmanager
+def _locked(path, blocking=True):
+    """ Exclusive flock on path, held across processes; yields False if not blocking and busy. """
+    if fcntl is None:
+        yield True
+        return
+    with open(path, 'a') as f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def materialize(src, dst):
+    """ Make dst a copy of src: a reflink or hardlink where the filesystem allows, else a real copy.
+
+    :return: 'reflink', 'hardlink' or 'copy'
+    """
+    part = dst + '.part'
+    if os.path.exists(part):
+        os.remove(part)
+
+    if fcntl is not None:
+        try:
+            with open(src, 'rb') as s, open(part, 'wb') as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            os.replace(part, dst)
+            return 'reflink'
+        except (IOError, OSError):
+            if os.path.exists(part):
+                os.remove(part)
+
+    try:
+        os.link(src, part)
+        os.replace(part, dst)
+        return 'hardlink'
+    except (OSError, AttributeError):
+        pass
+
+    shutil.copyfile(src, part)
+    os.replace(part, dst)
+    return 'copy'
+
+
+class BandCache(object):
+    """ Machine-wide store of band files shared by every output directory.
+
+    Files are kept under root/<PRODUCT_ID>/<band file> and handed to each output by
+    reflink or hardlink where possible. A per-file lock lets one process download a band
+    while others wanting it wait and then reuse it; when the cache grows past max_bytes
+    the least recently used files not in use are removed. Cached files must be treated as
+    read-only, since a hardlinked output shares them.
+    """
+
+    def __init__(self, root, max_bytes=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        self.index = os.path.join(root, INDEX_NAME)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def get(self, url, destination_path, fetch):
+        """ Put the band at url at destination_path, from the cache or by fetch(url, path) into it.
+
+        :return: the FetchResult of fetch, or one describing the cache hit
+        """
+        from landsat.image_fetcher import FetchResult
+
+        key = cache_key(url)
+        path = self.path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+
+        with _locked(path + LOCK_SUFFIX):
+            if os.path.isfile(path):
+                entry = self._touch(key, path)
+                metrics.count('cache_hits', file=os.path.basename(url), bytes=entry[0])
+                materialize(path, destination_path)
+                print('Cached {}'.format(os.path.basename(url)))
+                return FetchResult(url, destination_path, True, size=entry[0], checksum=entry[1],
+                                   verified=entry[2])
+
+            metrics.count('cache_misses', file=os.path.basename(url))
+            result = fetch(url, path)
+            if not result.ok:
+                return result._replace(path=destination_path)
+            self._record(key, result)
+            materialize(path, destination_path)
+
+        self.evict()
+        return result._replace(path=destination_path)
+
+    def evict(self):
+        """ Remove least recently used files until the cache is within max_bytes. """
+        if not self.max_bytes:
+            return None
+
+        with self._connect() as conn:
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            if total <= self.max_bytes:
+                return None
+            entries = conn.execute('SELECT key, size FROM entries ORDER BY last_used').fetchall()
+
+        for key, size in entries:
+            if total <= self.max_bytes:
+                break
+            path = self.path(key)
+            # files another process is reading or writing are left for a later pass
+            with _locked(path + LOCK_SUFFIX, blocking=False) as held:
+                if not held:
+                    continue
+                if os.path.isfile(path):
+                    os.remove(path)
+                with self._connect() as conn:
+                    conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+            total -= size
+
+    def _touch(self, key, path):
+        with self._connect() as conn:
+            entry = conn.execute('SELECT size, checksum, verified FROM entries WHERE key = ?', (key,)).fetchone()
+            if entry is None:
+                # a file put in place by hand or by a run that died before recording it
+                entry = (os.path.getsize(path), None, None)
+                conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                             (key, entry[0], None, None, time.time()))
+            else:
+                conn.execute('UPDATE entries SET last_used = ? WHERE key = ?', (time.time(), key))
+        return entry
+
+    def _record(self, key, result):
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                         (key, result.size, result.checksum, result.verified, time.time()))
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.index, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+if __name__ == '__main__':
+    pass
+
+# ========================= EOF ================================================================
@@ -0,0 +1,144 @@
+# =============================================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================================
+from __future__ import print_function, absolute_import
+
+import re
+import time
+from datetime import datetime
+from threading import Lock
+
+from landsat.metrics import metrics
+
+UNITS = {'': 1, 'K': 1e3, 'M': 1e6, 'G': 1e9, 'KI': 1024, 'MI': 1024 ** 2, 'GI': 1024 ** 3}
+UNLIMITED = ('', 'none', 'unlimited', 'off')
+
+RATE = re.compile(r'^\s*([\d.]+)\s*([kmg]i?)?(b|bit|bps|byte)?(/s)?\s*$', re.IGNORECASE)
+WINDOW = re.compile(r'^\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*$')
+
+
+class BandwidthSpecError(ValueError):
+    pass
+
+
+def parse_rate(value):
+    """ Bytes per second from '200MB/s', '50MiB/s', '800Mbps', '1.5GB' or a number; None for unlimited.
+
+    An upper-case B is bytes and a lower-case b, 'bit' or 'bps' is bits.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value) or None
+    if str(value).strip().lower() in UNLIMITED:
+        return None
+
+    match = RATE.match(str(value))
+    if not match:
+        raise BandwidthSpecError('Can not read bandwidth {}'.format(value))
+    number, prefix, unit, _ = match.groups()
+    rate = float(number) * UNITS[(prefix or '').upper()]
+    if unit and (unit in ('b', 'bps') or unit.lower() == 'bit'):
+        rate /= 8.
+    return rate or None
+
+
+class BandwidthSchedule(object):
+    """ Bandwidth caps by local time of day.
+
+    :param spec: a single rate for all hours, a dict of {'HH:MM-HH:MM': rate} with an optional
+        'default' entry for the remaining hours, or the same as a 'HH:MM-HH:MM=rate,default=rate'
+        string; windows may wrap past midnight, and the first window containing the time wins
+    """
+
+    def __init__(self, spec=None):
+        self.windows = []
+        self.default = None
+
+        if isinstance(spec, str) and '=' in spec:
+            spec = dict(part.split('=', 1) for part in spec.split(',') if part.strip())
+        if isinstance(spec, dict):
+            for key, value in spec.items():
+                key = str(key).strip()
+                if key == 'default':
+                    self.default = parse_rate(value)
+                    continue
+                match = WINDOW.match(key)
+                if not match:
+                    raise BandwidthSpecError('Can not read time window {}, use HH:MM-HH:MM'.format(key))
+                h0, m0, h1, m1 = [int(v) for v in match.groups()]
+                self.windows.append((h0 * 60 + m0, h1 * 60 + m1, parse_rate(value)))
+        else:
+            self.default = parse_rate(spec)
+
+    def rate(self, now=None):
+        """ Bytes per second allowed at now (a datetime, default the current local time), or None. """
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.windows:
+            inside = start <= minute < end if start <= end else (minute >= start or minute < end)
+            if inside:
+                return rate
+        return self.default
+
+
+class BandwidthLimiter(object):
+    """ Token bucket shared by every download thread of the process.
+
+    Each caller takes the tokens for the bytes it just received and, if that puts the bucket
+    in debt, sleeps until the debt would be paid off at the current rate. The bucket holds
+    at most one second of tokens, so idle time doesn't buy a long burst.
+    """
+
+    def __init__(self, schedule=None):
+        self.schedule = schedule or BandwidthSchedule()
+        self._lock = Lock()
+        self._tokens = 0.
+        self._stamp = time.time()
+
+    def configure(self, spec):
+        with self._lock:
+            self.schedule = spec if isinstance(spec, BandwidthSchedule) else BandwidthSchedule(spec)
+            self._tokens = 0.
+            self._stamp = time.time()
+
+    def consume(self, n):
+        rate = self.schedule.rate()
+        if not rate:
+            return None
+
+        with self._lock:
+            now = time.time()
+            self._tokens = min(rate, self._tokens + (now - self._stamp) * rate) - n
+            self._stamp = now
+            wait = -self._tokens / rate if self._tokens < 0 else 0.
+        if wait:
+            metrics.observe('bandwidth_wait', wait)
+            time.sleep(wait)
+
+
+# the one limiter for the process, see configure
+limiter = BandwidthLimiter()
+
+
+def configure(spec):
+    """ Set the process-wide bandwidth cap; see BandwidthSchedule for spec. """
+    limiter.configure(spec)
+
+
+if __name__ == '__main__':
+    pass
+
+# ========================= EOF ================================================================
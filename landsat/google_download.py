@@ -18,16 +18,9 @@ from __future__ import print_function, absolute_import
 import os
 import re
 import sys
-import tarfile
-import shutil
-from lxml import html
-import numpy as np
+import copy
 from warnings import warn
-import pandas as pd
-from shapely.geometry import Point
-import geopandas as gpd
 from datetime import datetime as dt
-from requests import get
 
 try:
     from urllib.parse import urlparse, urlunparse
@@ -36,8 +29,18 @@ except ImportError:
 
 sys.path.append(os.path.dirname(__file__))
 
-from landsat.update_landsat_metadata import SatMetaData
+from landsat.update_landsat_metadata import SatMetaData, storage_url
+from landsat.scene_query import (SCENE_COLUMNS, RECORD_BATCH_ROWS, open_catalog, scene_filter, scene_records,
+                                 select_per_bin)
 from landsat.band_map import BandMap
+from landsat import bandwidth
+# BadRequestsResponse lived here before the fetcher had its own module, and is still importable from here
+from landsat.image_fetcher import BadRequestsResponse, ImageFetcher, RetryPolicy
+from landsat.packaging import SceneArchive, check_codec
+from landsat.scene_pipeline import ScenePipeline, SceneTask
+from landsat.job_ledger import JobLedger, COMPLETE, PACKAGED, INCOMPLETE
+from landsat.band_cache import BandCache, default_cache_dir
+from landsat.metrics import metrics
 
 SATS = ['LANDSAT_1', 'LANDSAT_2', 'LANDSAT_3', 'LANDSAT_4',
         'LANDSAT_5', 'LANDSAT_7', 'LANDSAT_8']
@@ -51,10 +54,6 @@ SCENES = os.path.join(os.path.dirname(__file__), 'scenes')
 fmt = '%Y-%m-%d'
 
 
-class BadRequestsResponse(Exception):
-    pass
-
-
 class MissingInitData(Exception):
     pass
 
@@ -62,30 +61,99 @@ class MissingInitData(Exception):
 class GoogleDownload(object):
     def __init__(self, start, end, satellite, latitude=None, longitude=None,
                  path=None, row=None, max_cloud_percent=100,
-                 instrument=None, output_path=None, zipped=False, alt_name=False):
+                 instrument=None, output_path=None, zipped=False, alt_name=False, workers=1,
+                 segments=1, codec='gz', max_scenes=None, max_staging_mb=None, aoi=None,
+                 retries=5, max_bandwidth=None, cache_dir=None, cache_max_gb=None, scenes_dir=None,
+                 wrs_shapefile=None, lazy=False, drop_overlap=False):
 
         self.sat_num = satellite
         self.sat_name = 'LANDSAT_{}'.format(self.sat_num)
         self.instrument = instrument
-        self.start_str = start
-        self.end_str = end
-        self.start_dt = dt.strptime(start, fmt)
-        self.end_dt = dt.strptime(end, fmt)
-        self.cloud = float(max_cloud_percent)
 
-        if satellite < 4:
+        if wrs_shapefile:
+            self.vectors = wrs_shapefile
+        elif satellite < 4:
             self.vectors = WRS_1
         else:
             self.vectors = WRS_2
 
+        # another catalog and WRS grid can be swapped in, e.g. the synthetic ones in benchmarks/
         self.scenes_abspath = None
-        self.scenes = SCENES
+        self.scenes = scenes_dir or SCENES
         self._check_metadata()
 
+        # with an area of interest, only the part of each image band covering it is downloaded,
+        # and without a path/row or point the path/rows intersecting it are queried
+        self.aoi_shape = None
+        self.aoi = None
+        if aoi is not None:
+            from landsat.wrs_index import aoi_geometry
+
+            self.aoi_shape = aoi_geometry(aoi)
+            self.aoi = tuple(float(v) for v in self.aoi_shape.bounds)
+        # drop scenes whose part of the area others of the same date cover
+        self.drop_overlap = drop_overlap
+
+        self._set_query(start, end, latitude, longitude, path, row, max_cloud_percent)
+
+        self.output = output_path
+        self.zipped = zipped
+        self.alt_name = alt_name
+        self.codec = codec
+        # fail here rather than once the first scene's bands are downloaded
+        if zipped or alt_name:
+            check_codec(codec)
+
+        self.workers = max(1, int(workers))
+        self.segments = segments
+        self.retries = retries
+        # shared by every download of the process, e.g. '200MB/s' or {'08:00-18:00': '50MB/s'}
+        self.max_bandwidth = max_bandwidth
+
+        # bands shared with other output directories on this machine, see band_cache
+        cache_dir = cache_dir or default_cache_dir()
+        self.cache = None
+        if cache_dir:
+            self.cache = BandCache(cache_dir, max_bytes=int(cache_max_gb * 1e9) if cache_max_gb else None)
+        self._fetcher = None
+        self._ledger = None
+        self.failed_fetches = []
+
+        # back-pressure for download(): scenes started ahead of packaging, and the
+        # downloaded-but-unpackaged bytes they may hold on disk
+        self.max_scenes = max_scenes
+        self.max_staging_bytes = int(max_staging_mb * 1e6) if max_staging_mb else None
+
+        self.current_image = None
+
+        # a lazy query builds no scene frames; its scenes are streamed by iter_scenes
+        if not lazy:
+            self.candidate_scenes()
+        self.band_map = BandMap()
+
+    def for_query(self, start, end, latitude=None, longitude=None, path=None, row=None, max_cloud_percent=100):
+        """ A lazy copy of this object for another query of the same satellite.
+
+        The catalog, WRS grid and download settings are shared rather than set up again,
+        so a long-running process such as the query service keeps one object per satellite.
+        """
+        query = copy.copy(self)
+        query._set_query(start, end, latitude, longitude, path, row, max_cloud_percent)
+        return query
+
+    def _set_query(self, start, end, latitude, longitude, path, row, max_cloud_percent):
+        self.start_str = start
+        self.end_str = end
+        self.start_dt = dt.strptime(start, fmt)
+        self.end_dt = dt.strptime(end, fmt)
+        self.cloud = float(max_cloud_percent)
+
         self.p = path
         self.r = row
         self.lat = latitude
         self.lon = longitude
+        # (path, row) pairs queried, when several path/rows were looked up
+        self.tiles = None
         self._check_pr_lat_lon()
 
         self.urls_low_cloud = None
@@ -101,69 +169,158 @@ class GoogleDownload(object):
         self.selected_scenes = None
         self.pymetric_ids = None
 
-        self.output = output_path
-        self.zipped = zipped
-        self.alt_name = alt_name
-
-        self.current_image = None
+    @property
+    def fetcher(self):
+        # created on first use, so only downloads pay for importing requests
+        if self._fetcher is None:
+            if self.max_bandwidth is not None:
+                bandwidth.configure(self.max_bandwidth)
+            self._fetcher = ImageFetcher(workers=self.workers, segments=self.segments,
+                                         retry=RetryPolicy(attempts=self.retries))
+        return self._fetcher
+
+    def download(self, list_type='low_cloud', scenes=None):
+        """ Download every band of the scenes of list_type, or of scenes, a DataFrame or an
+        iterable of scene records such as iter_scenes yields. """
+
+        if scenes is None:
+            if list_type == 'selected':
+                if self.selected_scenes is None:
+                    raise ValueError("list_type 'selected' needs select_scenes() to be run first")
+                scenes = self.selected_scenes
+            elif self.scenes_all is None:
+                # a lazy query, stream its scenes from the catalog
+                scenes = self.iter_scenes(list_type)
+            elif list_type == 'low_cloud':
+                scenes = self.scenes_low_cloud
+            elif list_type == 'all':
+                scenes = self.scenes_all
 
-        self.candidate_scenes()
-        self.band_map = BandMap()
+        # progress is recorded in the output directory, so a restart skips finished work
+        # without stat'ing every expected file
+        self._ledger = JobLedger(self.output)
+        pipeline = ScenePipeline(self._fetch_image, workers=self.workers, max_scenes=self.max_scenes,
+                                 max_staging_bytes=self.max_staging_bytes, finished=self._scene_finished)
+        try:
+            incomplete = pipeline.run(self._scene_tasks(scenes))
+        finally:
+            self._ledger.close()
+            self._ledger = None
+        self.failed_fetches = []
+
+        if incomplete:
+            print('{} scenes did not complete: {}'.format(len(incomplete), incomplete))
+
+        # FetchResult of every band that could not be downloaded
+        self.failed_fetches = pipeline.failed
+        return self.failed_fetches
+
+    def _scene_tasks(self, scenes):
+        """ Yield a SceneTask per scene; the pipeline pulls these as it has room for more scenes. """
+        package = self.zipped or self.alt_name
+
+        if hasattr(scenes, 'itertuples'):
+            scenes = scenes.itertuples(index=False)
+
+        for row in scenes:
+            key = self._ledger_key(row.SCENE_ID)
+            state = self._ledger.scene_state(key)
+            if state == PACKAGED or (state == COMPLETE and not package):
+                print('{} is already {}'.format(row.SCENE_ID, 'packaged' if state == PACKAGED else 'downloaded'))
+                continue
+            # files from before the ledger existed, and bands left by a scene that wasn't
+            # packaged, are only found by looking; anything else the ledger knows about
+            if self._ledger.known(key):
+                check_disk = state == INCOMPLETE or (package and state is None)
+            else:
+                check_disk = self._ledger.new
 
-    def download(self, list_type='low_cloud'):
+            archive = None
+            if package:
+                name = row.PYMETRIC_ID if self.alt_name else row.SCENE_ID
+                archive = SceneArchive(os.path.join(self.output, name), row.SCENE_ID, codec=self.codec)
+                if check_disk and os.path.isfile(archive.path):
+                    print('{} is already packaged'.format(row.SCENE_ID))
+                    continue
 
-        if list_type == 'low_cloud':
-            scenes = self.scenes_low_cloud
-        elif list_type == 'all':
-            scenes = self.scenes_all
-        elif list_type == 'selected':
-            scenes = self.selected_scenes
-
-        out_dir = None
-        for ind, row in scenes.iterrows():
             print('Image {} for {}'.format(row.SCENE_ID, row.DATE_ACQUIRED))
-            for band in self.band_map.file_suffixes[self.sat_name]:
-
-                url = self._make_url(row, band)
-
-                dst = os.path.join(self.output, row.SCENE_ID, os.path.basename(url))
 
-                out_dir = os.path.join(self.output, row.SCENE_ID)
-                if not os.path.isdir(out_dir):
-                    os.mkdir(out_dir)
+            out_dir = os.path.join(self.output, row.SCENE_ID)
+            if not os.path.isdir(out_dir):
+                os.mkdir(out_dir)
 
-                if not os.path.isfile(dst):
-                    self._fetch_image(url, dst)
+            # bands already in the archive left by an earlier run are neither fetched nor added again
+            archived = archive.archived() if archive is not None else set()
+            bands = []
+            for band in self.band_map.file_suffixes[self.sat_name]:
+                url = self._make_url(row, band)
+                if os.path.basename(url) not in archived:
+                    bands.append((url, os.path.join(out_dir, os.path.basename(url))))
 
-            if self.zipped:
-                tgz_file = '{}.tar.gz'.format(row.SCENE_ID)
-                self._zip_image(tgz_file, out_dir)
+            done = None
+            if not check_disk:
+                done = set(dst for url, dst in bands if self._ledger.band_done(key, os.path.basename(dst)))
+                if archive is not None:
+                    # archived bands are deleted, and gone for good if their .part was discarded
+                    done = set(dst for dst in done if os.path.isfile(dst))
 
-            if self.alt_name:
-                tgz_file = '{}.tar.gz'.format(row.PYMETRIC_ID)
-                self._zip_image(tgz_file, out_dir)
+            yield SceneTask(row.SCENE_ID, out_dir, bands, archive=archive, done=done)
 
-        return None
+    def _scene_finished(self, task):
+        if not task.complete:
+            state = INCOMPLETE
+        else:
+            state = PACKAGED if task.archive is not None else COMPLETE
+        archive = task.archive.path if task.archive is not None else None
+        self._ledger.scene_finished(self._ledger_key(task.scene_id), state, archive=archive)
+
+    def _ledger_key(self, scene_id):
+        """ The ledger's name for a scene: clipped bands are recorded under the AOI they were
+        clipped to, so they are never taken for the full bands, or another AOI's. """
+        if self.aoi is None:
+            return scene_id
+        return '{}@{}'.format(scene_id, ','.join('{:.6f}'.format(v) for v in self.aoi))
+
+    def iter_scenes(self, list_type='low_cloud', batch_size=RECORD_BATCH_ROWS):
+        """ Stream the query's scenes as scene_query.SceneRecord tuples, in catalog order.
+
+        Unlike candidate_scenes nothing is collected, so memory stays flat however many
+        scenes match; download(scenes=...) takes the records directly.
+        """
+        import pyarrow.dataset as ds
 
+        where = self._scene_filter()
+        if list_type == 'low_cloud':
+            where &= (ds.field('CLOUD_COVER') < self.cloud) & ds.field('PRODUCT_ID').is_valid()
+        elif list_type != 'all':
+            raise AttributeError('Must choose list type all or low_cloud')
+
+        dataset = open_catalog(self.scenes, self.sat_name)
+        records = scene_records(dataset, where, batch_size=batch_size)
+        if self.drop_overlap and self.aoi_shape is not None:
+            # overlaps are judged among all scenes of a date, so find them with a narrow scan first
+            dates = dataset.to_table(columns=['SCENE_ID', 'DATE_ACQUIRED', 'WRS_PATH', 'WRS_ROW'], filter=where)
+            keep = set(self._drop_overlap(dates.to_pandas())['SCENE_ID'])
+            records = (r for r in records if r.SCENE_ID in keep)
+        return records
+
+    @metrics.timed('candidate_scenes')
     def candidate_scenes(self, return_list=False, list_type='low_cloud'):
+        import pyarrow.dataset as ds
 
-        filters = None
-        path = self.scenes_abspath
-
-        if isinstance(self.p, int):
-            filters = [[('WRS_PATH', '=', self.p), ('WRS_ROW', '=', self.r)]]
-        elif isinstance(self.p, list):
-            filters = [[('WRS_PATH', 'in', self.p), ('WRS_ROW', 'in', self.r)]]
-
-        df = pd.read_parquet(path, engine="pyarrow", filters=filters)
+        where = self._scene_filter()
+        dataset = open_catalog(self.scenes, self.sat_name)
+        table = dataset.to_table(columns=SCENE_COLUMNS, filter=where)
+        table = table.sort_by([('DATE_ACQUIRED', 'ascending'), ('WRS_PATH', 'ascending'),
+                               ('WRS_ROW', 'ascending')])
 
-        s, e = pd.Timestamp(self.start_dt), pd.Timestamp(self.end_dt)
+        low_cloud = table.filter((ds.field('CLOUD_COVER') < self.cloud) & ds.field('PRODUCT_ID').is_valid())
 
-        df['DATE_ACQUIRED'] = df['DATE_ACQUIRED'].apply(pd.to_datetime)
-        df = df.loc[(s < df.DATE_ACQUIRED) & (df.DATE_ACQUIRED < e)]
-
-        cloud_select = df.loc[(df.CLOUD_COVER < self.cloud)]
-        cloud_select.dropna(subset=['PRODUCT_ID'], inplace=True, axis=0)
+        df = table.to_pandas()
+        cloud_select = low_cloud.to_pandas()
+        if self.drop_overlap and self.aoi_shape is not None:
+            # judged within each list, so a cloudy scene doesn't push out a clear neighbour
+            df, cloud_select = self._drop_overlap(df), self._drop_overlap(cloud_select)
 
         self.scenes_all = df
         self.scenes_low_cloud = cloud_select
@@ -191,30 +348,38 @@ class GoogleDownload(object):
         else:
             return None
 
-    def select_scenes(self, n):
-        scn = self.scenes_all
-        s = scn.sort_values(by='SENSING_TIME').index.values.tolist()
-        c = scn.sort_values(by='SENSING_TIME')['CLOUD_COVER'].values.tolist()
-        ls = self._split_list(s, n)
-        lc = self._split_list(c, n)
-        c_idx = [c.index(min(c)) for c in lc]
-        select = [l[i] for l, i in zip(ls, c_idx)]
-        self.selected_scenes = scn.loc[select]
-        pass
+    @metrics.timed('select_scenes')
+    def select_scenes(self, n=None, bins='count', per_bin=1, rank='cloud', list_type='all'):
+        """ Keep the best scenes of each time bin of each path/row in selected_scenes.
+
+        By default the scenes are split into n runs in time and the clearest of each is kept;
+        see scene_query.select_per_bin for bins, per_bin and rank. list_type 'low_cloud'
+        selects only among the scenes under max_cloud_percent.
+        """
+        if self.scenes_all is None:
+            # a lazy query, the selection needs every scene in hand
+            self.candidate_scenes()
+        if list_type == 'all':
+            scn = self.scenes_all
+        elif list_type == 'low_cloud':
+            scn = self.scenes_low_cloud
+        else:
+            raise AttributeError('Must choose list type all or low_cloud')
+
+        self.selected_scenes = select_per_bin(scn, n=n, bins=bins, per_bin=per_bin, rank=rank,
+                                              start=self.start_dt)
 
     def _check_metadata(self):
 
+        meta = SatMetaData(sat='landsat', scenes_dir=self.scenes)
         if not os.path.isdir(self.scenes):
-            SatMetaData(sat='landsat').update_metadata_lists()
+            meta.update_metadata_lists()
 
         path = os.path.join(self.scenes, 'LANDSAT_{}'.format(self.sat_num))
-        if not os.path.isdir(path):
-            SatMetaData(sat='landsat').update_metadata_lists()
+        if not os.path.isdir(path) or not meta.catalog_is_current():
+            meta.update_metadata_lists()
         self.scenes_abspath = path
 
-        if not os.path.isdir(WRS_DIR):
-            SatMetaData(sat='landsat').get_wrs_shapefiles()
-
     def _check_pr_lat_lon(self):
         if self.p and self.r:
             try:
@@ -223,10 +388,21 @@ class GoogleDownload(object):
                 pass
         elif self.lat and self.lon:
             self._get_path_row()
+        elif self.aoi_shape is not None:
+            self._get_aoi_path_rows()
         else:
             raise MissingInitData(print('Must create GoogleDownload object with both path and row,'
-                                        'or with both latitude and longitude'))
+                                        'or with both latitude and longitude, or with an area of interest'))
+
+    def _wrs_index(self):
+        from landsat.wrs_index import load_index
 
+        # only fetched when a point or area has to be looked up, so path/row queries work offline
+        if self.vectors in (WRS_1, WRS_2) and not os.path.isdir(WRS_DIR):
+            SatMetaData(sat='landsat').get_wrs_shapefiles()
+        return load_index(self.vectors)
+
+    @metrics.timed('wrs_lookup')
     def _get_path_row(self):
         """
         :param lat: Latitude float
@@ -234,73 +410,102 @@ class GoogleDownload(object):
                 'convert_pr_to_ll' [path, row to coordinates]
         :return: lat, lon tuple or path, row tuple
         """
-        if self.sat_num > 3:
-            shp = WRS_2
-        else:
-            shp = WRS_1
-
-        wrs = gpd.read_file(shp)
-        pt = Point(self.lon, self.lat)
-        inter = wrs[wrs.intersects(pt)]
-        inter = inter[['PATH', 'ROW', 'PR_', 'WRSPR']]
+        inter = self._wrs_index().path_rows([self.lat], [self.lon])
         if inter.shape[0] == 0:
             raise NotImplementedError('Lat/Lon point failed to intersect the worldwide WRS, check the numbers')
         elif inter.shape[0] == 1:
-            self.p, self.r = inter.iloc[0, 'PATH'], inter.iloc[0, 'ROW']
+            self.p, self.r = int(inter['PATH'].iloc[0]), int(inter['ROW'].iloc[0])
         else:
             self.path_rows = [pr for pr in inter['WRSPR']]
-            self.p, self.r = [pr for pr in inter['PATH']], [pr for pr in inter['ROW']]
+            self.p, self.r = [int(pr) for pr in inter['PATH']], [int(pr) for pr in inter['ROW']]
+            self.tiles = list(zip(self.p, self.r))
             print('Lat/Lon produced multiple path/row intersects: {}'.format(self.path_rows))
 
+    @metrics.timed('wrs_lookup')
+    def _get_aoi_path_rows(self):
+        inter = self._wrs_index().tiles(self.aoi_shape)
+        if inter.shape[0] == 0:
+            raise NotImplementedError('Area of interest failed to intersect the worldwide WRS, check the coordinates')
+
+        self.path_rows = [pr for pr in inter['WRSPR']]
+        self.p, self.r = [int(pr) for pr in inter['PATH']], [int(pr) for pr in inter['ROW']]
+        self.tiles = list(zip(self.p, self.r))
+        if len(self.tiles) == 1:
+            self.p, self.r = self.p[0], self.r[0]
+        else:
+            print('Area of interest intersects {} path/rows: {}'.format(len(self.tiles), self.path_rows))
+
+    def _scene_filter(self):
+        if self.tiles:
+            return scene_filter(self.start_dt, self.end_dt, tiles=self.tiles)
+        return scene_filter(self.start_dt, self.end_dt, path=self.p, row=self.r)
+
+    def _drop_overlap(self, scenes):
+        """ Drop scenes whose part of the area of interest is covered by the others of their date. """
+        import pandas as pd
+
+        if scenes.shape[0] == 0:
+            return scenes
+
+        index = self._wrs_index()
+        dates = pd.to_datetime(scenes['DATE_ACQUIRED']).dt.normalize()
+        tiles = list(zip(scenes['WRS_PATH'].astype(int), scenes['WRS_ROW'].astype(int)))
+
+        # the path/rows of each date; dates with the same path/rows share one answer
+        on_date = {}
+        for date, tile in zip(dates, tiles):
+            on_date.setdefault(date, set()).add(tile)
+        covering = {}
+        for present in set(frozenset(t) for t in on_date.values()):
+            covering[present] = index.covering(self.aoi_shape, present) if len(present) > 1 else present
+
+        keep = [tile in covering[frozenset(on_date[date])] for date, tile in zip(dates, tiles)]
+        dropped = len(keep) - sum(keep)
+        if dropped:
+            print('Dropped {} scenes covered by others of the same date'.format(dropped))
+        return scenes[keep]
+
     @staticmethod
     def _make_url(row, band):
+        """ e.g. http://storage.googleapis.com/gcp-public-data-landsat/LC08/01/037/029/
+        LC08_L1TP_037029_20130602_20170310_01_T1/LC08_L1TP_037029_20130602_20170310_01_T1_B2.TIF,
+        on the host given by update_landsat_metadata.storage_url """
 
-        parse = urlparse('http://storage.googleapis.com/gcp-public-data-landsat/LC08/01/037/029/'
-                         'LC08_L1TP_037029_20130602_20170310_01_T1/LC08_L1TP_037029_20130602_20170310_01_T1_B2.TIF')
+        parse = urlparse(storage_url())
 
         base = row.BASE_URL.replace('gs://', '')
-        path = '{}/{}_{}'.format(base, row.PRODUCT_ID, band)
+        path = '{}/{}/{}_{}'.format(parse.path, base, row.PRODUCT_ID, band)
         url = urlunparse([parse.scheme, parse.netloc, path, '', '', ''])
         return url
 
-    @staticmethod
-    def _fetch_image(url, destination_path=None):
-
-        if not destination_path:
-            destination_path = os.path.join(os.getcwd(), os.path.basename(url))
+    def _fetch_image(self, url, destination_path=None):
+        ledger = self._ledger
+        if ledger is None or destination_path is None:
+            return self._get_band(url, destination_path)
 
+        scene_id = self._ledger_key(os.path.basename(os.path.dirname(destination_path)))
+        band = os.path.basename(destination_path)
+        ledger.band_started(scene_id, band, url)
         try:
-            response = get(url, stream=True)
-            if response.status_code == 200:
-                with open(destination_path, 'wb') as f:
-                    print('Getting {}'.format(os.path.basename(url)))
-                    for chunk in response.iter_content(chunk_size=1024 * 1024 * 8):
-                        f.write(chunk)
-
-            elif response.status_code > 399:
-                print('Code {} on {}'.format(response.status_code, url))
-                raise BadRequestsResponse(Exception)
-        except BadRequestsResponse:
-            pass
-
-    @staticmethod
-    def _zip_image(output_filename, source_dir):
-        out_location = os.path.dirname(source_dir)
-        with tarfile.open(os.path.join(out_location, output_filename), "w:gz") as tar:
-            tar.add(source_dir, arcname=os.path.basename(source_dir))
-        shutil.rmtree(source_dir)
+            result = self._get_band(url, destination_path)
+        except Exception as e:
+            ledger.band_failed(scene_id, band, e)
+            raise
 
-    @staticmethod
-    def _split_list(seq, num):
-        avg = len(seq) / float(num)
-        out = []
-        last = 0.0
-
-        while last < len(seq):
-            out.append(seq[int(last):int(last + avg)])
-            last += avg
-
-        return out
+        if result.ok:
+            ledger.band_finished(scene_id, band, result.size, result.checksum, result.verified)
+        else:
+            ledger.band_failed(scene_id, band, result.error)
+        return result
+
+    def _get_band(self, url, destination_path=None):
+        if self.aoi and url.upper().endswith('.TIF'):
+            if not destination_path:
+                destination_path = os.path.join(os.getcwd(), os.path.basename(url))
+            return self.fetcher.fetch_window(url, self.aoi, destination_path)
+        if self.cache is not None and destination_path:
+            return self.cache.get(url, destination_path, self.fetcher.fetch)
+        return self.fetcher.fetch(url, destination_path)
 
 
 if __name__ == '__main__':
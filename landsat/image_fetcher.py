@@ -0,0 +1,539 @@
+# =============================================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================================
+from __future__ import print_function, absolute_import
+
+import os
+import time
+import base64
+import random
+import hashlib
+import struct
+from collections import namedtuple
+from email.utils import parsedate_tz, mktime_tz
+from threading import Lock, Condition
+from concurrent.futures import ThreadPoolExecutor
+
+from landsat import bandwidth
+from landsat.metrics import metrics
+
+CHUNK_SIZE = 1024 * 1024
+PART_SUFFIX = '.part'
+SEGMENT_SUFFIX = '.segments'
+SEGMENT_THRESHOLD = 1024 * 1024 * 64
+# (connect, read) seconds
+TIMEOUT = (15, 120)
+
+RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+# responses that mean the server wants fewer requests from us
+THROTTLE_STATUS = (429, 503)
+MAX_RETRY_AFTER = 300.
+
+# outcome of ImageFetcher.fetch; checksum is the base64 MD5 of the file as it was written, and
+# verified names what it was checked against: 'md5' or 'crc32c' from the server's x-goog-hash,
+# or just 'size' from Content-Length
+FetchResult = namedtuple('FetchResult', ['url', 'path', 'ok', 'status', 'size', 'checksum', 'attempts', 'error',
+                                         'verified'])
+FetchResult.__new__.__defaults__ = (None, None, None, 1, None, None)
+
+
+class BadRequestsResponse(Exception):
+    pass
+
+
+class SegmentError(Exception):
+    pass
+
+
+class RetryableError(Exception):
+    def __init__(self, message, status=None, retry_after=None):
+        super(RetryableError, self).__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class ChecksumMismatch(RetryableError):
+    pass
+
+
+def server_hashes(response):
+    """ {'md5': ..., 'crc32c': ...} of base64 digests from 'x-goog-hash: crc32c=...,md5=...' headers. """
+    hashes = {}
+    for part in response.headers.get('x-goog-hash', '').split(','):
+        name, _, value = part.strip().partition('=')
+        if name in ('md5', 'crc32c') and value:
+            hashes[name] = value
+    return hashes
+
+
+def _crc32c():
+    """ An update(data, crc) -> crc function if a CRC32C package is installed, else None. """
+    try:
+        import google_crc32c
+
+        return lambda data, crc: google_crc32c.extend(crc, data)
+    except ImportError:
+        pass
+    try:
+        import crc32c
+
+        return lambda data, crc: crc32c.crc32c(data, crc)
+    except ImportError:
+        return None
+
+
+class StreamDigest(object):
+    """ Hashes a file as its chunks are written, to check it against the server's digests
+    without reading it back.
+
+    MD5 is always computed. CRC32C is computed only when the server sends no MD5 (composite
+    objects) and google-crc32c or crc32c is installed.
+    """
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.md5 = hashlib.md5()
+        self._crc_update = _crc32c() if 'crc32c' in expected and 'md5' not in expected else None
+        self.crc = 0
+        self.size = 0
+
+    def update(self, chunk):
+        self.md5.update(chunk)
+        if self._crc_update is not None:
+            self.crc = self._crc_update(chunk, self.crc)
+        self.size += len(chunk)
+
+    def update_from_file(self, path):
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                self.update(chunk)
+
+    def digest(self):
+        return base64.b64encode(self.md5.digest()).decode('ascii')
+
+    def verify(self, name, expected_size=None):
+        """ Name of the check the file passed; raises ChecksumMismatch if it failed one. """
+        if expected_size is not None and self.size != expected_size:
+            raise ChecksumMismatch('{} is {} bytes, expected {}'.format(name, self.size, expected_size))
+        if 'md5' in self.expected:
+            if self.digest() != self.expected['md5']:
+                raise ChecksumMismatch('MD5 mismatch on {}'.format(name))
+            return 'md5'
+        if self._crc_update is not None:
+            crc = base64.b64encode(struct.pack('>I', self.crc)).decode('ascii')
+            if crc != self.expected['crc32c']:
+                raise ChecksumMismatch('CRC32C mismatch on {}'.format(name))
+            return 'crc32c'
+        return 'size' if expected_size is not None else None
+
+
+def retry_after(response):
+    """ Seconds to wait from a Retry-After header given as seconds or as an HTTP date, or None. """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        parsed = parsedate_tz(value)
+        if parsed is None:
+            return None
+        seconds = mktime_tz(parsed) - time.time()
+    return min(max(seconds, 0.), MAX_RETRY_AFTER)
+
+
+class RetryPolicy(object):
+    """ Exponential backoff with full jitter: attempt n waits a random time of up to
+    base * 2 ** (n - 1) seconds, capped at cap, or longer if the server asked for it. """
+
+    def __init__(self, attempts=5, base=1., cap=60.):
+        self.attempts = max(1, int(attempts))
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt, retry_after=None):
+        wait = random.uniform(0, min(self.cap, self.base * 2 ** (attempt - 1)))
+        if retry_after is not None:
+            wait = max(wait, retry_after)
+        return wait
+
+
+class ConcurrencyController(object):
+    """ Additive-increase, multiplicative-decrease limit on requests in flight.
+
+    The limit starts at maximum, halves on every throttling response and grows back by one
+    after each run of limit successful downloads.
+    """
+
+    def __init__(self, maximum, minimum=1):
+        self.maximum = max(1, int(maximum))
+        self.minimum = max(1, min(int(minimum), self.maximum))
+        self.limit = self.maximum
+        self.active = 0
+        self._successes = 0
+        self._condition = Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.active >= self.limit:
+                self._condition.wait()
+            self.active += 1
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    def success(self):
+        with self._condition:
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self._successes = 0
+                self._condition.notify_all()
+
+    def throttle(self):
+        with self._condition:
+            self.limit = max(self.minimum, self.limit // 2)
+            self._successes = 0
+
+
+class ImageFetcher(object):
+    """ Fetch band files over a keep-alive session sized for a pool of download workers.
+
+    A single fetcher is shared by every worker thread in GoogleDownload.download, so
+    connections to the storage host are reused rather than re-opened for each band.
+
+    With segments > 1, files larger than segment_threshold bytes are split into that many
+    byte ranges which are fetched on separate connections and written in place. A range
+    that is throttled, cut short or drops its connection is retried on its own under the
+    retry policy, keeping the ranges that finished; a server that doesn't honour the
+    ranges gets a single stream instead.
+    """
+
+    def __init__(self, workers=1, segments=1, segment_threshold=SEGMENT_THRESHOLD, retry=None):
+        from requests import Session
+        from requests.adapters import HTTPAdapter
+        from requests.exceptions import ConnectionError, Timeout, ChunkedEncodingError
+
+        self.workers = max(1, int(workers))
+        self.segments = max(1, int(segments))
+        self.segment_threshold = segment_threshold
+        self.session = Session()
+        pool = self.workers * self.segments
+        adapter = HTTPAdapter(pool_connections=pool, pool_maxsize=pool)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.retry = retry or RetryPolicy()
+        self.concurrency = ConcurrencyController(self.workers)
+        self._transient = (ConnectionError, Timeout, ChunkedEncodingError)
+
+    def fetch(self, url, destination_path=None):
+        """ Download url to destination_path by way of a part-file, retrying transient failures.
+
+        Bytes are written to destination_path + '.part', which is renamed into place only
+        once the whole file has arrived, so a path that exists is always complete. If a
+        part-file survives from an interrupted attempt or run, the request asks for the
+        remaining bytes with a Range header and appends to it rather than starting over.
+
+        Connection errors, short transfers and 429/5xx responses are retried under
+        self.retry; throttling responses also narrow self.concurrency. Any other error
+        comes back as a FetchResult with ok False rather than being raised.
+
+        :return: FetchResult
+        """
+
+        if not destination_path:
+            destination_path = os.path.join(os.getcwd(), os.path.basename(url))
+        return self._with_retry(url, destination_path, self._fetch_once)
+
+    def fetch_window(self, url, bounds, destination_path):
+        """ Write the part of the GeoTIFF at url covering lon/lat bounds to destination_path
+        (see tiff_window.RemoteTiff), with the same retries as fetch.
+
+        :return: FetchResult; its checksum is None, the server's is for the whole file
+        """
+        return self._with_retry(url, destination_path,
+                                lambda u, dst: self._fetch_window_once(u, bounds, dst))
+
+    def _with_retry(self, url, destination_path, attempt_fetch):
+        name = os.path.basename(destination_path)
+        start = time.time()
+        attempt = 0
+        while True:
+            attempt += 1
+            self.concurrency.acquire()
+            metrics.gauge('requests_in_flight', self.concurrency.active)
+            try:
+                with metrics.timer('request', file=name):
+                    result = attempt_fetch(url, destination_path)
+                error = None
+            except RetryableError as e:
+                error = e
+            except self._transient as e:
+                error = RetryableError(e)
+            except Exception as e:
+                # e.g. an unwritable destination: no use retrying, but it is still a result
+                result, error = FetchResult(url, destination_path, False, error='{}: {}'.format(
+                    type(e).__name__, e)), None
+            finally:
+                self.concurrency.release()
+
+            if error is None:
+                # a 404 or other final failure says nothing about how busy the server is
+                if result.ok:
+                    self.concurrency.success()
+                metrics.observe('fetch', time.time() - start, file=name, attempts=attempt, ok=result.ok)
+                if result.ok:
+                    metrics.count('download_bytes', result.size or 0, file=name)
+                else:
+                    metrics.count('failed_fetches', file=name)
+                return result._replace(attempts=attempt)
+
+            if error.status in THROTTLE_STATUS:
+                self.concurrency.throttle()
+                metrics.count('throttled', file=name, status=error.status)
+            if attempt >= self.retry.attempts:
+                metrics.observe('fetch', time.time() - start, file=name, attempts=attempt, ok=False)
+                metrics.count('failed_fetches', file=name)
+                return FetchResult(url, destination_path, False, status=error.status, attempts=attempt,
+                                   error=str(error))
+            metrics.count('retries', file=name, error=str(error))
+            time.sleep(self.retry.delay(attempt, error.retry_after))
+
+    def _fetch_once(self, url, destination_path):
+        part_path = destination_path + PART_SUFFIX
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+
+        if self.segments > 1 and not offset:
+            head = self._segmentable(url)
+            if head:
+                try:
+                    size = self._content_length(head)
+                    self._fetch_segmented(url, destination_path, size)
+                    # ranges land out of order, so a segmented file is only checked for its size
+                    return FetchResult(url, destination_path, True, status=head.status_code, size=size,
+                                       verified='size')
+                except SegmentError as e:
+                    print('Segmented download of {} failed ({}), using a single stream'.format(
+                        os.path.basename(url), e))
+                except RetryableError as e:
+                    # each range has had its retries, the whole file isn't tried again
+                    return FetchResult(url, destination_path, False, status=e.status, error=str(e))
+
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+
+        response = self.session.get(url, stream=True, headers=headers, timeout=TIMEOUT)
+        if response.status_code == 416:
+            response.close()
+            if self._total_size(response) == offset:
+                # the part file is already whole, so it has to be read once to be checked
+                digest = StreamDigest(server_hashes(response))
+                digest.update_from_file(part_path)
+                return self._finish(url, part_path, destination_path, response, digest, offset)
+            os.remove(part_path)
+            return self._fetch_once(url, destination_path)
+
+        elif response.status_code in (200, 206):
+            digest = StreamDigest(server_hashes(response))
+            if response.status_code == 206 and self._range_start(response) == offset:
+                mode, expected = 'ab', self._total_size(response)
+                print('Resuming {} at {} bytes'.format(os.path.basename(url), offset))
+                # only the bytes kept from the earlier attempt are read back
+                digest.update_from_file(part_path)
+            else:
+                # the server sent the whole file, so the old part-file is discarded
+                mode, offset = 'wb', 0
+                expected = self._content_length(response)
+                print('Getting {}'.format(os.path.basename(url)))
+
+            with open(part_path, mode) as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+                    digest.update(chunk)
+                    offset += len(chunk)
+                    bandwidth.limiter.consume(len(chunk))
+
+            if expected is not None and offset < expected:
+                raise RetryableError('Incomplete {}: {} of {} bytes'.format(os.path.basename(url), offset, expected))
+
+            return self._finish(url, part_path, destination_path, response, digest, expected)
+
+        response.close()
+        if response.status_code in RETRY_STATUS:
+            raise RetryableError('Code {} on {}'.format(response.status_code, url), status=response.status_code,
+                                 retry_after=retry_after(response))
+        return FetchResult(url, destination_path, False, status=response.status_code,
+                           error='Code {} on {}'.format(response.status_code, url))
+
+    def _fetch_window_once(self, url, bounds, destination_path):
+        from landsat.tiff_window import RemoteTiff, WindowError
+
+        print('Clipping {} to the AOI'.format(os.path.basename(url)))
+        try:
+            size = RemoteTiff(self.session, url).extract(bounds, destination_path)
+        except WindowError as e:
+            return FetchResult(url, destination_path, False, error=str(e))
+        return FetchResult(url, destination_path, True, status=206, size=size)
+
+    @staticmethod
+    def _finish(url, part_path, destination_path, response, digest, expected_size):
+        """ Move a checked part-file into place; a file that fails its check is deleted and refetched. """
+        try:
+            verified = digest.verify(os.path.basename(destination_path), expected_size)
+        except ChecksumMismatch:
+            os.remove(part_path)
+            metrics.count('checksum_mismatches', file=os.path.basename(destination_path))
+            raise
+        os.replace(part_path, destination_path)
+        return FetchResult(url, destination_path, True, status=response.status_code, size=digest.size,
+                           checksum=digest.digest(), verified=verified)
+
+    def _segmentable(self, url):
+        """ HEAD response for url if the file is big enough to split and the server takes byte ranges. """
+        response = self.session.head(url, allow_redirects=True, timeout=TIMEOUT)
+        if response.status_code != 200:
+            return None
+        if response.headers.get('Accept-Ranges', '').lower() != 'bytes':
+            return None
+        size = self._content_length(response)
+        if size is None or size < self.segment_threshold:
+            return None
+        return response
+
+    def _fetch_segmented(self, url, destination_path, size):
+        """ Fetch [0, size) as self.segments concurrent Range requests into a preallocated file.
+
+        The file is built under its own suffix so a killed run can never leave a full-size
+        file with unwritten holes where the single-stream resume would mistake it for done.
+        """
+        segment_path = destination_path + SEGMENT_SUFFIX
+        step = -(-size // self.segments)
+        ranges = [(start, min(start + step, size) - 1) for start in range(0, size, step)]
+
+        print('Getting {} in {} segments'.format(os.path.basename(url), len(ranges)))
+        with open(segment_path, 'wb') as f:
+            f.truncate(size)
+
+        fd = os.open(segment_path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+        lock = Lock()
+        try:
+            with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                futures = [executor.submit(self._fetch_segment, url, fd, lock, start, end)
+                           for start, end in ranges]
+                for future in futures:
+                    future.result()
+        except Exception as e:
+            os.close(fd)
+            os.remove(segment_path)
+            # a range that used up its retries fails the file; anything else means ranges
+            # don't work here, and a single stream is tried instead
+            if isinstance(e, RetryableError):
+                raise
+            raise SegmentError(e)
+
+        os.close(fd)
+        os.replace(segment_path, destination_path)
+
+    def _fetch_segment(self, url, fd, lock, start, end):
+        """ Fetch bytes start-end into fd, retrying just this range under self.retry; each
+        retry asks only for the bytes not yet written. """
+        name = os.path.basename(url)
+        progress = [start]
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return self._fetch_range(url, fd, lock, progress, end)
+            except RetryableError as e:
+                error = e
+            except self._transient as e:
+                error = RetryableError(e)
+
+            if error.status in THROTTLE_STATUS:
+                self.concurrency.throttle()
+                metrics.count('throttled', file=name, status=error.status)
+            if attempt >= self.retry.attempts:
+                raise error
+            metrics.count('retries', file=name, error=str(error))
+            time.sleep(self.retry.delay(attempt, error.retry_after))
+
+    def _fetch_range(self, url, fd, lock, progress, end):
+        start = progress[0]
+        response = self.session.get(url, stream=True, headers={'Range': 'bytes={}-{}'.format(start, end)},
+                                    timeout=TIMEOUT)
+        if response.status_code in RETRY_STATUS:
+            response.close()
+            raise RetryableError('Code {} for bytes {}-{} of {}'.format(response.status_code, start, end, url),
+                                 status=response.status_code, retry_after=retry_after(response))
+        if response.status_code != 206 or self._range_start(response) != start:
+            response.close()
+            raise SegmentError('code {} for bytes {}-{}'.format(response.status_code, start, end))
+
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            self._write_at(fd, lock, chunk, progress[0])
+            progress[0] += len(chunk)
+            bandwidth.limiter.consume(len(chunk))
+
+        if progress[0] != end + 1:
+            raise RetryableError('Short read for bytes {}-{} of {}'.format(start, end, url))
+
+    @staticmethod
+    def _write_at(fd, lock, data, position):
+        view = memoryview(data)
+        while view:
+            if hasattr(os, 'pwrite'):
+                written = os.pwrite(fd, view, position)
+            else:
+                with lock:
+                    os.lseek(fd, position, os.SEEK_SET)
+                    written = os.write(fd, view)
+            view = view[written:]
+            position += written
+
+    @staticmethod
+    def _content_length(response):
+        try:
+            return int(response.headers['Content-Length'])
+        except (KeyError, ValueError):
+            return None
+
+    @staticmethod
+    def _range_start(response):
+        """ First byte position of a 'bytes start-end/total' Content-Range header. """
+        try:
+            return int(response.headers['Content-Range'].split()[1].split('-')[0])
+        except (KeyError, IndexError, ValueError):
+            return None
+
+    @staticmethod
+    def _total_size(response):
+        """ Complete object size from a 'bytes start-end/total' or 'bytes */total' Content-Range header. """
+        try:
+            return int(response.headers['Content-Range'].split('/')[1])
+        except (KeyError, IndexError, ValueError):
+            return None
+
+    def close(self):
+        self.session.close()
+
+
+if __name__ == '__main__':
+    pass
+
+# ========================= EOF ================================================================
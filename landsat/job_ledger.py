@@ -0,0 +1,170 @@
+# =============================================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================================
+from __future__ import print_function, absolute_import
+
+import os
+import time
+import sqlite3
+from threading import Lock
+
+LEDGER_NAME = 'landsat_ledger.sqlite'
+
+# band states
+DOWNLOADING = 'downloading'
+DONE = 'done'
+FAILED = 'failed'
+
+# scene states
+COMPLETE = 'complete'
+PACKAGED = 'packaged'
+INCOMPLETE = 'incomplete'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS bands (
+    scene_id TEXT NOT NULL,
+    band TEXT NOT NULL,
+    url TEXT,
+    state TEXT NOT NULL,
+    size INTEGER,
+    checksum TEXT,
+    verified TEXT,
+    started REAL,
+    finished REAL,
+    error TEXT,
+    PRIMARY KEY (scene_id, band));
+CREATE TABLE IF NOT EXISTS scenes (
+    scene_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    archive TEXT,
+    finished REAL);
+'''
+
+
+def ledger_file(output_dir):
+    return os.path.join(output_dir, LEDGER_NAME)
+
+
+class JobLedger(object):
+    """ SQLite record of every scene and band downloaded into an output directory.
+
+    The ledger is read once when it is opened, so a restarted download looks up what is
+    already done in memory instead of stat'ing each expected file on the output volume.
+    Files removed by hand after they were recorded are not noticed; delete the ledger
+    to make the next run check the directory again.
+    """
+
+    def __init__(self, output_dir):
+        self.path = ledger_file(output_dir)
+        self._lock = Lock()
+        self.new = not os.path.isfile(self.path)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+        columns = [c[1] for c in self._conn.execute('PRAGMA table_info(bands)')]
+        if 'verified' not in columns:
+            # ledgers written before checksums were verified
+            self._conn.execute('ALTER TABLE bands ADD COLUMN verified TEXT')
+
+        self.scenes = dict(self._conn.execute('SELECT scene_id, state FROM scenes'))
+        self.done_bands = {}
+        for scene_id, band in self._conn.execute('SELECT scene_id, band FROM bands WHERE state = ?', (DONE,)):
+            self.done_bands.setdefault(scene_id, set()).add(band)
+
+    def scene_state(self, scene_id):
+        return self.scenes.get(scene_id)
+
+    def known(self, scene_id):
+        """ True if the ledger holds any record of scene_id. """
+        return scene_id in self.scenes or scene_id in self.done_bands
+
+    def band_done(self, scene_id, band):
+        return band in self.done_bands.get(scene_id, ())
+
+    def band_started(self, scene_id, band, url):
+        self._execute('INSERT OR REPLACE INTO bands (scene_id, band, url, state, started) VALUES (?, ?, ?, ?, ?)',
+                      (scene_id, band, url, DOWNLOADING, time.time()))
+
+    def band_finished(self, scene_id, band, size, checksum=None, verified=None):
+        """ Record a finished band; checksum is its base64 MD5 and verified what it was checked against. """
+        self._execute('UPDATE bands SET state = ?, size = ?, checksum = ?, verified = ?, finished = ?, error = NULL '
+                      'WHERE scene_id = ? AND band = ?',
+                      (DONE, size, checksum, verified, time.time(), scene_id, band))
+        with self._lock:
+            self.done_bands.setdefault(scene_id, set()).add(band)
+
+    def band_failed(self, scene_id, band, error):
+        self._execute('UPDATE bands SET state = ?, finished = ?, error = ? WHERE scene_id = ? AND band = ?',
+                      (FAILED, time.time(), str(error), scene_id, band))
+
+    def scene_finished(self, scene_id, state, archive=None):
+        self._execute('INSERT OR REPLACE INTO scenes (scene_id, state, archive, finished) VALUES (?, ?, ?, ?)',
+                      (scene_id, state, archive, time.time()))
+        with self._lock:
+            self.scenes[scene_id] = state
+
+    def summary(self):
+        """ Counts and totals describing the progress of the job. """
+        with self._lock:
+            scenes = dict(self._conn.execute('SELECT state, COUNT(*) FROM scenes GROUP BY state'))
+            bands = dict((state, (count, size or 0, seconds or 0.)) for state, count, size, seconds in
+                         self._conn.execute('SELECT state, COUNT(*), SUM(size), SUM(finished - started) '
+                                            'FROM bands GROUP BY state'))
+            failures = self._conn.execute('SELECT scene_id, band, error FROM bands WHERE state = ? '
+                                          'ORDER BY finished DESC', (FAILED,)).fetchall()
+        return {'scenes': scenes, 'bands': bands, 'failures': failures}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _execute(self, sql, params):
+        with self._lock:
+            self._conn.execute(sql, params)
+            self._conn.commit()
+
+
+def print_status(output_dir, max_failures=10):
+    """ Print the progress recorded in output_dir's ledger, for 'landsat status'. """
+    if not os.path.isfile(ledger_file(output_dir)):
+        print('No download ledger in {}'.format(output_dir))
+        return None
+
+    ledger = JobLedger(output_dir)
+    summary = ledger.summary()
+    ledger.close()
+
+    print('Scenes: {}'.format(', '.join('{} {}'.format(n, s) for s, n in sorted(summary['scenes'].items()))
+                              or 'none finished'))
+    for state, (count, size, seconds) in sorted(summary['bands'].items()):
+        line = 'Bands {}: {}'.format(state, count)
+        if state == DONE:
+            line += ', {:.1f} MB'.format(size / 1e6)
+            if seconds > 0:
+                line += ', {:.1f} MB/s per stream'.format(size / 1e6 / seconds)
+        print(line)
+
+    failures = summary['failures']
+    for scene_id, band, error in failures[:max_failures]:
+        print('  failed {}/{}: {}'.format(scene_id, band, error))
+    if len(failures) > max_failures:
+        print('  ... and {} more'.format(len(failures) - max_failures))
+
+    return summary
+
+
+if __name__ == '__main__':
+    pass
+
+# ========================= EOF ================================================================
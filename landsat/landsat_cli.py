@@ -47,6 +47,12 @@ satellite: 5
 return_list: False
 zipped: True
 max_cloud_percent: 100
+workers: 1
+# e.g. 200MB/s, or by time of day:
+# max_bandwidth:
+#   '08:00-18:00': 50MB/s
+#   default: unlimited
+max_bandwidth:
 '''
 
 CONFIG_PLACEMENT = os.path.dirname(__file__)
@@ -74,11 +80,57 @@ def create_parser():
     parser.add_argument('--zipped', help='Download .tar.gz file(s), without unzipping',
                         action='store_true', default=False)
 
+    parser.add_argument('--codec', help='Archive format for --zipped: gz (default), none (plain tar), '
+                                        'pigz (multi-threaded gzip) or zst (zstandard)',
+                        choices=['gz', 'none', 'pigz', 'zst'], default='gz')
+
     parser.add_argument('--max-cloud-percent', help='Maximum percent of of image obscured by clouds accepted,'
                                                     ' type integer', type=float, default=100)
 
+    parser.add_argument('--workers', help='Number of bands to download concurrently, type integer',
+                        type=int, default=1)
+
+    parser.add_argument('--segments', help='Split large band files into this many byte ranges '
+                                           'downloaded in parallel, type integer', type=int, default=1)
+
+    parser.add_argument('--retries', help='Attempts per file before giving up on it, backing off between '
+                                          'attempts and when the server throttles, type integer',
+                        type=int, default=5)
+
+    parser.add_argument('--max-bandwidth', help="Cap on the total download rate, e.g. 200MB/s or 800Mbps; "
+                                                "by time of day as '08:00-18:00=50MB/s,default=unlimited'")
+
+    parser.add_argument('--cache-dir', help='Machine-wide band cache shared by all output directories '
+                                            '(default $LANDSAT578_CACHE); cached bands are linked, not refetched')
+
+    parser.add_argument('--cache-max-gb', help='Remove least recently used bands beyond this cache size',
+                        type=float, default=None)
+
+    parser.add_argument('--aoi', help='Only download the part of each image covering this area: '
+                                      'west,south,east,north in degrees, or a GeoJSON file or shapefile; '
+                                      'without a path/row, every path/row intersecting it is queried')
+
+    parser.add_argument('--drop-overlap', action='store_true', default=False,
+                        help='Skip scenes whose part of the --aoi other path/rows of the same date cover')
+
+    parser.add_argument('--max-scenes', help='Most scenes downloading or packaging at once, '
+                                             'type integer (default workers + 1)', type=int, default=None)
+
+    parser.add_argument('--max-staging-mb', help='Pause starting new scenes while downloaded bands waiting '
+                                                 'to be packaged exceed this many MB', type=float, default=None)
+
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help='Print the time spent in each download and query stage at exit')
+
+    parser.add_argument('--metrics-file', help='Export throughput metrics: a Prometheus textfile written at exit '
+                                               'if the name ends in .prom, else a JSON-lines event stream')
+
     parser.add_argument('--update-scenes', action='store_true', help='Update the scenes list')
 
+    parser.add_argument('--incremental', action='store_true', default=False,
+                        help='With --update-scenes, only add scenes newer than the local list, '
+                             'and skip the update if the remote index is unchanged')
+
     return parser
 
 
@@ -93,8 +145,10 @@ def main(args):
             if var is not None:
                 cfg[arg] = var
 
+        instrument(cfg.pop('profile', False), cfg.pop('metrics_file', None))
+
         if cfg['update_scenes']:
-            SatMetaData(sat='landsat').update_metadata_lists()
+            SatMetaData(sat='landsat').update_metadata_lists(incremental=cfg['incremental'])
             exit()
 
         if cfg['return_list']:
@@ -112,6 +166,7 @@ def main(args):
             del cfg['return_list']
             del cfg['configuration']
             del cfg['update_scenes']
+            del cfg['incremental']
 
             del cfg['clear_scenes']
             del cfg['pymetric_root']
@@ -124,6 +179,14 @@ def main(args):
         else:
             del cfg['return_list']
             del cfg['update_scenes']
+            del cfg['incremental']
+
+            if return_scene_list:
+                from landsat.query_service import service_candidate_scenes
+
+                scenes = service_candidate_scenes(cfg)
+                if scenes is not None:
+                    return scenes
 
             g = GoogleDownload(**cfg)
             if return_scene_list:
@@ -132,7 +195,50 @@ def main(args):
                 g.download()
 
 
+def instrument(profile=False, metrics_file=None):
+    """ Report the metrics collected in this run at exit, see landsat.metrics. """
+    if not profile and not metrics_file:
+        return None
+
+    import atexit
+    from landsat.metrics import metrics, export
+
+    if metrics_file:
+        atexit.register(export(metrics_file))
+    if profile:
+        atexit.register(lambda: print('\n' + metrics.profile()))
+
+
+def create_serve_parser():
+    parser = argparse.ArgumentParser(prog='landsat serve',
+                                     description='Keep the scene lists in memory and answer queries over '
+                                                 'localhost HTTP; other landsat commands use it when it runs.')
+    parser.add_argument('--host', help='Address to listen on', default=None)
+    parser.add_argument('--port', help='Port to listen on, any free one by default', type=int, default=None)
+    return parser
+
+
+def create_status_parser():
+    parser = argparse.ArgumentParser(prog='landsat status',
+                                     description='Summarize the downloads recorded in an output directory.')
+    parser.add_argument('-o', '--output-path', help='Output directory of the download', default=os.getcwd())
+    return parser
+
+
 def cli_runner():
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        from landsat.query_service import serve
+
+        args = create_serve_parser().parse_args(sys.argv[2:])
+        return serve(host=args.host, port=args.port)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'status':
+        from landsat.job_ledger import print_status
+
+        args = create_status_parser().parse_args(sys.argv[2:])
+        print_status(args.output_path)
+        return None
+
     parser = create_parser()
     args = parser.parse_args()
     if len(sys.argv) == 1:
@@ -162,7 +268,10 @@ if __name__ == '__main__':
     args = Namespace(satellite=8, start='2021-07-01', end='2021-07-31', latitude=46.8, longitude=-114.0, path=None,
                      row=None,
                      output_path='/home/dgketchum/PycharmProjects/Landsat578', configuration=None, clear_scenes=None,
-                     return_list=False, zipped=False, max_cloud_percent=100, update_scenes=False)
+                     return_list=False, zipped=False, max_cloud_percent=100, update_scenes=False, workers=1,
+                     segments=1, incremental=False, codec='gz', max_scenes=None,
+                     max_staging_mb=None, aoi=None, drop_overlap=False, retries=5,
+                     max_bandwidth=None, cache_dir=None, cache_max_gb=None, profile=False, metrics_file=None)
 
     main(args)
 
@@ -0,0 +1,203 @@
+# =============================================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================================
+from __future__ import print_function, absolute_import
+
+import os
+import json
+import time
+from threading import Lock
+from functools import wraps
+from contextlib import contextmanager
+
+PREFIX = 'landsat_'
+
+
+class Metrics(object):
+    """ Counters, timers and gauges for the download and query paths, with event hooks.
+
+    count() adds to a counter (bytes, retries, cache hits), observe() records a duration
+    for a stage (timer() does it around a block) and gauge() sets a level such as a queue
+    depth. Callbacks passed to subscribe() receive every update as a dict, e.g.
+    {'event': 'observe', 'name': 'fetch', 'value': 0.8, 'time': ..., 'url': ...}.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._hooks = []
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            # name: [count, total seconds, max seconds]
+            self.timers = {}
+            # name: [current, max]
+            self.gauges = {}
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._hooks.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self._hooks:
+                self._hooks.remove(callback)
+
+    def count(self, name, value=1, **fields):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        self._emit('count', name, value, fields)
+
+    def observe(self, name, seconds, **fields):
+        with self._lock:
+            timer = self.timers.setdefault(name, [0, 0., 0.])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+        self._emit('observe', name, seconds, fields)
+
+    def gauge(self, name, value, **fields):
+        with self._lock:
+            gauge = self.gauges.setdefault(name, [value, value])
+            gauge[0] = value
+            gauge[1] = max(gauge[1], value)
+        self._emit('gauge', name, value, fields)
+
+    @contextmanager
+    def timer(self, name, **fields):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **fields)
+
+    def timed(self, name):
+        """ Decorator timing every call of a function as stage name. """
+
+        def decorate(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorate
+
+    def _emit(self, event, name, value, fields):
+        if not self._hooks:
+            return None
+        record = dict(fields, event=event, name=name, value=value, time=time.time())
+        for hook in list(self._hooks):
+            hook(record)
+
+    def prometheus(self):
+        """ The current values in Prometheus text exposition format. """
+        lines = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                lines += ['# TYPE {}{}_total counter'.format(PREFIX, name),
+                          '{}{}_total {}'.format(PREFIX, name, value)]
+            for name, (n, total, longest) in sorted(self.timers.items()):
+                lines += ['# TYPE {}{}_seconds summary'.format(PREFIX, name),
+                          '{}{}_seconds_count {}'.format(PREFIX, name, n),
+                          '{}{}_seconds_sum {:.6f}'.format(PREFIX, name, total),
+                          '# TYPE {}{}_seconds_max gauge'.format(PREFIX, name),
+                          '{}{}_seconds_max {:.6f}'.format(PREFIX, name, longest)]
+            for name, (current, highest) in sorted(self.gauges.items()):
+                lines += ['# TYPE {}{} gauge'.format(PREFIX, name),
+                          '{}{} {}'.format(PREFIX, name, current),
+                          '# TYPE {}{}_max gauge'.format(PREFIX, name),
+                          '{}{}_max {}'.format(PREFIX, name, highest)]
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """ Write prometheus() to path for node_exporter's textfile collector, atomically. """
+        part = '{}.{}.part'.format(path, os.getpid())
+        with open(part, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(part, path)
+
+    def profile(self):
+        """ Per-stage breakdown of where the time went, longest stages first. """
+        with self._lock:
+            timers = sorted(self.timers.items(), key=lambda t: -t[1][1])
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+
+        lines = ['{:<28}{:>8}{:>12}{:>12}{:>12}'.format('stage', 'count', 'total s', 'mean s', 'max s')]
+        for name, (n, total, longest) in timers:
+            lines.append('{:<28}{:>8}{:>12.3f}{:>12.4f}{:>12.3f}'.format(name, n, total, total / n, longest))
+        for name, value in counters:
+            lines.append('{:<28}{:>12}'.format(name, _human(name, value)))
+        for name, (current, highest) in gauges:
+            lines.append('{:<28}{:>12} (max)'.format(name, _human(name, highest)))
+        return '\n'.join(lines)
+
+
+def _human(name, value):
+    if name.endswith('bytes'):
+        return '{:.1f} MB'.format(value / 1e6)
+    if isinstance(value, float) and not value.is_integer():
+        return '{:.3f}'.format(value)
+    return str(int(value))
+
+
+class JsonLinesExporter(object):
+    """ Hook writing every metrics event as one JSON line to path. """
+
+    def __init__(self, path):
+        self._lock = Lock()
+        self._file = open(path, 'a')
+
+    def __call__(self, record):
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+# the process-wide registry that the download and query code reports to
+metrics = Metrics()
+
+
+def export(path):
+    """ Send metrics to path: a Prometheus textfile (.prom), rewritten by the returned
+    function, or a JSON-lines event stream (any other name).
+
+    :return: function that writes out or closes the export, to be called at exit
+    """
+    if path.endswith('.prom'):
+        return lambda: metrics.write_prometheus(path)
+
+    exporter = JsonLinesExporter(path)
+    metrics.subscribe(exporter)
+
+    def close():
+        metrics.unsubscribe(exporter)
+        exporter.close()
+
+    return close
+
+
+if __name__ == '__main__':
+    pass
+
+# ========================= EOF ================================================================
@@ -0,0 +1,229 @@
+# =============================================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================================
+from __future__ import print_function, absolute_import
+
+import os
+import gzip
+import tarfile
+import subprocess
+from contextlib import contextmanager
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+# archive extension for each codec; 'pigz' and 'zst' compress on several threads
+CODECS = {'gz': 'tar.gz',
+          'none': 'tar',
+          'pigz': 'tar.gz',
+          'zst': 'tar.zst'}
+
+
+class CodecUnavailable(Exception):
+    pass
+
+
+def archive_file(base, codec='gz'):
+    """ Archive path for base (a path without extension) under codec. """
+    if codec not in CODECS:
+        raise ValueError('Unknown codec {}, choose from {}'.format(codec, sorted(CODECS)))
+    return '{}.{}'.format(base, CODECS[codec])
+
+
+def check_codec(codec):
+    """ Raise CodecUnavailable if codec can't run on this machine. """
+    archive_file('', codec)
+    if codec == 'pigz' and not which('pigz'):
+        raise CodecUnavailable('pigz is not on the PATH')
+    if codec == 'zst' and not which('zstd'):
+        try:
+            import zstandard
+        except ImportError:
+            raise CodecUnavailable('zst needs the zstandard package or zstd on the PATH')
+
+
+class SceneArchive(object):
+    """ Tar archive of one scene that bands are appended to as they finish downloading.
+
+    Each band file is deleted as soon as it is in the archive, so a scene never needs its
+    bands and its archive on disk at once. The archive is written to a .part file that
+    close() finishes and renames into place. abort() leaves the .part as it is, and the
+    next SceneArchive of the scene appends to it (see archived()), so a rerun only fetches
+    the bands that are in neither the .part nor the staging directory. Compressed archives
+    are resumed by starting a new gzip member or zstd frame, which both decompress as one
+    stream.
+    """
+
+    def __init__(self, base, arcdir, codec='gz'):
+        check_codec(codec)
+        self.path = archive_file(base, codec)
+        self.part = '{}.part'.format(self.path)
+        self.arcdir = arcdir
+        self.codec = codec
+        self._file = None
+        self._stream = None
+        self._proc = None
+        self._tar = None
+        # band names in the .part, and the tar offset to append at; read on first use
+        self._archived = None
+        self._offset = 0
+        # set while a band is half written, when the .part can't be resumed
+        self._broken = False
+
+    def archived(self):
+        """ Names of the bands already in a .part left by an earlier abort().
+
+        A .part that can't be read to the end, e.g. from a killed run, is deleted.
+        """
+        if self._archived is None:
+            self._archived = set()
+            if os.path.isfile(self.part):
+                try:
+                    self._archived, self._offset = self._scan_part()
+                except Exception as e:
+                    print('Discarding {}: {}'.format(self.part, e))
+                    os.remove(self.part)
+        return set(self._archived)
+
+    def add(self, band_path):
+        if self._tar is None:
+            self._open()
+        self._broken = True
+        self._tar.add(band_path, arcname=os.path.join(self.arcdir, os.path.basename(band_path)))
+        self._broken = False
+        self._archived.add(os.path.basename(band_path))
+        os.remove(band_path)
+
+    def close(self):
+        if self._tar is None:
+            self._open()
+        try:
+            # the end-of-archive blocks are only written here
+            self._tar.close()
+            self._close_streams()
+        except Exception:
+            self._broken = True
+            raise
+        os.replace(self.part, self.path)
+
+    def abort(self):
+        if self._tar is not None:
+            try:
+                self._close_streams()
+            except IOError:
+                self._broken = True
+        # keep a .part holding whole bands, it is resumed by the next run
+        if os.path.isfile(self.part) and (self._broken or self._archived == set()):
+            os.remove(self.part)
+
+    def _open(self):
+        offset = self._offset if self.archived() else 0
+        if self.codec == 'none':
+            self._file = open(self.part, 'r+b' if offset else 'wb')
+            self._file.seek(offset)
+            self._file.truncate()
+            self._stream = self._file
+        else:
+            self._file = open(self.part, 'ab' if offset else 'wb')
+            if self.codec == 'gz':
+                self._stream = gzip.GzipFile(fileobj=self._file, mode='wb')
+            elif self.codec == 'pigz':
+                self._pipe(['pigz', '-c'])
+            elif which('zstd'):
+                self._pipe(['zstd', '-q', '-T0', '-c'])
+            else:
+                import zstandard
+
+                self._stream = zstandard.ZstdCompressor(threads=-1).stream_writer(self._file)
+        self._tar = tarfile.TarFile(fileobj=_TarOutput(self._stream, offset), mode='w')
+
+    def _pipe(self, command):
+        self._proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=self._file)
+        self._stream = self._proc.stdin
+
+    def _close_streams(self):
+        self._tar = None
+        if self._proc is not None:
+            self._stream.close()
+            if self._proc.wait() != 0:
+                raise IOError('{} failed on {}'.format(self.codec, self.part))
+            self._proc = None
+        elif self._stream is not self._file:
+            self._stream.close()
+        if not self._file.closed:
+            self._file.close()
+
+    def _scan_part(self):
+        """ ({band names}, tar offset after the last band) of the .part; raises if any band is cut short. """
+        names, offset = set(), 0
+        with self._reader() as stream:
+            tar = tarfile.open(fileobj=stream, mode='r|')
+            for member in tar:
+                data = tar.extractfile(member)
+                if data is None or len(data.read()) != member.size:
+                    raise tarfile.ReadError('{} is cut short'.format(member.name))
+                names.add(os.path.basename(member.name))
+                offset = member.offset_data + -(-member.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        return names, offset
+
+    @contextmanager
+    def _reader(self):
+        """ The .part decompressed, as a file object. """
+        if self.codec == 'none':
+            with open(self.part, 'rb') as f:
+                yield f
+        elif self.codec in ('gz', 'pigz'):
+            with gzip.open(self.part, 'rb') as f:
+                yield f
+        elif which('zstd'):
+            proc = subprocess.Popen(['zstd', '-q', '-d', '-c', self.part], stdout=subprocess.PIPE)
+            try:
+                yield proc.stdout
+                # whatever the tar reader left unread still has to be checked by zstd
+                proc.stdout.read()
+            finally:
+                proc.stdout.close()
+                code = proc.wait()
+            if code != 0:
+                raise IOError('zstd could not read {}'.format(self.part))
+        else:
+            import zstandard
+
+            with open(self.part, 'rb') as f:
+                yield zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+
+
+class _TarOutput(object):
+    """ Writes through to a (compressing) stream, counting bytes so TarFile can carry on at
+    the offset where an aborted archive stopped. """
+
+    def __init__(self, stream, offset=0):
+        self.stream = stream
+        self.offset = offset
+
+    def write(self, data):
+        self.stream.write(data)
+        self.offset += len(data)
+
+    def tell(self):
+        return self.offset
+
+
+if __name__ == '__main__':
+    pass
+
+# ========================= EOF ================================================================
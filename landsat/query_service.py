@@ -0,0 +1,294 @@
+# =============================================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================================
+from __future__ import print_function, absolute_import
+
+import os
+import hmac
+import json
+import socket
+import binascii
+from threading import Lock
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.request import Request, ProxyHandler, build_opener
+    from urllib.error import HTTPError, URLError
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from urllib2 import Request, ProxyHandler, build_opener, HTTPError, URLError
+
+    ThreadingHTTPServer = None
+
+DEFAULT_HOST = '127.0.0.1'
+SERVICE_ENV = 'LANDSAT578_SERVICE'
+SERVICE_FILE = 'query_service.json'
+TOKEN_HEADER = 'X-Landsat578-Token'
+CLIENT_TIMEOUT = 30.
+
+# GoogleDownload arguments a query may carry
+QUERY_ARGS = ['start', 'end', 'satellite', 'latitude', 'longitude', 'path', 'row', 'max_cloud_percent']
+# and GoogleDownload.select_scenes options
+SELECT_ARGS = ['bins', 'per_bin', 'rank', 'list_type']
+
+
+class ServiceError(Exception):
+    pass
+
+
+class CatalogMissing(Exception):
+    pass
+
+
+def service_file():
+    """ Where a running service leaves its address and token: $LANDSAT578_SERVICE if set,
+    else query_service.json in the user's cache directory. """
+    path = os.environ.get(SERVICE_ENV)
+    if path:
+        return path
+    cache = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache, 'landsat578', SERVICE_FILE)
+
+
+def read_service_file(path=None):
+    """ (host, port, token) of the running service, or None if it has left no service file. """
+    try:
+        with open(path or service_file()) as f:
+            info = json.load(f)
+        return info['host'], int(info['port']), info['token']
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def write_service_file(address, token, path=None):
+    """ Leave the service's address and token where clients look for them, readable only by
+    the user, so only their own processes can query it. """
+    path = path or service_file()
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    part = '{}.{}'.format(path, os.getpid())
+    fd = os.open(part, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'host': address[0], 'port': address[1], 'token': token, 'pid': os.getpid()}, f)
+    os.replace(part, path)
+    return path
+
+
+class SceneService(object):
+    """ Answers scene queries from catalogs and WRS indexes held in memory.
+
+    Each satellite's catalog is read into memory on its first query and reloaded when
+    the catalog on disk is rebuilt or refreshed; the WRS indexes are loaded once, and one
+    GoogleDownload per satellite is copied for each query (see GoogleDownload.for_query).
+    The service never downloads a catalog or the WRS shapefiles itself, a query needing a
+    missing one fails with CatalogMissing.
+    """
+
+    def __init__(self, scenes_dir=None):
+        from landsat import google_download
+
+        self.scenes_dir = scenes_dir or google_download.SCENES
+        self._lock = Lock()
+        self._generation = None
+        # sat_name: GoogleDownload built by the satellite's first query
+        self._queries = {}
+
+    def candidate_scenes(self, query):
+        g = self._download_object(query)
+        return {'scene_ids': g.candidate_scenes(return_list=True, list_type=query.get('list_type', 'low_cloud'))}
+
+    def select_scenes(self, query):
+        g = self._download_object(query)
+        options = dict((k, query[k]) for k in SELECT_ARGS if query.get(k) is not None)
+        g.select_scenes(int(query['n']) if query.get('n') else None, **options)
+        return {'scene_ids': g.selected_scenes['SCENE_ID'].values.tolist()}
+
+    def _download_object(self, query):
+        """ A lazy GoogleDownload for the query, so its catalog is only scanned once. """
+        from landsat.google_download import GoogleDownload
+        from landsat.scene_query import load_resident
+
+        kwargs = dict((k, query[k]) for k in QUERY_ARGS if query.get(k) is not None)
+        kwargs['satellite'] = int(kwargs['satellite'])
+        sat_name = 'LANDSAT_{}'.format(kwargs['satellite'])
+
+        with self._lock:
+            self._check_catalog(sat_name, point=kwargs.get('path') is None)
+            self._check_generation()
+            load_resident(self.scenes_dir, sat_name)
+            template = self._queries.get(sat_name)
+
+        if template is None:
+            template = GoogleDownload(scenes_dir=self.scenes_dir, lazy=True, **kwargs)
+            with self._lock:
+                template = self._queries.setdefault(sat_name, template)
+        del kwargs['satellite']
+        return template.for_query(**kwargs)
+
+    def _check_catalog(self, sat_name, point=False):
+        from landsat.google_download import WRS_DIR
+        from landsat.update_landsat_metadata import SatMetaData
+
+        # refreshing downloads gigabytes and changes the working directory of the whole
+        # process, so it is left to the command line rather than done inside a request
+        meta = SatMetaData(sat='landsat', scenes_dir=self.scenes_dir)
+        if not os.path.isdir(os.path.join(self.scenes_dir, sat_name)) or not meta.catalog_is_current():
+            raise CatalogMissing('The {} scene list is missing or out of date, '
+                                 'run landsat --update-scenes'.format(sat_name))
+        if point and not os.path.isdir(WRS_DIR):
+            raise CatalogMissing('The WRS shapefiles are missing, run landsat --update-scenes')
+
+    def _check_generation(self):
+        from landsat.scene_query import drop_resident
+        from landsat.update_landsat_metadata import SatMetaData
+
+        state = SatMetaData(sat='landsat', scenes_dir=self.scenes_dir).index_state
+        generation = os.path.getmtime(state) if os.path.isfile(state) else None
+        if generation != self._generation:
+            drop_resident()
+            self._generation = generation
+
+
+class _Handler(BaseHTTPRequestHandler):
+    service = None
+    token = None
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        if self.path == '/ping':
+            self._reply(200, {'status': 'ok'})
+        else:
+            self._reply(404, {'error': 'unknown path {}'.format(self.path)})
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        routes = {'/candidate_scenes': self.service.candidate_scenes,
+                  '/select_scenes': self.service.select_scenes}
+        if self.path not in routes:
+            self._reply(404, {'error': 'unknown path {}'.format(self.path)})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            query = json.loads(self.rfile.read(length).decode('utf-8'))
+            self._reply(200, routes[self.path](query))
+        except CatalogMissing as e:
+            self._reply(409, {'error': str(e)})
+        except Exception as e:
+            self._reply(400, {'error': '{}: {}'.format(type(e).__name__, e)})
+
+    def _authorized(self):
+        if self.token is None or hmac.compare_digest(self.headers.get(TOKEN_HEADER, ''), self.token):
+            return True
+        self._reply(401, {'error': 'wrong or missing token'})
+        return False
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+def make_server(address, service=None, token=None):
+    """ HTTP server answering queries with service, a SceneService by default, from clients
+    sending token in the X-Landsat578-Token header (any client if token is None). """
+    if ThreadingHTTPServer is None:
+        raise NotImplementedError('landsat serve needs python 3.7 or later')
+
+    handler = type('SceneServiceHandler', (_Handler,), {'service': service or SceneService(), 'token': token})
+    return ThreadingHTTPServer(address, handler)
+
+
+def serve(host=None, port=None):
+    """ Run the query service on localhost HTTP until interrupted.
+
+    The port is any free one unless given; it is written with a fresh token to the
+    service file (see service_file), which clients need to read to query the service.
+    """
+    token = binascii.hexlify(os.urandom(16)).decode('ascii')
+    server = make_server((host or DEFAULT_HOST, port or 0), token=token)
+    address = server.server_address[:2]
+    path = write_service_file(address, token)
+    print('Serving Landsat scene queries on http://{}:{}, see {}'.format(address[0], address[1], path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        # unless another service has taken over the file since
+        if read_service_file(path) == (address[0], address[1], token):
+            os.remove(path)
+
+
+def query_service(endpoint, query, service=None, timeout=CLIENT_TIMEOUT):
+    """ Send a query to a running service.
+
+    :param service: (host, port, token), by default read from the service file
+    :return: the service's reply, or None if no service is running
+    """
+    service = service or read_service_file()
+    if service is None:
+        return None
+    host, port, token = service
+    body = json.dumps(dict((k, v) for k, v in query.items() if v is not None)).encode('utf-8')
+    request = Request('http://{}:{}/{}'.format(host, port, endpoint), data=body,
+                      headers={'Content-Type': 'application/json', TOKEN_HEADER: token})
+    try:
+        # the service is local, never route it through an http_proxy from the environment
+        response = build_opener(ProxyHandler({})).open(request, timeout=timeout)
+    except HTTPError as e:
+        try:
+            message = json.loads(e.read().decode('utf-8')).get('error')
+        except ValueError:
+            message = 'HTTP {}'.format(e.code)
+        raise ServiceError(message)
+    except (URLError, socket.error):
+        return None
+
+    try:
+        return json.loads(response.read().decode('utf-8'))
+    except ValueError:
+        raise ServiceError('{} replied with something other than JSON'.format(endpoint))
+
+
+def service_candidate_scenes(cfg):
+    """ Scene ID list for a CLI configuration from a running service, or None if there is
+    none or it can't answer, so the caller queries locally. """
+    # the service answers path/row and point queries
+    if cfg.get('aoi') is not None:
+        return None
+    try:
+        reply = query_service('candidate_scenes', dict((k, cfg.get(k)) for k in QUERY_ARGS))
+    except ServiceError as e:
+        print('The query service failed ({}), querying locally'.format(e))
+        return None
+    if reply is None:
+        return None
+    return reply.get('scene_ids')
+
+
+if __name__ == '__main__':
+    pass
+
+# ========================= EOF ================================================================
@@ -0,0 +1,240 @@
+# =============================================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================================
+from __future__ import print_function, absolute_import
+
+import os
+import time
+import shutil
+from threading import Thread, Semaphore, Condition
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from landsat.image_fetcher import FetchResult
+from landsat.metrics import metrics
+
+_DONE = object()
+
+
+class SceneTask(object):
+    """ One scene moving through the pipeline.
+
+    :param scene_id: scene identifier, used in messages
+    :param out_dir: staging directory the bands are downloaded to
+    :param bands: list of (url, destination path) for every band of the scene
+    :param archive: packaging.SceneArchive to append bands to, or None to leave them in out_dir
+    :param done: set of destination paths known to be complete already, or None to check
+        for each band's file on disk
+    """
+    __slots__ = ['scene_id', 'out_dir', 'bands', 'archive', 'done', 'remaining', 'complete', 'started']
+
+    def __init__(self, scene_id, out_dir, bands, archive=None, done=None):
+        self.scene_id = scene_id
+        self.out_dir = out_dir
+        self.bands = bands
+        self.archive = archive
+        self.done = done
+        self.remaining = len(bands)
+        self.complete = True
+        self.started = None
+
+
+class ScenePipeline(object):
+    """ Download, verify and package stages connected by bounded queues.
+
+    Band downloads run on a pool of workers, a verify thread checks each finished band and a
+    package thread appends it to its scene's archive, so the network and the compressor are
+    both kept busy over a long scene list. New scenes are only started while fewer than
+    max_scenes are in flight and the bands waiting to be packaged total less than
+    max_staging_bytes; one scene is always let through so a large scene can't stall the run.
+
+    finished, if given, is called with each SceneTask once it is packaged or given up on.
+    """
+
+    def __init__(self, fetch, workers=1, max_scenes=None, max_staging_bytes=None, finished=None):
+        self.fetch = fetch
+        self.finished = finished
+        self.workers = max(1, int(workers))
+        self.max_scenes = max_scenes or self.workers + 1
+        self.max_staging_bytes = max_staging_bytes
+
+        self._verify_queue = Queue(maxsize=2 * self.workers)
+        self._package_queue = Queue(maxsize=2 * self.workers)
+        self._slots = Semaphore(self.max_scenes)
+        self._budget = Condition()
+        self._staged_bytes = 0
+        self._in_flight = 0
+
+        self.incomplete = []
+        # image_fetcher.FetchResult of every band that failed, whether fetch returned or raised
+        self.failed = []
+
+    def run(self, tasks):
+        """ Push tasks (an iterable of SceneTask, consumed lazily) through the pipeline.
+
+        :return: list of scene ids that could not be completed
+        """
+        stages = [Thread(target=self._verify_stage), Thread(target=self._package_stage)]
+        for stage in stages:
+            stage.daemon = True
+            stage.start()
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for task in tasks:
+                    self._admit()
+                    task.started = time.time()
+                    if not task.bands:
+                        self._package_queue.put((task, None, False))
+                    for url, dst in task.bands:
+                        if dst in task.done if task.done is not None else os.path.isfile(dst):
+                            self._verify_queue.put((task, dst, None))
+                        else:
+                            future = executor.submit(self.fetch, url, dst)
+                            future.add_done_callback(lambda f, t=task, d=dst: self._verify_queue.put((t, d, f)))
+        finally:
+            # even if tasks raises, the scenes already started are finished before it propagates
+            self._verify_queue.put(_DONE)
+            for stage in stages:
+                stage.join()
+
+        return self.incomplete
+
+    def _admit(self):
+        self._slots.acquire()
+        with self._budget:
+            while (self.max_staging_bytes and self._in_flight and
+                   self._staged_bytes >= self.max_staging_bytes):
+                self._budget.wait()
+            self._in_flight += 1
+            metrics.gauge('scenes_in_flight', self._in_flight)
+
+    def _release(self):
+        with self._budget:
+            self._in_flight -= 1
+            self._budget.notify_all()
+        self._slots.release()
+
+    def _stage_bytes(self, n):
+        with self._budget:
+            self._staged_bytes += n
+            self._budget.notify_all()
+            metrics.gauge('staged_bytes', self._staged_bytes)
+
+    def _verify_stage(self):
+        while True:
+            item = self._verify_queue.get()
+            metrics.gauge('verify_queue_depth', self._verify_queue.qsize())
+            if item is _DONE:
+                self._package_queue.put(_DONE)
+                return
+
+            task, dst, future = item
+            start = time.time()
+            ok = True
+            if future is not None and future.exception() is not None:
+                print('Failed {}: {}'.format(os.path.basename(dst), future.exception()))
+                url = dict((d, u) for u, d in task.bands)[dst]
+                self.failed.append(FetchResult(url, dst, False, error=str(future.exception())))
+                ok = False
+            elif future is not None and getattr(future.result(), 'ok', True) is False:
+                self.failed.append(future.result())
+                ok = False
+            elif future is not None and not os.path.isfile(dst):
+                ok = False
+            elif task.archive is not None:
+                try:
+                    self._stage_bytes(os.path.getsize(dst))
+                except OSError as e:
+                    print('Missing {}: {}'.format(os.path.basename(dst), e))
+                    ok = False
+
+            metrics.observe('verify', time.time() - start, file=os.path.basename(dst), ok=ok)
+            self._package_queue.put((task, dst, ok))
+
+    def _package_stage(self):
+        while True:
+            item = self._package_queue.get()
+            metrics.gauge('package_queue_depth', self._package_queue.qsize())
+            if item is _DONE:
+                return
+
+            task, dst, ok = item
+            if dst is not None:
+                if not ok:
+                    task.complete = False
+                elif task.archive is not None:
+                    try:
+                        self._package_band(task, dst)
+                    except Exception as e:
+                        print('Could not package {}: {}'.format(os.path.basename(dst), e))
+                        task.complete = False
+                task.remaining -= 1
+
+            if task.remaining <= 0:
+                # whatever goes wrong, the scene's slot is given back, or the queues fill and
+                # the run never ends
+                try:
+                    self._finish(task)
+                    if self.finished is not None:
+                        self.finished(task)
+                except Exception as e:
+                    print('Could not finish {}: {}'.format(task.scene_id, e))
+                finally:
+                    self._release()
+
+    def _package_band(self, task, dst):
+        size = os.path.getsize(dst)
+        try:
+            if task.complete:
+                with metrics.timer('package', file=os.path.basename(dst), bytes=size):
+                    task.archive.add(dst)
+        finally:
+            self._stage_bytes(-size)
+
+    def _finish(self, task):
+        if task.complete and task.archive is not None:
+            try:
+                task.archive.close()
+                print('Packaged {}'.format(task.archive.path))
+            except Exception as e:
+                print('Could not package {}: {}'.format(task.scene_id, e))
+                task.complete = False
+            else:
+                try:
+                    shutil.rmtree(task.out_dir)
+                except OSError as e:
+                    print('Could not remove {}: {}'.format(task.out_dir, e))
+
+        metrics.observe('scene', time.time() - task.started, scene=task.scene_id, complete=task.complete)
+        metrics.count('scenes_complete' if task.complete else 'scenes_incomplete', scene=task.scene_id)
+        if not task.complete:
+            print('{} is incomplete, not packaging it'.format(task.scene_id))
+            self.incomplete.append(task.scene_id)
+            if task.archive is not None:
+                try:
+                    task.archive.abort()
+                except Exception as e:
+                    print('Could not remove {}: {}'.format(task.archive.part, e))
+
+
+if __name__ == '__main__':
+    pass
+
+# ========================= EOF ================================================================
@@ -0,0 +1,246 @@
+# =============================================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================================
+from __future__ import print_function, absolute_import
+
+import os
+from collections import namedtuple
+from threading import Lock
+
+from landsat.update_landsat_metadata import SatMetaData, DATE_TYPE
+
+SCENES = os.path.join(os.path.dirname(__file__), 'scenes')
+
+# the catalog columns needed to select scenes and build their urls
+SCENE_COLUMNS = ['SCENE_ID', 'PRODUCT_ID', 'DATE_ACQUIRED', 'SENSING_TIME',
+                 'WRS_PATH', 'WRS_ROW', 'CLOUD_COVER', 'BASE_URL']
+
+JOB_COLUMNS = ['satellite', 'path', 'row', 'start', 'end']
+
+# one catalog scene, as streamed by scene_records; GoogleDownload.download takes these
+SceneRecord = namedtuple('SceneRecord', SCENE_COLUMNS)
+
+# catalog rows converted to SceneRecords at a time
+RECORD_BATCH_ROWS = 16384
+
+# catalogs held in memory by a long-running process, see load_resident
+_resident = {}
+_resident_lock = Lock()
+
+
+def open_catalog(scenes_dir, sat_name):
+    import pyarrow.dataset as ds
+
+    path = os.path.join(scenes_dir, sat_name)
+    if path in _resident:
+        return _resident[path]
+    return ds.dataset(path, format='parquet', partitioning='hive')
+
+
+def load_resident(scenes_dir, sat_name):
+    """ Read a satellite's catalog into memory; open_catalog then returns it without touching disk. """
+    import pyarrow.dataset as ds
+
+    path = os.path.join(scenes_dir, sat_name)
+    with _resident_lock:
+        if path not in _resident and os.path.isdir(path):
+            print('Loading {} into memory'.format(path))
+            table = ds.dataset(path, format='parquet', partitioning='hive').to_table(columns=SCENE_COLUMNS)
+            _resident[path] = ds.dataset(table)
+    return _resident.get(path)
+
+
+def drop_resident():
+    with _resident_lock:
+        _resident.clear()
+
+
+def scene_filter(start, end, path=None, row=None, tiles=None):
+    """ Dataset filter for scenes acquired strictly between start and end.
+
+    path and row may each be an int or a list; lists are matched with 'in', so two lists
+    match every combination of their paths and rows. tiles, (path, row) pairs, matches
+    just those path/rows instead.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    date_type = pa.type_for_alias(DATE_TYPE)
+    where = ((ds.field('DATE_ACQUIRED') > pa.scalar(start, date_type)) &
+             (ds.field('DATE_ACQUIRED') < pa.scalar(end, date_type)))
+
+    if tiles is not None:
+        # one term per path, so each path partition is still pruned or read as a whole
+        rows = {}
+        for p, r in tiles:
+            rows.setdefault(int(p), set()).add(int(r))
+        terms = [(ds.field('WRS_PATH') == p) & ds.field('WRS_ROW').isin(sorted(rows[p])) for p in sorted(rows)]
+        if not terms:
+            return where & ds.scalar(False)
+        tile_filter = terms[0]
+        for term in terms[1:]:
+            tile_filter |= term
+        return where & tile_filter
+
+    for field, value in [('WRS_PATH', path), ('WRS_ROW', row)]:
+        if isinstance(value, list):
+            where &= ds.field(field).isin(value)
+        elif value is not None:
+            where &= ds.field(field) == value
+
+    return where
+
+
+def scene_records(dataset, where=None, batch_size=RECORD_BATCH_ROWS):
+    """ Stream the scenes of a catalog dataset matching where as SceneRecords.
+
+    The catalog is read a file at a time and a record batch at a time, so memory doesn't
+    grow with the number of scenes (a scan of the whole dataset would read ahead of a slow
+    consumer). Scenes come in catalog order: by path, then row and date within each file.
+    """
+    for fragment in dataset.get_fragments(filter=where):
+        for batch in fragment.to_batches(schema=dataset.schema, columns=SCENE_COLUMNS, filter=where,
+                                         batch_size=batch_size, use_threads=False):
+            # the same values as the frames of candidate_scenes, e.g. pandas.Timestamp dates
+            frame = batch.to_pandas()
+            for values in zip(*[frame[c] for c in SCENE_COLUMNS]):
+                yield SceneRecord._make(values)
+
+
+def batch_candidate_scenes(jobs, scenes_dir=None):
+    """ Answer many scene queries with one catalog scan per satellite.
+
+    :param jobs: pandas.DataFrame, or list of dicts, with columns satellite, path, row,
+        start and end (dates as 'YYYY-MM-DD' or datetimes), and optionally max_cloud_percent
+        (default 100) and job (default the job's position in the table)
+    :param scenes_dir: catalog directory, defaults to the package's scenes directory
+    :return: pandas.DataFrame of SCENE_COLUMNS plus JOB and SATELLITE, one record per job and
+        matching scene, sorted by job and date; like GoogleDownload's low-cloud list, only
+        scenes under the job's cloud threshold and with a PRODUCT_ID are returned
+    """
+    import pandas as pd
+    import pyarrow.dataset as ds
+
+    scenes_dir = scenes_dir or SCENES
+
+    jobs = pd.DataFrame(jobs).reset_index(drop=True)
+    missing = [c for c in JOB_COLUMNS if c not in jobs.columns]
+    if missing:
+        raise KeyError('Scene query jobs are missing columns {}'.format(missing))
+    if 'job' not in jobs.columns:
+        jobs['job'] = jobs.index
+    if 'max_cloud_percent' not in jobs.columns:
+        jobs['max_cloud_percent'] = 100.
+    # jobs given as dicts leave it empty where only some set it
+    jobs['max_cloud_percent'] = jobs['max_cloud_percent'].fillna(100.).astype(float)
+    jobs['start'] = pd.to_datetime(jobs['start'])
+    jobs['end'] = pd.to_datetime(jobs['end'])
+    for c in ['satellite', 'path', 'row']:
+        jobs[c] = jobs[c].astype(int)
+
+    meta = SatMetaData(sat='landsat', scenes_dir=scenes_dir)
+
+    frames = []
+    for sat_num, group in jobs.groupby('satellite'):
+        sat_name = 'LANDSAT_{}'.format(sat_num)
+        if not os.path.isdir(os.path.join(scenes_dir, sat_name)) or not meta.catalog_is_current():
+            meta.update_metadata_lists()
+
+        # one scan covering every job of this satellite, narrowed to each job below
+        where = scene_filter(group['start'].min().to_pydatetime(), group['end'].max().to_pydatetime(),
+                             tiles=set(zip(group['path'].tolist(), group['row'].tolist())))
+        where &= ds.field('PRODUCT_ID').is_valid()
+        scenes = open_catalog(scenes_dir, sat_name).to_table(columns=SCENE_COLUMNS, filter=where).to_pandas()
+
+        hits = group.merge(scenes, left_on=['path', 'row'], right_on=['WRS_PATH', 'WRS_ROW'])
+        hits = hits[(hits['DATE_ACQUIRED'] > hits['start']) & (hits['DATE_ACQUIRED'] < hits['end']) &
+                    (hits['CLOUD_COVER'] < hits['max_cloud_percent'])]
+        hits = hits.rename(columns={'job': 'JOB', 'satellite': 'SATELLITE'})
+        frames.append(hits[['JOB', 'SATELLITE'] + SCENE_COLUMNS])
+
+    if not frames:
+        return pd.DataFrame(columns=['JOB', 'SATELLITE'] + SCENE_COLUMNS)
+
+    result = pd.concat(frames, ignore_index=True)
+    return result.sort_values(['JOB', 'DATE_ACQUIRED'], kind='stable').reset_index(drop=True)
+
+
+def select_per_bin(scenes, n=None, bins='count', per_bin=1, rank='cloud', group=('WRS_PATH', 'WRS_ROW'),
+                   start=None):
+    """ Pick the best per_bin scenes of each time bin of each group, e.g. for compositing.
+
+    :param scenes: pandas.DataFrame with SENSING_TIME, DATE_ACQUIRED, CLOUD_COVER and the group columns,
+        e.g. GoogleDownload.scenes_all or the result of batch_candidate_scenes
+    :param n: with bins='count', the number of bins; each group's scenes, in time order, are
+        split into n runs of (nearly) equal length
+    :param bins: 'count', 'month' for calendar months, or an interval such as '16D' or a
+        pandas.Timedelta for fixed-width bins counted from start
+    :param per_bin: scenes kept from each bin
+    :param rank: 'cloud' (lowest cloud cover first) or 'centre' (closest to the middle of the
+        bin first), or a list of both to break ties of the first with the second; remaining
+        ties go to the earliest scene. Unknown (negative) cloud cover ranks last.
+    :param group: columns whose combinations are binned separately, e.g. ['JOB'] for a batch
+    :param start: first day of the first interval bin, defaults to the earliest acquisition
+    :return: the selected rows of scenes, sorted by group and sensing time
+    """
+    import numpy as np
+    import pandas as pd
+
+    group = list(group)
+    rules = [rank] if isinstance(rank, str) else list(rank)
+    unknown = [r for r in rules if r not in ('cloud', 'centre', 'center')]
+    if unknown:
+        raise ValueError('Unknown scene ranking {}, use cloud or centre'.format(unknown))
+
+    df = scenes.sort_values(group + ['SENSING_TIME'], kind='stable')
+    dates = pd.to_datetime(df['DATE_ACQUIRED'])
+
+    if bins == 'count':
+        if not n:
+            raise ValueError('Count bins need the number of bins n')
+        position = df.groupby(group, sort=False).cumcount().values
+        size = df.groupby(group, sort=False)['SENSING_TIME'].transform('size').values
+        # the same runs as cutting the time-ordered list at multiples of size / n
+        key = ((position + 1) * int(n) - 1) // size
+        by_bin = dates.groupby([df[g] for g in group] + [key])
+        low, high = by_bin.transform('min'), by_bin.transform('max')
+    elif bins == 'month':
+        month = dates.dt.to_period('M')
+        key = month.astype('int64').values
+        low, high = month.dt.start_time, month.dt.end_time.dt.normalize()
+    else:
+        width = pd.Timedelta(bins)
+        origin = pd.Timestamp(start) if start is not None else dates.min()
+        key = ((dates - origin) // width).values
+        low = origin + width * key
+        high = low + width
+
+    ranked = pd.DataFrame({'bin': key, 'order': np.arange(len(df))}, index=df.index)
+    for g in group:
+        ranked[g] = df[g].values
+    cloud = df['CLOUD_COVER'].astype(float)
+    ranked['cloud'] = cloud.where(cloud >= 0, np.inf).values
+    ranked['centre'] = (dates - (low + (high - low) / 2)).abs().values
+    ranked['center'] = ranked['centre']
+
+    ranked = ranked.sort_values(group + ['bin'] + rules + ['order'], kind='stable')
+    best = ranked.groupby(group + ['bin'], sort=False).head(int(per_bin))
+    return df.iloc[np.sort(best['order'].values)]
+
+
+if __name__ == '__main__':
+    pass
+
+# ========================= EOF ================================================================
@@ -0,0 +1,372 @@
+# =============================================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================================
+from __future__ import print_function, absolute_import
+
+import os
+import math
+import struct
+
+from landsat import bandwidth
+from landsat.metrics import metrics
+from landsat.image_fetcher import RetryableError, RETRY_STATUS, TIMEOUT, retry_after
+
+HEADER_BYTES = 64 * 1024
+# neighbouring blocks closer than this are fetched in one request
+COALESCE_GAP = 256 * 1024
+MAX_SPAN = 32 * 1024 * 1024
+EDGE_TOLERANCE = 1e-6
+
+# TIFF field type: (struct code, size in bytes); rationals are read as pairs
+FIELD_TYPES = {1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8), 6: ('b', 1),
+               7: ('B', 1), 8: ('h', 2), 9: ('i', 4), 10: ('ii', 8), 11: ('f', 4), 12: ('d', 8),
+               16: ('Q', 8), 17: ('q', 8), 18: ('Q', 8)}
+
+IMAGE_WIDTH, IMAGE_LENGTH, BITS_PER_SAMPLE, COMPRESSION = 256, 257, 258, 259
+STRIP_OFFSETS, SAMPLES_PER_PIXEL, ROWS_PER_STRIP, STRIP_BYTE_COUNTS = 273, 277, 278, 279
+PLANAR_CONFIG, TILE_WIDTH, TILE_LENGTH, TILE_OFFSETS, TILE_BYTE_COUNTS = 284, 322, 323, 324, 325
+MODEL_PIXEL_SCALE, MODEL_TIEPOINT, MODEL_TRANSFORMATION, GEO_KEY_DIRECTORY = 33550, 33922, 34264, 34735
+
+# tags that point at other places in the source file and can't be copied
+OFFSET_TAGS = [330, 34665, 34853, 40965]
+
+PROJECTED_CS_KEY, GEOGRAPHIC_TYPE_KEY = 3072, 2048
+
+
+class WindowError(Exception):
+    pass
+
+
+class RemoteTiff(object):
+    """ A GeoTIFF read over HTTP Range requests: the header and block tables first, then
+    only the tiles or strips that cover a window.
+
+    Blocks are copied as they are stored, so compressed files are clipped to whole tiles
+    (or, for striped files, whole full-width strips); uncompressed striped files are cut
+    to the exact pixel window.
+    """
+
+    def __init__(self, session, url):
+        self.session = session
+        self.url = url
+        self._cache = (0, self._get_range(0, HEADER_BYTES, allow_short=True))
+
+        order = self._cache[1][:2]
+        if order == b'II':
+            self.bo = '<'
+        elif order == b'MM':
+            self.bo = '>'
+        else:
+            raise WindowError('{} is not a TIFF'.format(url))
+
+        header = self._cache[1]
+        version = struct.unpack(self.bo + 'H', header[2:4])[0]
+        if version == 42:
+            self.big, ifd = False, struct.unpack(self.bo + 'I', header[4:8])[0]
+        elif version == 43:
+            self.big, ifd = True, struct.unpack(self.bo + 'Q', header[8:16])[0]
+        else:
+            raise WindowError('{} is not a TIFF'.format(url))
+
+        self.tags = self._read_ifd(ifd)
+        self.width = self.tags[IMAGE_WIDTH][1][0]
+        self.height = self.tags[IMAGE_LENGTH][1][0]
+        self.tiled = TILE_OFFSETS in self.tags
+        self.compression = self.tags.get(COMPRESSION, (3, [1]))[1][0]
+        bits = self.tags[BITS_PER_SAMPLE][1]
+        samples = self.tags.get(SAMPLES_PER_PIXEL, (3, [1]))[1][0]
+        if samples > 1 and self.tags.get(PLANAR_CONFIG, (3, [1]))[1][0] != 1:
+            raise WindowError('Band-interleaved TIFFs are not supported')
+        if sum(bits) % 8:
+            raise WindowError('Only whole-byte pixels are supported')
+        self.pixel_bytes = sum(bits) // 8
+
+    def pixel_window(self, bounds):
+        """ (col_off, row_off, width, height) of the pixels covering lon/lat bounds. """
+        west, south, east, north = self._project(bounds)
+        sx, sy, x0, y0 = self._geotransform()
+
+        # the tolerance keeps bounds on a pixel edge from picking up a row or column of rounding error
+        c0 = max(0, int(math.floor((west - x0) / sx + EDGE_TOLERANCE)))
+        c1 = min(self.width, int(math.ceil((east - x0) / sx - EDGE_TOLERANCE)))
+        r0 = max(0, int(math.floor((y0 - north) / sy + EDGE_TOLERANCE)))
+        r1 = min(self.height, int(math.ceil((y0 - south) / sy - EDGE_TOLERANCE)))
+        if c1 <= c0 or r1 <= r0:
+            raise WindowError('AOI does not overlap {}'.format(os.path.basename(self.url)))
+        return c0, r0, c1 - c0, r1 - r0
+
+    def extract(self, bounds, destination_path):
+        """ Write the part of the image covering lon/lat bounds to destination_path.
+
+        :return: number of bytes written
+        """
+        c0, r0, w, h = self.pixel_window(bounds)
+        if self.tiled:
+            layout, blocks, (c0, r0, w, h) = self._tile_window(c0, r0, w, h)
+        elif self.compression == 1:
+            layout, blocks, (c0, r0, w, h) = self._pixel_window_strips(c0, r0, w, h)
+        else:
+            layout, blocks, (c0, r0, w, h) = self._strip_window(r0, h)
+
+        tags = dict((k, v) for k, v in self.tags.items() if k not in OFFSET_TAGS)
+        for k in [STRIP_OFFSETS, STRIP_BYTE_COUNTS, ROWS_PER_STRIP, TILE_OFFSETS, TILE_BYTE_COUNTS]:
+            tags.pop(k, None)
+        tags.update(layout)
+        tags[IMAGE_WIDTH] = (4, [w])
+        tags[IMAGE_LENGTH] = (4, [h])
+        self._shift_georeference(tags, c0, r0)
+
+        part = destination_path + '.part'
+        size = self._write(part, tags, blocks)
+        os.replace(part, destination_path)
+        return size
+
+    def _tile_window(self, c0, r0, w, h):
+        tw, th = self.tags[TILE_WIDTH][1][0], self.tags[TILE_LENGTH][1][0]
+        across = -(-self.width // tw)
+        offsets, counts = self.tags[TILE_OFFSETS][1], self.tags[TILE_BYTE_COUNTS][1]
+
+        tc0, tc1 = c0 // tw, (c0 + w - 1) // tw
+        tr0, tr1 = r0 // th, (r0 + h - 1) // th
+        index = [tr * across + tc for tr in range(tr0, tr1 + 1) for tc in range(tc0, tc1 + 1)]
+        blocks = self._get_blocks([(offsets[i], counts[i]) for i in index])
+
+        layout = {TILE_WIDTH: (4, [tw]), TILE_LENGTH: (4, [th]),
+                  TILE_OFFSETS: (4, None), TILE_BYTE_COUNTS: (4, [len(b) for b in blocks])}
+        window = (tc0 * tw, tr0 * th, min((tc1 + 1) * tw, self.width) - tc0 * tw,
+                  min((tr1 + 1) * th, self.height) - tr0 * th)
+        return layout, blocks, window
+
+    def _strip_window(self, r0, h):
+        rps = self.tags.get(ROWS_PER_STRIP, (4, [self.height]))[1][0]
+        offsets, counts = self.tags[STRIP_OFFSETS][1], self.tags[STRIP_BYTE_COUNTS][1]
+
+        s0, s1 = r0 // rps, (r0 + h - 1) // rps
+        blocks = self._get_blocks([(offsets[i], counts[i]) for i in range(s0, s1 + 1)])
+
+        layout = {ROWS_PER_STRIP: (4, [rps]), STRIP_OFFSETS: (4, None),
+                  STRIP_BYTE_COUNTS: (4, [len(b) for b in blocks])}
+        return layout, blocks, (0, s0 * rps, self.width, min((s1 + 1) * rps, self.height) - s0 * rps)
+
+    def _pixel_window_strips(self, c0, r0, w, h):
+        rps = self.tags.get(ROWS_PER_STRIP, (4, [self.height]))[1][0]
+        offsets = self.tags[STRIP_OFFSETS][1]
+        row_bytes = self.width * self.pixel_bytes
+
+        # the rows are located inside their strips, then only the window's columns are kept
+        s0, s1 = r0 // rps, (r0 + h - 1) // rps
+        strips = self._get_blocks([(offsets[i], min(rps, self.height - i * rps) * row_bytes)
+                                   for i in range(s0, s1 + 1)])
+        lo, hi = c0 * self.pixel_bytes, (c0 + w) * self.pixel_bytes
+        rows = []
+        for r in range(r0, r0 + h):
+            strip = strips[r // rps - s0]
+            start = (r % rps) * row_bytes
+            rows.append(strip[start + lo:start + hi])
+
+        out_rps = max(1, (64 * 1024) // (hi - lo))
+        blocks = [b''.join(rows[i:i + out_rps]) for i in range(0, h, out_rps)]
+        layout = {ROWS_PER_STRIP: (4, [out_rps]), STRIP_OFFSETS: (4, None),
+                  STRIP_BYTE_COUNTS: (4, [len(b) for b in blocks])}
+        return layout, blocks, (c0, r0, w, h)
+
+    def _geotransform(self):
+        """ (x pixel size, y pixel size, x, y) of the image's upper-left corner. """
+        if MODEL_TRANSFORMATION in self.tags:
+            m = self.tags[MODEL_TRANSFORMATION][1]
+            if m[1] or m[4]:
+                raise WindowError('Rotated rasters are not supported')
+            return m[0], -m[5], m[3], m[7]
+        if MODEL_TIEPOINT not in self.tags or MODEL_PIXEL_SCALE not in self.tags:
+            raise WindowError('{} is not georeferenced'.format(os.path.basename(self.url)))
+        i, j, _, x, y, _ = self.tags[MODEL_TIEPOINT][1][:6]
+        sx, sy = self.tags[MODEL_PIXEL_SCALE][1][:2]
+        return sx, sy, x - i * sx, y + j * sy
+
+    def _shift_georeference(self, tags, c0, r0):
+        sx, sy, x0, y0 = self._geotransform()
+        if MODEL_TRANSFORMATION in tags:
+            m = list(tags[MODEL_TRANSFORMATION][1])
+            m[3], m[7] = x0 + c0 * sx, y0 - r0 * sy
+            tags[MODEL_TRANSFORMATION] = (12, m)
+        else:
+            tie = list(tags[MODEL_TIEPOINT][1][:6])
+            tie[:2], tie[3:5] = [0., 0.], [x0 + c0 * sx, y0 - r0 * sy]
+            tags[MODEL_TIEPOINT] = (12, tie)
+
+    def _project(self, bounds):
+        """ lon/lat bounds as bounds in the raster's coordinate system. """
+        keys = self._geokeys()
+        epsg = keys.get(PROJECTED_CS_KEY) or keys.get(GEOGRAPHIC_TYPE_KEY)
+        if not epsg or epsg == 32767:
+            raise WindowError('{} has no EPSG code'.format(os.path.basename(self.url)))
+        if epsg == 4326:
+            return bounds
+
+        from pyproj import Transformer
+
+        west, south, east, north = bounds
+        steps = [k / 20. for k in range(21)]
+        lons = [west + (east - west) * s for s in steps] * 2 + [west] * 21 + [east] * 21
+        lats = [south] * 21 + [north] * 21 + [south + (north - south) * s for s in steps] * 2
+        xs, ys = Transformer.from_crs(4326, epsg, always_xy=True).transform(lons, lats)
+        return min(xs), min(ys), max(xs), max(ys)
+
+    def _geokeys(self):
+        directory = self.tags.get(GEO_KEY_DIRECTORY, (3, []))[1]
+        keys = {}
+        for k in range(4, len(directory) - 3, 4):
+            key, location, count, value = directory[k:k + 4]
+            if location == 0:
+                keys[key] = value
+        return keys
+
+    def _read_ifd(self, offset):
+        if self.big:
+            count_format, count_size, entry_size, inline = 'Q', 8, 20, 8
+        else:
+            count_format, count_size, entry_size, inline = 'H', 2, 12, 4
+
+        n = struct.unpack(self.bo + count_format, self._read(offset, count_size))[0]
+        raw = self._read(offset + count_size, n * entry_size)
+        tags = {}
+        for k in range(n):
+            entry = raw[k * entry_size:(k + 1) * entry_size]
+            tag, field_type = struct.unpack(self.bo + 'HH', entry[:4])
+            if field_type not in FIELD_TYPES:
+                continue
+            count = struct.unpack(self.bo + ('Q' if self.big else 'I'), entry[4:4 + inline])[0]
+            code, size = FIELD_TYPES[field_type]
+            value = entry[4 + inline:]
+            if count * size > inline:
+                position = struct.unpack(self.bo + ('Q' if self.big else 'I'), value)[0]
+                value = self._read(position, count * size)
+            tags[tag] = (field_type, self._decode(field_type, count, value[:count * size]))
+        return tags
+
+    def _decode(self, field_type, count, data):
+        code, size = FIELD_TYPES[field_type]
+        if field_type == 2:
+            return data
+        return list(struct.unpack('{}{}{}'.format(self.bo, count, code) if len(code) == 1 else
+                                  '{}{}'.format(self.bo, code * count), data))
+
+    def _encode(self, field_type, values):
+        code, size = FIELD_TYPES[field_type]
+        if field_type == 2:
+            return bytes(values)
+        if len(code) == 1:
+            return struct.pack('{}{}{}'.format(self.bo, len(values), code), *values)
+        return struct.pack('{}{}'.format(self.bo, code * (len(values) // 2)), *values)
+
+    def _write(self, path, tags, blocks):
+        """ Write a classic TIFF of tags and image blocks; offsets tags given as None are filled in. """
+        offsets_tag = TILE_OFFSETS if TILE_OFFSETS in tags else STRIP_OFFSETS
+        tags[offsets_tag] = (4, [0] * len(blocks))
+        # BigTIFF-only types have no place in a classic TIFF
+        for tag, (field_type, values) in list(tags.items()):
+            if field_type in (16, 17, 18):
+                tags[tag] = (4, values)
+
+        order = sorted(tags)
+        ifd_size = 2 + 12 * len(order) + 4
+        extra_start = 8 + ifd_size
+        extra_size = 0
+        for tag in order:
+            field_type, values = tags[tag]
+            size = len(self._encode(field_type, values))
+            if size > 4:
+                extra_size += size + size % 2
+
+        position = extra_start + extra_size
+        block_offsets = []
+        for block in blocks:
+            block_offsets.append(position)
+            position += len(block)
+        tags[offsets_tag] = (4, block_offsets)
+
+        head = [b'II' if self.bo == '<' else b'MM', struct.pack(self.bo + 'HI', 42, 8),
+                struct.pack(self.bo + 'H', len(order))]
+        extra = []
+        extra_position = extra_start
+        for tag in order:
+            field_type, values = tags[tag]
+            data = self._encode(field_type, values)
+            count = len(values) // 2 if field_type in (5, 10) else len(values)
+            if len(data) > 4:
+                head.append(struct.pack(self.bo + 'HHII', tag, field_type, count, extra_position))
+                extra.append(data + b'\0' * (len(data) % 2))
+                extra_position += len(extra[-1])
+            else:
+                head.append(struct.pack(self.bo + 'HHI', tag, field_type, count) + data.ljust(4, b'\0'))
+        head.append(struct.pack(self.bo + 'I', 0))
+
+        with open(path, 'wb') as f:
+            for part in head + extra + blocks:
+                f.write(part)
+        return position
+
+    def _get_blocks(self, ranges):
+        """ Contents of (offset, length) ranges, fetched in as few requests as is sensible. """
+        order = sorted(range(len(ranges)), key=lambda k: ranges[k][0])
+        spans = []
+        for k in order:
+            start, length = ranges[k]
+            if spans and start - spans[-1][1] <= COALESCE_GAP and start + length - spans[-1][0] <= MAX_SPAN:
+                spans[-1][1] = max(spans[-1][1], start + length)
+                spans[-1][2].append(k)
+            else:
+                spans.append([start, start + length, [k]])
+
+        blocks = [None] * len(ranges)
+        for start, end, members in spans:
+            data = self._read(start, end - start)
+            for k in members:
+                offset, length = ranges[k]
+                blocks[k] = data[offset - start:offset - start + length]
+        return blocks
+
+    def _read(self, offset, length):
+        start, data = self._cache
+        if start <= offset and offset + length <= start + len(data):
+            return data[offset - start:offset - start + length]
+        return self._get_range(offset, length)
+
+    def _get_range(self, offset, length, allow_short=False):
+        if not length:
+            return b''
+        response = self.session.get(self.url, headers={'Range': 'bytes={}-{}'.format(offset, offset + length - 1)},
+                                    timeout=TIMEOUT)
+        if response.status_code == 416 and allow_short:
+            return b''
+        if response.status_code in RETRY_STATUS:
+            response.close()
+            raise RetryableError('Code {} on {}'.format(response.status_code, self.url),
+                                 status=response.status_code, retry_after=retry_after(response))
+        if response.status_code != 206:
+            response.close()
+            raise WindowError('Code {} for a byte range of {}'.format(response.status_code, self.url))
+        data = response.content
+        bandwidth.limiter.consume(len(data))
+        metrics.count('range_bytes', len(data), file=os.path.basename(self.url))
+        if len(data) != length and not (allow_short and len(data) < length):
+            raise RetryableError('Short read from {}'.format(self.url))
+        return data
+
+
+if __name__ == '__main__':
+    pass
+
+# ========================= EOF ================================================================
@@ -15,28 +15,53 @@
 # =============================================================================================
 from __future__ import print_function, absolute_import
 
-import gzip
 import os
+import json
+import shutil
+from glob import glob
 from datetime import datetime
 from zipfile import ZipFile, BadZipFile
-from fastkml import kml
 
-from dask.dataframe import read_csv
-from numpy import unique
-from requests import get
+from landsat.metrics import metrics
 
 fmt = '%Y%m%d'
 date = datetime.strftime(datetime.now(), fmt)
 
+CATALOG_VERSION = '3'
+ROW_GROUP_SIZE = 2048
+CSV_BLOCK_SIZE = 1024 * 1024 * 16
+# pyarrow type aliases, kept as strings so importing this module doesn't import pyarrow
+DATE_TYPE = 'timestamp[ms]'
+CSV_COLUMN_TYPES = {'SCENE_ID': 'string', 'PRODUCT_ID': 'string', 'SPACECRAFT_ID': 'string',
+                    'DATE_ACQUIRED': DATE_TYPE, 'COLLECTION_NUMBER': 'string',
+                    'COLLECTION_CATEGORY': 'string', 'SENSING_TIME': 'string', 'BASE_URL': 'string',
+                    'WRS_PATH': 'int32', 'WRS_ROW': 'int32', 'CLOUD_COVER': 'float64'}
+STAGING_PARTITION_TYPES = [('SPACECRAFT_ID', 'string'), ('WRS_PATH', 'int32')]
+# the first pass spreads rows over a few thousand path partitions; keep its open files below
+# the usual 1024 descriptor limit (a partition whose file is closed early just gets another,
+# and they are merged when the partition is sorted)
+STAGING_OPEN_FILES = 512
+STAGING_ROWS_PER_GROUP = 64 * 1024
+
+STORAGE_URL = 'http://storage.googleapis.com'
+# replaces STORAGE_URL, e.g. with a local stand-in for the public bucket (tests/storage_stand_in.py)
+STORAGE_ENV = 'LANDSAT578_STORAGE'
+BUCKET = 'gcp-public-data-landsat'
+
+
+def storage_url():
+    """ Scheme and host (and optional path prefix) the public Landsat bucket is read from. """
+    return (os.environ.get(STORAGE_ENV) or STORAGE_URL).rstrip('/')
+
 
 class SatMetaData(object):
     """ ... """
 
-    def __init__(self, sat):
+    def __init__(self, sat, scenes_dir=None):
 
         if sat == 'landsat':
             self.sat = 'landsat'
-            self.metadata_url = 'http://storage.googleapis.com/gcp-public-data-landsat/index.csv.gz'
+            self.metadata_url = '{}/{}/index.csv.gz'.format(storage_url(), BUCKET)
             self.vector_url = ['https://d9-wret.s3.us-west-2.amazonaws.com/assets/palladium/production/'
                                's3fs-public/atoms/files/WRS1_descending_0.zip',
                                'https://d9-wret.s3.us-west-2.amazonaws.com/assets/palladium/production/'
@@ -46,14 +71,23 @@ class SatMetaData(object):
                                  os.path.join(self.project_ws, 'wrs', 'wrs2_descending.shp'))
             self.vector_zip = os.path.join(self.project_ws, 'wrs', 'wrs.zip')
             self.vector_dir = os.path.join(self.project_ws, 'wrs')
-            self.scenes = os.path.join(self.project_ws, 'scenes')
+            self.scenes = scenes_dir or os.path.join(self.project_ws, 'scenes')
             self.scenes_zip = os.path.join(self.scenes, 'l_index.csv.gz')
             self.latest = os.path.join(self.scenes, 'scenes_{}'.format(date))
+            self.catalog_version = os.path.join(self.scenes, 'catalog_version')
+            self.index_state = os.path.join(self.scenes, 'index_state.json')
 
         else:
             raise NotImplementedError('only works for "landsat"')
 
-    def update_metadata_lists(self):
+    @metrics.timed('update_metadata_lists')
+    def update_metadata_lists(self, incremental=False):
+        """ Refresh the scene catalog.
+
+        :param incremental: only append scenes newer than the local catalog, and skip the
+            refresh entirely if the remote index is unchanged; falls back to a full build
+            if there is no current local catalog to append to
+        """
         print('Please wait while Landsat578 updates {} metadata files...'.format(self.sat))
         if not os.path.isdir(self.scenes):
             os.mkdir(self.scenes)
@@ -62,72 +96,268 @@ class SatMetaData(object):
         for f in ls:
             if 'l_scenes_' in f and self.latest not in f:
                 os.remove(os.path.join(self.scenes, f))
-        self.download_latest_metadata()
-        try:
-            os.remove(self.latest)
-            os.remove(self.scenes_zip)
-        except FileNotFoundError:
-            pass
+
+        if incremental and not (self.catalog_is_current() and self._load_state().get('watermarks')):
+            print('No current {} catalog to update, rebuilding it'.format(self.sat))
+            incremental = False
+
+        self.download_latest_metadata(incremental=incremental)
+        for f in [self.latest, self.scenes_zip]:
+            if os.path.isfile(f):
+                os.remove(f)
         with open(self.latest, 'w') as empty:
             empty.write('')
         return None
 
-    def download_latest_metadata(self):
+    def download_latest_metadata(self, incremental=False):
+        from requests import get
+
+        if not os.path.isfile(self.latest) or not self.catalog_is_current():
+            state = self._load_state()
+            headers = {}
+            if incremental:
+                if state.get('etag'):
+                    headers['If-None-Match'] = state['etag']
+                if state.get('last_modified'):
+                    headers['If-Modified-Since'] = state['last_modified']
 
-        if not os.path.isfile(self.latest):
-            req = get(self.metadata_url, stream=True)
+            req = get(self.metadata_url, stream=True, headers=headers)
+            if req.status_code == 304:
+                print('{} metadata index is unchanged since {}'.format(self.sat, state.get('last_modified')))
+                return None
             if req.status_code != 200:
                 raise ValueError('Bad response {} from request.'.format(req.status_code))
 
-            with open(self.scenes_zip, 'wb') as f:
-                print('Downloading {}'.format(self.metadata_url))
-                for chunk in req.iter_content(chunk_size=1024):
-                    if chunk:
-                        f.write(chunk)
+            # the archive is decompressed and parsed as it arrives, so neither the .gz
+            # nor the decompressed CSV is ever written to disk
+            print('Downloading {}'.format(self.metadata_url))
+            req.raw.decode_content = True
+            compression = None if 'gzip' in req.headers.get('Content-Encoding', '') else 'gzip'
+            if incremental:
+                self.split_list(req.raw, watermarks=state['watermarks'], compression=compression)
+            else:
+                self.split_list(req.raw, compression=compression)
+
+            state = self._load_state()
+            state['etag'] = req.headers.get('ETag')
+            state['last_modified'] = req.headers.get('Last-Modified')
+            self._save_state(state)
 
-            self.split_list()
             self.get_wrs_shapefiles()
 
         else:
             print('you have the latest {} metadata'.format(self.sat))
 
-        if not os.path.isfile(self.latest):
-            with gzip.open(self.scenes_zip, 'rb') as infile:
-                print('unzipping {}'.format(self.scenes_zip))
-                with open(self.latest, 'wb') as outfile:
-                    for line in infile:
-                        outfile.write(line)
-
         return None
 
-    def split_list(self):
+    @metrics.timed('split_list')
+    def split_list(self, source=None, watermarks=None, compression='infer'):
+        """ Build the Parquet scene catalog from the index in a single streaming pass.
+
+        The CSV is read in bounded blocks into an unsorted dataset partitioned by spacecraft
+        and WRS path; each partition is then sorted by WRS row and acquisition date and
+        rewritten as scenes/<SPACECRAFT_ID>/WRS_PATH=<path>/part-0.parquet with small
+        row groups, so that path, row and date filters prune whole files and row groups.
+
+        :param source: path to a gzipped (or plain) index.csv, or a readable binary stream
+            such as an HTTP response body, defaults to the downloaded index
+        :param watermarks: {SPACECRAFT_ID: 'YYYY-MM-DD'}, if given the catalog is appended to
+            rather than rebuilt, see write_catalog
+        :param compression: 'gzip' or None, by default taken from a path's extension and
+            assumed to be 'gzip' for a stream
+        """
+
+        import pyarrow as pa
+        from pyarrow import csv
 
         print('Please wait while {} scene metadata is split'.format(self.sat))
-        csv = read_csv(self.latest, dtype={'PRODUCT_ID': object, 'COLLECTION_NUMBER': object,
-                                           'COLLECTION_CATEGORY': object}, blocksize=25e6,
-                       parse_dates=True)
-        csv = csv[csv.COLLECTION_NUMBER != 'PRE']
+        if source is None:
+            source = self.scenes_zip
+
+        if hasattr(source, 'read'):
+            if compression == 'infer':
+                compression = 'gzip'
+            stream = pa.PythonFile(source, mode='r')
+            if compression:
+                stream = pa.CompressedInputStream(stream, compression)
+        else:
+            if compression == 'infer':
+                compression = 'gzip' if source.endswith('.gz') else None
+            stream = pa.input_stream(source, compression=compression)
+
+        with stream:
+            column_types = dict((k, pa.type_for_alias(v)) for k, v in CSV_COLUMN_TYPES.items())
+            reader = csv.open_csv(stream, read_options=csv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+                                  convert_options=csv.ConvertOptions(column_types=column_types,
+                                                                     strings_can_be_null=True))
+            self.write_catalog(reader, watermarks=watermarks)
+
+        return None
+
+    def write_catalog(self, reader, watermarks=None):
+        """ Write a stream of index record batches to the partitioned catalog.
+
+        Without watermarks the catalog is rebuilt. With watermarks, only rows acquired on or
+        after their spacecraft's watermark date (and not already in the catalog) are kept,
+        and each path partition they touch gets them as one new file; every other partition
+        is left as it is. Scenes added to the index for dates before the watermark, e.g. by
+        reprocessing, are only picked up by a full rebuild.
+
+        A rebuild writes straight into scenes/build, and each path is sorted into its final
+        file and its unsorted files deleted before the next path is read. The old catalog is
+        kept until its spacecraft is swapped in, so disk use peaks at about twice the catalog.
+        """
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
+
+        staging = os.path.join(self.scenes, 'staging')
+        build = os.path.join(self.scenes, 'build')
+        for d in [staging, build]:
+            if os.path.isdir(d):
+                shutil.rmtree(d)
+
+        # an incremental run only stages its new rows, a rebuild goes straight to build
+        unsorted = staging if watermarks else build
+        batches = (self._select_rows(batch, watermarks) for batch in reader)
+        partitioning = ds.partitioning(pa.schema([(k, pa.type_for_alias(v)) for k, v in STAGING_PARTITION_TYPES]))
+        ds.write_dataset(pa.RecordBatchReader.from_batches(reader.schema, batches), unsorted,
+                         format='parquet', partitioning=partitioning, max_partitions=1024 * 16,
+                         max_open_files=STAGING_OPEN_FILES, max_rows_per_group=STAGING_ROWS_PER_GROUP,
+                         existing_data_behavior='overwrite_or_ignore')
 
-        sats = unique(csv.SPACECRAFT_ID).tolist()
+        state = self._load_state()
+        marks = dict(state.get('watermarks', {})) if watermarks else {}
+        stamp = datetime.strftime(datetime.now(), '%Y%m%d%H%M%S')
+
+        sats = sorted(os.listdir(unsorted)) if os.path.isdir(unsorted) else []
         for sat in sats:
             print(sat)
-            df = csv[csv.SPACECRAFT_ID == sat]
-            dst = os.path.join(self.scenes, sat)
-            if os.path.isfile(dst):
-                os.remove(dst)
-            if not os.path.isdir(dst):
-                os.mkdir(dst)
-            df.to_parquet('{}'.format(dst))
+            for path in sorted(os.listdir(os.path.join(unsorted, sat)), key=int):
+                part = os.path.join(unsorted, sat, path)
+                table = pq.read_table(part)
+                if watermarks:
+                    dst = os.path.join(self.scenes, sat, 'WRS_PATH={}'.format(path))
+                    table = self._unseen_rows(table, dst, watermarks.get(sat))
+                    if table.num_rows:
+                        self._write_partition(table, dst, 'part-{}.parquet'.format(stamp))
+                else:
+                    self._write_partition(table, os.path.join(build, sat, 'WRS_PATH={}'.format(path)))
+                marks[sat] = max([d for d in [marks.get(sat), self._last_date(table)] if d])
+                shutil.rmtree(part)
+
+            if not watermarks:
+                dst = os.path.join(self.scenes, sat)
+                if os.path.isfile(dst):
+                    os.remove(dst)
+                elif os.path.isdir(dst):
+                    shutil.rmtree(dst)
+                os.rename(os.path.join(build, sat), dst)
+
+        shutil.rmtree(staging, ignore_errors=True)
+        shutil.rmtree(build, ignore_errors=True)
+
+        state['watermarks'] = marks
+        self._save_state(state)
+
+        with open(self.catalog_version, 'w') as f:
+            f.write(CATALOG_VERSION)
 
         return None
 
+    def catalog_is_current(self):
+        try:
+            with open(self.catalog_version) as f:
+                return f.read().strip() == CATALOG_VERSION
+        except IOError:
+            return False
+
+    def _load_state(self):
+        try:
+            with open(self.index_state) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_state(self, state):
+        with open(self.index_state, 'w') as f:
+            json.dump(state, f, indent=1)
+
+    @staticmethod
+    def _select_rows(batch, watermarks=None):
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        keep = pc.fill_null(pc.not_equal(batch['COLLECTION_NUMBER'], 'PRE'), True)
+        if watermarks:
+            date_type = batch.schema.field('DATE_ACQUIRED').type
+            sats = batch['SPACECRAFT_ID']
+            recent = pc.invert(pc.is_in(sats, value_set=pa.array(list(watermarks.keys()), pa.string())))
+            for sat, mark in watermarks.items():
+                mark = pc.cast(pa.scalar(datetime.strptime(mark, '%Y-%m-%d').date()), date_type)
+                recent = pc.or_(recent, pc.and_(pc.equal(sats, sat),
+                                                pc.greater_equal(batch['DATE_ACQUIRED'], mark)))
+            keep = pc.and_(keep, pc.fill_null(recent, False))
+        return batch.filter(keep)
+
+    @staticmethod
+    def _unseen_rows(table, partition, mark):
+        """ Drop rows of table whose SCENE_ID is already in the partition on or after mark. """
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.dataset as ds
+
+        if mark is None or not os.path.isdir(partition):
+            return table
+        mark = pc.cast(pa.scalar(datetime.strptime(mark, '%Y-%m-%d').date()),
+                       table.schema.field('DATE_ACQUIRED').type)
+        seen = ds.dataset(partition, format='parquet').to_table(
+            columns=['SCENE_ID'], filter=ds.field('DATE_ACQUIRED') >= mark)
+        return table.filter(pc.invert(pc.is_in(table['SCENE_ID'], value_set=seen['SCENE_ID'])))
+
+    @staticmethod
+    def _last_date(table):
+        import pyarrow.compute as pc
+
+        if not table.num_rows:
+            return None
+        last = pc.max(table['DATE_ACQUIRED']).as_py()
+        if hasattr(last, 'date'):
+            last = last.date()
+        return last.strftime('%Y-%m-%d')
+
+    @staticmethod
+    def _write_partition(table, dst, name='part-0.parquet'):
+        import pyarrow.parquet as pq
+
+        table = table.sort_by([('WRS_ROW', 'ascending'), ('DATE_ACQUIRED', 'ascending')])
+        sorting = [pq.SortingColumn(table.schema.get_field_index(c)) for c in ['WRS_ROW', 'DATE_ACQUIRED']]
+        if not os.path.isdir(dst):
+            os.makedirs(dst)
+        # written under a hidden name, which dataset discovery skips, until it is complete
+        tmp = os.path.join(dst, '.{}'.format(name))
+        pq.write_table(table, tmp, row_group_size=ROW_GROUP_SIZE,
+                       write_statistics=True, sorting_columns=sorting)
+        os.replace(tmp, os.path.join(dst, name))
+
     def get_wrs_shapefiles(self):
         if not os.path.isdir(self.vector_dir):
             os.mkdir(self.vector_dir)
         os.chdir(self.vector_dir)
         self.download_wrs_data()
+        self.build_wrs_index()
+
+    def build_wrs_index(self):
+        from landsat.wrs_index import build_index
+
+        for shp in glob(os.path.join(self.vector_dir, '*.shp')):
+            print('indexing {}'.format(shp))
+            build_index(shp)
+        return None
 
     def download_wrs_data(self):
+        from requests import get
+
         for url, wrs_file in zip(self.vector_url, self.vector_files):
             if not os.path.isfile(wrs_file):
                 req = get(url, stream=True)
@@ -145,6 +375,8 @@ class SatMetaData(object):
                     zip_file.extractall()
 
             except BadZipFile:
+                from fastkml import kml
+
                 with open(self.vector_zip) as doc:
                     s = doc.read()
                     k = kml.KML()
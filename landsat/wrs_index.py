@@ -0,0 +1,202 @@
+# =============================================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================================
+from __future__ import print_function, absolute_import
+
+import os
+import json
+import pickle
+
+import numpy as np
+import shapely
+from shapely import STRtree
+
+INDEX_SUFFIX = '_index.pkl'
+# share of a tile's part of an area of interest that may be left uncovered when it is
+# dropped as redundant, so slivers along shared edges don't keep a tile
+OVERLAP_TOLERANCE = .001
+
+_loaded = {}
+
+
+class WrsIndex(object):
+    """ STRtree over the WRS path/row polygons.
+
+    The polygons are stored next to their shapefile as WKB with their PATH and ROW, so
+    loading the index costs a WKB parse and a tree build rather than a shapefile read.
+    """
+
+    def __init__(self, geometries, paths, rows):
+        self.geometries = np.asarray(geometries)
+        self.paths = np.asarray(paths, dtype=int)
+        self.rows = np.asarray(rows, dtype=int)
+        self.tree = STRtree(self.geometries)
+        # (path, row): position, built the first time covering needs it
+        self._positions = None
+
+    @classmethod
+    def from_shapefile(cls, shapefile):
+        import geopandas as gpd
+
+        wrs = gpd.read_file(shapefile)
+        return cls(wrs.geometry.values, wrs['PATH'].values, wrs['ROW'].values)
+
+    @classmethod
+    def load(cls, index_file):
+        with open(index_file, 'rb') as f:
+            data = pickle.load(f)
+        return cls(shapely.from_wkb(data['geometries']), data['PATH'], data['ROW'])
+
+    def save(self, index_file):
+        data = {'geometries': shapely.to_wkb(self.geometries),
+                'PATH': self.paths,
+                'ROW': self.rows}
+        with open(index_file, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def path_rows(self, latitudes, longitudes):
+        """ Resolve many points to the path/rows they fall in with one tree query.
+
+        :param latitudes: sequence of latitudes, decimal degrees
+        :param longitudes: sequence of longitudes, decimal degrees
+        :return: pandas.DataFrame with POINT (position in the input), PATH, ROW and WRSPR,
+            one record per point and intersecting path/row
+        """
+        import pandas as pd
+
+        points = shapely.points(np.asarray(longitudes, dtype=float), np.asarray(latitudes, dtype=float))
+        point_idx, tile_idx = self.tree.query(points, predicate='intersects')
+        order = np.lexsort((tile_idx, point_idx))
+        point_idx, tile_idx = point_idx[order], tile_idx[order]
+
+        paths, rows = self.paths[tile_idx], self.rows[tile_idx]
+        return pd.DataFrame({'POINT': point_idx, 'PATH': paths, 'ROW': rows,
+                             'WRSPR': paths * 1000 + rows})
+
+    def tiles(self, geometry):
+        """ Resolve an area of interest to the path/rows intersecting it with one tree query.
+
+        :param geometry: shapely geometry in decimal degrees, see aoi_geometry
+        :return: pandas.DataFrame with PATH, ROW, WRSPR and COVERAGE (the share of the area
+            within the path/row), sorted by path and row
+        """
+        import pandas as pd
+
+        tile_idx = np.sort(self.tree.query(geometry, predicate='intersects'))
+        paths, rows = self.paths[tile_idx], self.rows[tile_idx]
+        area = shapely.area(geometry)
+        covered = shapely.area(shapely.intersection(self.geometries[tile_idx], geometry))
+        coverage = covered / area if area > 0 else np.ones(len(tile_idx))
+
+        tiles = pd.DataFrame({'PATH': paths, 'ROW': rows, 'WRSPR': paths * 1000 + rows, 'COVERAGE': coverage})
+        return tiles.sort_values(['PATH', 'ROW']).reset_index(drop=True)
+
+    def covering(self, geometry, tiles):
+        """ The tiles needed to cover geometry, dropping any whose part of it the others cover.
+
+        Tiles are kept largest share first, so of two overlapping tiles the one covering more
+        of the area stays.
+
+        :param tiles: (path, row) pairs, e.g. those with a scene on one date
+        :return: set of the (path, row) pairs to keep
+        """
+        if self._positions is None:
+            self._positions = dict((pr, i) for i, pr in enumerate(zip(self.paths.tolist(), self.rows.tolist())))
+        lookup = self._positions
+        parts = [(t, shapely.intersection(self.geometries[lookup[t]], geometry)) for t in tiles if t in lookup]
+        parts.sort(key=lambda tp: (-shapely.area(tp[1]), tp[0]))
+
+        keep, union = set(), None
+        for tile, part in parts:
+            area = shapely.area(part)
+            if union is not None and shapely.area(shapely.difference(part, union)) <= OVERLAP_TOLERANCE * area:
+                continue
+            keep.add(tile)
+            union = part if union is None else shapely.union(union, part)
+        # tiles missing from the grid can't be judged, keep them
+        keep.update(t for t in tiles if t not in lookup)
+        return keep
+
+
+def index_file(shapefile):
+    return '{}{}'.format(os.path.splitext(shapefile)[0], INDEX_SUFFIX)
+
+
+def build_index(shapefile):
+    """ Build the index for a WRS shapefile and save it alongside. """
+    idx = WrsIndex.from_shapefile(shapefile)
+    idx.save(index_file(shapefile))
+    _loaded[shapefile] = idx
+    return idx
+
+
+def load_index(shapefile):
+    """ Return the index for a WRS shapefile, loading it at most once per process.
+
+    An index file older than its shapefile, or missing, is rebuilt from the shapefile.
+    """
+    if shapefile in _loaded:
+        return _loaded[shapefile]
+
+    path = index_file(shapefile)
+    if os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(shapefile):
+        idx = WrsIndex.load(path)
+        _loaded[shapefile] = idx
+        return idx
+
+    return build_index(shapefile)
+
+
+def aoi_geometry(aoi):
+    """ Shapely geometry, decimal degrees, of an area of interest; every form an AOI is given
+    in is parsed here.
+
+    :param aoi: a shapefile (reprojected to WGS84) or GeoJSON file path, a GeoJSON geometry,
+        Feature or FeatureCollection dict, a shapely geometry, or (west, south, east, north)
+        bounds as a sequence or a 'west,south,east,north' string
+    """
+    from shapely.geometry import shape
+
+    if isinstance(aoi, shapely.Geometry):
+        return aoi
+    if isinstance(aoi, str) and aoi.lower().endswith('.shp'):
+        import geopandas as gpd
+
+        frame = gpd.read_file(aoi)
+        if frame.crs is not None:
+            frame = frame.to_crs(epsg=4326)
+        return shapely.union_all(frame.geometry.values)
+    if isinstance(aoi, str) and os.path.isfile(aoi):
+        with open(aoi) as f:
+            aoi = json.load(f)
+    if isinstance(aoi, dict):
+        if aoi.get('type') == 'FeatureCollection':
+            return shapely.union_all([aoi_geometry(feature) for feature in aoi['features']])
+        if aoi.get('type') == 'Feature':
+            return shape(aoi['geometry'])
+        return shape(aoi)
+
+    if isinstance(aoi, str):
+        aoi = aoi.split(',')
+    west, south, east, north = [float(v) for v in aoi]
+    if west >= east or south >= north:
+        raise ValueError('AOI bounds must be west, south, east, north')
+    return shapely.box(west, south, east, north)
+
+
+if __name__ == '__main__':
+    pass
+
+# ========================= EOF ================================================================
@@ -55,8 +55,7 @@ setup(name='Landsat578',
       download_url='https://github.com/{}/{}/archive/{}.tar.gz'.format('dgketchum', 'Landsat578', tag),
       url='https://github.com/dgketchum',
       test_suite='tests.test_suite.suite',
-      install_requires=['pyyaml', 'geopandas', 'requests', 'lxml', 'future', 'pyarrow', 'fastparquet',
-                        'dask[dataframe]'],
+      install_requires=['pyyaml', 'geopandas', 'requests', 'lxml', 'future', 'pyarrow', 'fastparquet'],
       **setup_kwargs)
 
 
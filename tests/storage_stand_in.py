@@ -0,0 +1,261 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import re
+import gzip
+import time
+import base64
+import random
+import hashlib
+from datetime import datetime, timedelta
+from collections import Counter
+from threading import Thread, Lock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from landsat.update_landsat_metadata import BUCKET, STORAGE_ENV
+
+INDEX_HEADER = ['SCENE_ID', 'PRODUCT_ID', 'SPACECRAFT_ID', 'SENSOR_ID', 'DATE_ACQUIRED', 'COLLECTION_NUMBER',
+                'COLLECTION_CATEGORY', 'SENSING_TIME', 'DATA_TYPE', 'WRS_PATH', 'WRS_ROW', 'CLOUD_COVER',
+                'NORTH_LAT', 'SOUTH_LAT', 'WEST_LON', 'EAST_LON', 'TOTAL_SIZE', 'BASE_URL']
+SPACECRAFT = {5: ('LT05', 'TM'), 7: ('LE07', 'ETM'), 8: ('LC08', 'OLI_TIRS')}
+# faults that can be injected; 'truncate' sends half the body and drops the connection,
+# 'no_range' ignores a Range header and sends the whole object
+FAULTS = (429, 500, 502, 503, 'truncate', 'no_range')
+SEND_CHUNK = 64 * 1024
+INDEX_NAME = '/{}/index.csv.gz'.format(BUCKET)
+
+
+class StorageStandIn(object):
+    """ Local HTTP server laid out like the public Landsat bucket, for offline downloads.
+
+    Any object under /gcp-public-data-landsat/ exists: its bytes are generated from its
+    name, band_size long. Responses carry Content-Length, Accept-Ranges, x-goog-hash MD5
+    and honour single byte ranges, like storage.googleapis.com. index.csv.gz lists the
+    added scenes, with an ETag and Last-Modified that If-None-Match and If-Modified-Since
+    are checked against.
+
+    :param band_size: bytes in every object
+    :param latency: seconds before each response starts
+    :param bandwidth: bytes per second sent on each connection, or None for no limit
+    :param fault_rates: {fault: probability} for faults in FAULTS, drawn per request
+    :param seed: seed of the fault draws
+
+    inject(name, fault, times) fails the next requests for objects whose name ends with name.
+    stats counts requests by status, plus 'bytes' sent; use as a context manager to have
+    $LANDSAT578_STORAGE point at the server while it runs.
+    """
+
+    def __init__(self, band_size=1024 * 1024, latency=0., bandwidth=None, fault_rates=None, seed=0):
+        self.band_size = int(band_size)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.fault_rates = dict(fault_rates or {})
+        self.scenes = []
+        self.stats = Counter()
+
+        self._random = random.Random(seed)
+        self._injected = []
+        self._lock = Lock()
+        self._digests = {}
+        self._body = os.urandom(self.band_size)
+        self._index_modified = datetime.utcnow()
+        self._server = None
+        self._env = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def start(self):
+        handler = type('Handler', (_Handler,), {'stand_in': self})
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self._server.daemon_threads = True
+        # a short poll interval keeps stop() from adding half a second to every run
+        thread = Thread(target=self._server.serve_forever, kwargs={'poll_interval': .05})
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        self.start()
+        self._env = os.environ.get(STORAGE_ENV)
+        os.environ[STORAGE_ENV] = self.url
+        return self
+
+    def __exit__(self, *exc):
+        if self._env is None:
+            os.environ.pop(STORAGE_ENV, None)
+        else:
+            os.environ[STORAGE_ENV] = self._env
+        self.stop()
+
+    def add_scenes(self, n, satellite=8, path=38, row=27, start='2015-05-01', cloud=10.):
+        """ Add n scenes of a path/row, 16 days apart, to the index. """
+        code, sensor = SPACECRAFT[satellite]
+        first = datetime.strptime(start, '%Y-%m-%d')
+        for i in range(n):
+            day = first + timedelta(days=16 * i)
+            product = '{}_L1TP_{:03d}{:03d}_{}_20170101_01_T1'.format(code, path, row, day.strftime('%Y%m%d'))
+            scene = 'L{}{}{:03d}{:03d}{}LGN00'.format(code[1], code[3], path, row, day.strftime('%Y%j'))
+            base = 'gs://{}/{}/01/{:03d}/{:03d}/{}'.format(BUCKET, code, path, row, product)
+            self.scenes.append([scene, product, 'LANDSAT_{}'.format(satellite), sensor, day.strftime('%Y-%m-%d'),
+                                '01', 'T1', day.strftime('%Y-%m-%dT18:00:00.0000000Z'), 'L1TP', path, row, cloud,
+                                47., 45., -110., -107., self.band_size * 13, base])
+        self._index_modified = datetime.utcnow()
+        return self.scenes[-n:]
+
+    def write_index(self, destination):
+        """ Write the index of the added scenes as index.csv.gz for SatMetaData.split_list. """
+        with open(destination, 'wb') as f:
+            f.write(self.index())
+        return destination
+
+    def index(self):
+        """ The gzipped index.csv of the added scenes. """
+        lines = [','.join(INDEX_HEADER)] + [','.join(str(v) for v in scene) for scene in self.scenes]
+        return gzip.compress(('\n'.join(lines) + '\n').encode(), mtime=0)
+
+    def inject(self, name, fault, times=1):
+        assert fault in FAULTS, fault
+        with self._lock:
+            self._injected.extend([(name, fault)] * times)
+
+    def content(self, name):
+        """ The bytes of the object at name. """
+        return hashlib.md5(name.encode()).digest() + self._body[16:]
+
+    def digest(self, name):
+        with self._lock:
+            if name not in self._digests:
+                self._digests[name] = base64.b64encode(hashlib.md5(self.content(name)).digest()).decode()
+            return self._digests[name]
+
+    def _fault(self, name):
+        with self._lock:
+            for i, (suffix, fault) in enumerate(self._injected):
+                if name.endswith(suffix):
+                    del self._injected[i]
+                    return fault
+            for fault, rate in self.fault_rates.items():
+                if self._random.random() < rate:
+                    return fault
+        return None
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.stats[key] += n
+
+
+class _Handler(BaseHTTPRequestHandler):
+    stand_in = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self._respond(body=False)
+
+    def do_GET(self):
+        self._respond(body=True)
+
+    def _respond(self, body):
+        store = self.stand_in
+        if store.latency:
+            time.sleep(store.latency)
+
+        name = self.path.split('?')[0]
+        if name == INDEX_NAME:
+            return self._index(body)
+        if not name.startswith('/{}/'.format(BUCKET)):
+            return self._status(404)
+
+        fault = store._fault(name) if body else None
+        if fault in (429, 500, 502, 503):
+            return self._status(fault, {'Retry-After': '0'} if fault in (429, 503) else None)
+
+        size = store.band_size
+        start, end, status = 0, size - 1, 200
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match and fault != 'no_range':
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start >= size:
+                return self._status(416, {'Content-Range': 'bytes */{}'.format(size)})
+            status = 206
+
+        # counted before replying, so a client never sees a response that isn't in stats yet
+        store._count(status)
+        self.send_response(status)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('x-goog-hash', 'md5={}'.format(store.digest(name)))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        self.end_headers()
+        if not body:
+            return None
+
+        data = store.content(name)[start:end + 1]
+        if fault == 'truncate':
+            data = data[:len(data) // 2]
+            self.close_connection = True
+        for k in range(0, len(data), SEND_CHUNK):
+            chunk = data[k:k + SEND_CHUNK]
+            store._count('bytes', len(chunk))
+            self.wfile.write(chunk)
+            if store.bandwidth:
+                time.sleep(len(chunk) / float(store.bandwidth))
+
+    def _index(self, body):
+        store = self.stand_in
+        data = store.index()
+        etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+        modified = store._index_modified.strftime('%a, %d %b %Y %H:%M:%S GMT')
+        headers = {'ETag': etag, 'Last-Modified': modified}
+        # If-None-Match takes precedence, as in RFC 7232
+        if 'If-None-Match' in self.headers:
+            unchanged = self.headers['If-None-Match'] == etag
+        else:
+            unchanged = self.headers.get('If-Modified-Since') == modified
+        if unchanged:
+            return self._status(304, headers)
+
+        store._count(200)
+        self.send_response(200)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if body:
+            store._count('bytes', len(data))
+            self.wfile.write(data)
+
+    def _status(self, status, headers=None):
+        self.stand_in._count(status)
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+# ===============================================================================
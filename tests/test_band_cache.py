@@ -0,0 +1,80 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import shutil
+import tempfile
+import unittest
+
+from landsat.band_cache import BandCache, cache_key
+from landsat.image_fetcher import FetchResult
+
+URL = 'http://storage.googleapis.com/gcp-public-data-landsat/LC08/01/039/027/{0}/{0}_{1}'
+PRODUCT = 'LC08_L1TP_039027_20130529_20170101_01_T1'
+
+
+class BandCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.fetched = []
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def fetch(self, url, path):
+        self.fetched.append(url)
+        with open(path, 'wb') as f:
+            f.write(b'0' * 1000)
+        return FetchResult(url, path, True, size=1000, checksum='md5', verified='md5')
+
+    def _get(self, cache, band, out='out'):
+        dst_dir = os.path.join(self.root, out)
+        if not os.path.isdir(dst_dir):
+            os.mkdir(dst_dir)
+        dst = os.path.join(dst_dir, band)
+        return cache.get(URL.format(PRODUCT, band), dst, self.fetch), dst
+
+    def test_key(self):
+        self.assertEqual(cache_key(URL.format(PRODUCT, 'B1.TIF')), '{0}/{0}_B1.TIF'.format(PRODUCT))
+
+    def test_hit_across_outputs(self):
+        cache = BandCache(os.path.join(self.root, 'cache'))
+        first, dst = self._get(cache, 'B1.TIF', 'out1')
+        second, dst2 = self._get(cache, 'B1.TIF', 'out2')
+        self.assertEqual(len(self.fetched), 1)
+        self.assertTrue(second.ok)
+        self.assertEqual((second.path, second.checksum, second.verified), (dst2, 'md5', 'md5'))
+        self.assertEqual(os.path.getsize(dst2), 1000)
+
+        # outputs are separate names for the file, removing one leaves the cache whole
+        os.remove(dst)
+        self.assertTrue(os.path.isfile(cache.path(cache_key(URL.format(PRODUCT, 'B1.TIF')))))
+
+    def test_lru_eviction(self):
+        cache = BandCache(os.path.join(self.root, 'cache'), max_bytes=2500)
+        self._get(cache, 'B1.TIF')
+        self._get(cache, 'B2.TIF')
+        self._get(cache, 'B1.TIF')
+        self._get(cache, 'B3.TIF')
+
+        cached = lambda band: os.path.isfile(cache.path(cache_key(URL.format(PRODUCT, band))))
+        self.assertEqual([cached(b) for b in ['B1.TIF', 'B2.TIF', 'B3.TIF']], [True, False, True])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ===============================================================================
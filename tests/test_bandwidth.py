@@ -0,0 +1,67 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import time
+import unittest
+from datetime import datetime
+from threading import Thread
+
+from landsat.bandwidth import parse_rate, BandwidthSchedule, BandwidthLimiter, BandwidthSpecError
+
+
+class BandwidthTestCase(unittest.TestCase):
+
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate('200MB/s'), 200e6)
+        self.assertEqual(parse_rate('1.5 GB'), 1.5e9)
+        self.assertEqual(parse_rate('2MiB/s'), 2 * 1024 ** 2)
+        self.assertEqual(parse_rate('800Mbps'), 100e6)
+        self.assertEqual(parse_rate('8Mbit/s'), 1e6)
+        self.assertEqual(parse_rate(5000), 5000.)
+        self.assertIsNone(parse_rate('unlimited'))
+        self.assertRaises(BandwidthSpecError, parse_rate, 'fast')
+
+    def test_schedule(self):
+        day = BandwidthSchedule({'08:00-18:00': '50MB/s', '22:00-06:00': '1GB/s', 'default': '200MB/s'})
+        self.assertEqual(day.rate(datetime(2020, 1, 1, 12)), 50e6)
+        self.assertEqual(day.rate(datetime(2020, 1, 1, 23)), 1e9)
+        self.assertEqual(day.rate(datetime(2020, 1, 1, 3)), 1e9)
+        self.assertEqual(day.rate(datetime(2020, 1, 1, 19)), 200e6)
+
+        cli = BandwidthSchedule('08:00-18:00=50MB/s,default=unlimited')
+        self.assertEqual(cli.rate(datetime(2020, 1, 1, 9)), 50e6)
+        self.assertIsNone(cli.rate(datetime(2020, 1, 1, 7, 59)))
+
+    def test_limiter_shared_rate(self):
+        limiter = BandwidthLimiter(BandwidthSchedule('1MB/s'))
+
+        def pull():
+            for _ in range(5):
+                limiter.consume(50000)
+
+        start = time.time()
+        threads = [Thread(target=pull) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # 1 MB across all threads at 1 MB/s
+        self.assertGreater(time.time() - start, 0.9)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ===============================================================================
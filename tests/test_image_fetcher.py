@@ -0,0 +1,200 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import base64
+import hashlib
+import shutil
+import tempfile
+import unittest
+
+from landsat.image_fetcher import (ImageFetcher, RetryPolicy, ConcurrencyController, StreamDigest, ChecksumMismatch,
+                                   retry_after, server_hashes)
+from tests.storage_stand_in import StorageStandIn
+
+
+class _Response(object):
+    def __init__(self, headers):
+        self.headers = headers
+
+
+class RetryTestCase(unittest.TestCase):
+
+    def test_backoff_bounds(self):
+        policy = RetryPolicy(attempts=5, base=1., cap=6.)
+        for attempt, limit in [(1, 1.), (2, 2.), (3, 4.), (4, 6.), (5, 6.)]:
+            delays = [policy.delay(attempt) for _ in range(200)]
+            self.assertTrue(all(0 <= d <= limit for d in delays))
+        self.assertGreaterEqual(policy.delay(1, retry_after=30.), 30.)
+
+    def test_retry_after(self):
+        self.assertEqual(retry_after(_Response({'Retry-After': '7'})), 7.)
+        self.assertEqual(retry_after(_Response({'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})), 0.)
+        self.assertEqual(retry_after(_Response({'Retry-After': '100000'})), 300.)
+        self.assertIsNone(retry_after(_Response({})))
+
+
+class ConcurrencyControllerTestCase(unittest.TestCase):
+
+    def test_aimd(self):
+        controller = ConcurrencyController(8)
+        controller.throttle()
+        self.assertEqual(controller.limit, 4)
+        controller.throttle()
+        controller.throttle()
+        controller.throttle()
+        self.assertEqual(controller.limit, 1)
+
+        for _ in range(1 + 2 + 3):
+            controller.success()
+        self.assertEqual(controller.limit, 4)
+
+        for _ in range(100):
+            controller.success()
+        self.assertEqual(controller.limit, 8)
+
+
+class StreamDigestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.data = b'landsat' * 1000
+        md5 = base64.b64encode(hashlib.md5(self.data).digest()).decode()
+        self.headers = {'x-goog-hash': 'crc32c=n03x6A==, md5={}'.format(md5)}
+
+    def _digest(self, data):
+        digest = StreamDigest(server_hashes(_Response(self.headers)))
+        for k in range(0, len(data), 999):
+            digest.update(data[k:k + 999])
+        return digest
+
+    def test_server_hashes(self):
+        hashes = server_hashes(_Response(self.headers))
+        self.assertEqual(sorted(hashes), ['crc32c', 'md5'])
+        self.assertTrue(hashes['md5'].endswith('=='))
+
+    def test_verify(self):
+        self.assertEqual(self._digest(self.data).verify('B1.TIF', len(self.data)), 'md5')
+        mangled = b'L' + self.data[1:]
+        self.assertRaises(ChecksumMismatch, self._digest(mangled).verify, 'B1.TIF', len(self.data))
+        self.assertRaises(ChecksumMismatch, self._digest(self.data[:-1]).verify, 'B1.TIF', len(self.data))
+
+    def test_size_only(self):
+        self.headers = {}
+        self.assertEqual(self._digest(self.data).verify('B1.TIF', len(self.data)), 'size')
+        self.assertIsNone(self._digest(self.data).verify('B1.TIF'))
+
+
+class StandInFetchTestCase(unittest.TestCase):
+    """ ImageFetcher against the storage stand-in. """
+
+    NAME = '/gcp-public-data-landsat/LC08/01/038/027/LC08_L1TP/LC08_L1TP_B4.TIF'
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'B4.TIF')
+        self.storage = StorageStandIn(band_size=256 * 1024).start()
+        self.fetcher = ImageFetcher(workers=4, segments=4, segment_threshold=1024,
+                                    retry=RetryPolicy(attempts=3, base=0.))
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.storage.stop()
+        shutil.rmtree(self.root)
+
+    def _fetch(self):
+        result = self.fetcher.fetch(self.storage.url + self.NAME, self.path)
+        self.assertTrue(result.ok, result.error)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), self.storage.content(self.NAME))
+        self.assertEqual(os.listdir(self.root), ['B4.TIF'])
+        return result
+
+    def test_segments(self):
+        result = self._fetch()
+        self.assertEqual(result.verified, 'size')
+        # the HEAD, then four ranges
+        self.assertEqual(self.storage.stats[200], 1)
+        self.assertEqual(self.storage.stats[206], 4)
+
+    def test_throttled_segment(self):
+        # a 429 on one range narrows the limit and retries that range, not the others
+        self.storage.inject('B4.TIF', 429)
+        result = self._fetch()
+        self.assertEqual(result.attempts, 1)
+        self.assertEqual(self.fetcher.concurrency.limit, 2)
+        self.assertEqual(self.storage.stats[429], 1)
+        self.assertEqual(self.storage.stats[200], 1)
+        # three ranges on the first try, one retried
+        self.assertEqual(self.storage.stats[206], 4)
+
+    def test_truncated_segment(self):
+        # a range cut short asks for the rest of itself
+        self.storage.inject('B4.TIF', 'truncate')
+        result = self._fetch()
+        self.assertEqual(self.storage.stats[200], 1)
+        self.assertEqual(self.storage.stats[206], 5)
+        self.assertLess(self.storage.stats['bytes'], self.storage.band_size * 5 // 4)
+
+    def test_throttled_out(self):
+        # three tries for each of the four ranges
+        self.storage.inject('B4.TIF', 503, times=12)
+        result = self.fetcher.fetch(self.storage.url + self.NAME, self.path)
+        self.assertFalse(result.ok)
+        self.assertEqual(result.status, 503)
+        # once the ranges have had their retries, the whole file isn't fetched again
+        self.assertEqual(self.storage.stats[503], 12)
+        self.assertEqual(self.storage.stats[200], 1)
+        self.assertFalse(os.listdir(self.root))
+
+    def test_fallback(self):
+        # a server that ignores the ranges gets a single stream, checked against its MD5
+        self.storage.inject('B4.TIF', 'no_range')
+        result = self._fetch()
+        self.assertEqual(result.attempts, 1)
+        self.assertEqual(result.verified, 'md5')
+        # the HEAD, the range answered with the whole file, and the full GET
+        self.assertEqual(self.storage.stats[200], 3)
+
+    def test_not_found(self):
+        # final failures don't count towards growing a throttled limit back
+        self.fetcher.concurrency.throttle()
+        for _ in range(10):
+            result = self.fetcher.fetch(self.storage.url + '/elsewhere/B4.TIF', self.path)
+            self.assertFalse(result.ok)
+            self.assertEqual(result.status, 404)
+        self.assertEqual(self.fetcher.concurrency.limit, 2)
+
+        self._fetch()
+        self._fetch()
+        self.assertEqual(self.fetcher.concurrency.limit, 3)
+
+    def test_unexpected_error(self):
+        # an error no retry can fix is returned at once, not raised
+        result = self.fetcher.fetch(self.storage.url + self.NAME, os.path.join(self.root, 'missing', 'B4.TIF'))
+        self.assertFalse(result.ok)
+        self.assertEqual(result.attempts, 1)
+        self.assertIn('FileNotFoundError', result.error)
+
+    def test_old_import(self):
+        from landsat.google_download import BadRequestsResponse
+        from landsat import image_fetcher
+
+        self.assertIs(BadRequestsResponse, image_fetcher.BadRequestsResponse)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ===============================================================================
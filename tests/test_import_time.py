@@ -0,0 +1,57 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import sys
+import json
+import unittest
+import subprocess
+
+# the cli is started thousands of times by schedulers, keep these out of its import
+HEAVY_MODULES = ['geopandas', 'shapely', 'lxml', 'pandas', 'numpy', 'dask', 'fastkml', 'pyarrow', 'requests']
+
+IMPORT_BUDGET_SECONDS = 0.5
+# wall-clock time depends on the machine and its load, so the budget is only checked on request
+TIMING_ENV = 'LANDSAT578_TIMING'
+
+PROBE = '''
+import sys, time, json
+start = time.time()
+import landsat.landsat_cli
+elapsed = time.time() - start
+print(json.dumps({'seconds': elapsed, 'modules': sorted(set(m.split('.')[0] for m in sys.modules))}))
+'''
+
+
+class ImportTimeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        out = subprocess.check_output([sys.executable, '-c', PROBE], cwd=root)
+        self.probe = json.loads(out.decode().strip().splitlines()[-1])
+
+    def test_no_heavy_imports(self):
+        loaded = [m for m in HEAVY_MODULES if m in self.probe['modules']]
+        self.assertEqual(loaded, [])
+
+    @unittest.skipUnless(os.environ.get(TIMING_ENV), 'set ${} to check the import time'.format(TIMING_ENV))
+    def test_import_budget(self):
+        self.assertLess(self.probe['seconds'], IMPORT_BUDGET_SECONDS)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ===============================================================================
@@ -0,0 +1,60 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import shutil
+import tempfile
+import unittest
+
+from landsat.job_ledger import JobLedger, DONE, FAILED, PACKAGED
+
+
+class JobLedgerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_reopen_resumes(self):
+        ledger = JobLedger(self.root)
+        self.assertTrue(ledger.new)
+        ledger.band_started('S1', 'B1.TIF', 'http://host/B1.TIF')
+        ledger.band_finished('S1', 'B1.TIF', 100, 'md5')
+        ledger.band_started('S1', 'B2.TIF', 'http://host/B2.TIF')
+        ledger.band_failed('S1', 'B2.TIF', 'timed out')
+        ledger.scene_finished('S0', PACKAGED, archive='S0.tar')
+        ledger.close()
+
+        ledger = JobLedger(self.root)
+        self.assertFalse(ledger.new)
+        self.assertTrue(ledger.band_done('S1', 'B1.TIF'))
+        self.assertFalse(ledger.band_done('S1', 'B2.TIF'))
+        self.assertTrue(ledger.known('S1'))
+        self.assertFalse(ledger.known('S2'))
+        self.assertEqual(ledger.scene_state('S0'), PACKAGED)
+
+        summary = ledger.summary()
+        self.assertEqual(summary['scenes'], {PACKAGED: 1})
+        self.assertEqual(summary['bands'][DONE][:2], (1, 100))
+        self.assertEqual(summary['bands'][FAILED][0], 1)
+        self.assertEqual(summary['failures'], [('S1', 'B2.TIF', 'timed out')])
+        ledger.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ===============================================================================
@@ -0,0 +1,101 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from landsat.metrics import Metrics, JsonLinesExporter
+from landsat.scene_pipeline import ScenePipeline, SceneTask
+from landsat.image_fetcher import FetchResult
+from landsat import metrics as metrics_module
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_registry_and_exports(self):
+        m = Metrics()
+        events = []
+        m.subscribe(events.append)
+        m.count('download_bytes', 1000, file='B1.TIF')
+        m.count('download_bytes', 500)
+        with m.timer('package'):
+            pass
+        m.gauge('verify_queue_depth', 3)
+        m.gauge('verify_queue_depth', 1)
+
+        self.assertEqual(m.counters['download_bytes'], 1500)
+        self.assertEqual(m.timers['package'][0], 1)
+        self.assertEqual(m.gauges['verify_queue_depth'], [1, 3])
+        self.assertEqual([e['event'] for e in events], ['count', 'count', 'observe', 'gauge', 'gauge'])
+        self.assertEqual(events[0]['file'], 'B1.TIF')
+
+        text = m.prometheus()
+        self.assertIn('landsat_download_bytes_total 1500', text)
+        self.assertIn('landsat_package_seconds_count 1', text)
+        self.assertIn('landsat_verify_queue_depth_max 3', text)
+
+        path = os.path.join(self.root, 'metrics.prom')
+        m.write_prometheus(path)
+        with open(path) as f:
+            self.assertEqual(f.read(), text)
+
+        profile = m.profile()
+        self.assertIn('package', profile)
+        self.assertIn('0.0 MB', profile)
+
+    def test_json_lines(self):
+        m = Metrics()
+        path = os.path.join(self.root, 'events.jsonl')
+        exporter = JsonLinesExporter(path)
+        m.subscribe(exporter)
+        m.count('retries', file='B2.TIF')
+        m.observe('fetch', 0.5)
+        exporter.close()
+
+        with open(path) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([(r['name'], r['value']) for r in records], [('retries', 1), ('fetch', 0.5)])
+
+    def test_pipeline_stages(self):
+        metrics_module.metrics.reset()
+
+        def fetch(url, path):
+            with open(path, 'wb') as f:
+                f.write(b'0' * 10)
+            return FetchResult(url, path, True, size=10)
+
+        bands = [('http://host/{}'.format(b), os.path.join(self.root, b)) for b in ['B1.TIF', 'B2.TIF']]
+        ScenePipeline(fetch, workers=2).run([SceneTask('LC80390272013149LGN00', self.root, bands)])
+
+        timers = metrics_module.metrics.timers
+        self.assertEqual(timers['verify'][0], 2)
+        self.assertEqual(timers['scene'][0], 1)
+        self.assertEqual(metrics_module.metrics.counters['scenes_complete'], 1)
+        self.assertIn('verify_queue_depth', metrics_module.metrics.gauges)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ===============================================================================
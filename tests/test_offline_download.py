@@ -0,0 +1,167 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import shutil
+import tempfile
+import unittest
+
+from landsat.google_download import GoogleDownload
+from landsat.job_ledger import JobLedger
+from landsat.packaging import CodecUnavailable, SceneArchive
+from landsat.update_landsat_metadata import SatMetaData
+from tests.storage_stand_in import StorageStandIn
+
+
+class OfflineDownloadTestCase(unittest.TestCase):
+    """ GoogleDownload.download end to end against a local stand-in for the storage bucket. """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.scenes = os.path.join(self.root, 'scenes')
+        self.output = os.path.join(self.root, 'out')
+        for d in [self.scenes, self.output]:
+            os.mkdir(d)
+
+        # over two of ImageFetcher's 1 MB chunks, so a truncated response leaves some to resume from
+        self.storage = StorageStandIn(band_size=3 * 1024 * 1024)
+        self.storage.add_scenes(2)
+        index = self.storage.write_index(os.path.join(self.root, 'index.csv.gz'))
+        SatMetaData(sat='landsat', scenes_dir=self.scenes).split_list(source=index)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _query(self, **kwargs):
+        return GoogleDownload('2015-04-01', '2015-06-30', 8, path=38, row=27, output_path=self.output,
+                              scenes_dir=self.scenes, **kwargs)
+
+    def _download(self, **kwargs):
+        g = self._query(**kwargs)
+        return g, g.download()
+
+    def _check_files(self, g, scenes=None):
+        for scene in scenes if scenes is not None else g.scenes_low_cloud.itertuples():
+            for band in g.band_map.file_suffixes['LANDSAT_8']:
+                url = g._make_url(scene, band)
+                self.assertTrue(url.startswith(self.storage.url))
+                with open(os.path.join(self.output, scene.SCENE_ID, os.path.basename(url)), 'rb') as f:
+                    self.assertEqual(f.read(), self.storage.content(url[len(self.storage.url):]))
+
+    def test_download(self):
+        with self.storage:
+            g, failed = self._download(workers=4)
+            self._check_files(g)
+        self.assertEqual(failed, [])
+        self.assertEqual(self.storage.stats[200], 2 * 13)
+
+    def test_streamed_download(self):
+        with self.storage:
+            g = GoogleDownload('2015-04-01', '2015-06-30', 8, path=38, row=27, output_path=self.output,
+                               scenes_dir=self.scenes, lazy=True)
+            self.assertIsNone(g.scenes_all)
+            records = list(g.iter_scenes(batch_size=1))
+            self.assertEqual([r.SCENE_ID for r in records], sorted(s[0] for s in self.storage.scenes))
+            failed = g.download(scenes=iter(records))
+            self._check_files(g, records)
+        self.assertEqual(failed, [])
+        self.assertEqual(self.storage.stats[200], 2 * 13)
+
+    def test_lazy_selected(self):
+        g = self._query(lazy=True)
+        self.assertRaises(ValueError, g.download, list_type='selected')
+        g.select_scenes(1)
+        self.assertEqual(len(g.selected_scenes), 1)
+        with self.storage:
+            self.assertEqual(g.download(list_type='selected'), [])
+        self.assertEqual(self.storage.stats[200], 13)
+
+    def test_faults(self):
+        self.storage.inject('_B1.TIF', 503, times=2)
+        self.storage.inject('_B2.TIF', 'truncate')
+        self.storage.inject('_B3.TIF', 429)
+        with self.storage:
+            g, failed = self._download(workers=4)
+            self._check_files(g)
+        self.assertEqual(failed, [])
+        # the truncated band resumes where it was cut off
+        self.assertEqual(self.storage.stats[206], 1)
+
+    def test_packaged_rerun(self):
+        # one band of the first scene fails, so it isn't packaged; the rerun only fetches that band
+        self.storage.inject(sorted(s[1] for s in self.storage.scenes)[0] + '_B4.TIF', 500, times=2)
+        with self.storage:
+            g, failed = self._download(retries=2, zipped=True, codec='none')
+            self.assertEqual(len(failed), 1)
+            self.assertEqual(self.storage.stats[200], 2 * 13 - 1)
+            # the bands that did arrive are on disk once, in the .part or the staging directory
+            scene_id = sorted(self.storage.scenes, key=lambda s: s[1])[0][0]
+            archived = SceneArchive(os.path.join(self.output, scene_id), scene_id, codec='none').archived()
+            staged = set(os.listdir(os.path.join(self.output, scene_id)))
+            self.assertEqual(len(archived | staged), 12)
+            self.assertEqual(archived & staged, set())
+            g, failed = self._download(retries=2, zipped=True, codec='none')
+        self.assertEqual(failed, [])
+        self.assertEqual(self.storage.stats[200], 2 * 13)
+        self.assertEqual(sorted(f for f in os.listdir(self.output) if f.endswith('.tar')),
+                         sorted(s[0] + '.tar' for s in self.storage.scenes))
+
+    def test_gives_up(self):
+        self.storage.inject('_B4.TIF', 500, times=4)
+        with self.storage:
+            g, failed = self._download(retries=2)
+        self.assertEqual(sorted(os.path.basename(r.url)[-6:] for r in failed), ['B4.TIF', 'B4.TIF'])
+        self.assertEqual([r.status for r in failed], [500, 500])
+
+    def test_codec_checked_up_front(self):
+        self.assertRaises(ValueError, self._query, zipped=True, codec='rar')
+        # only packaging uses the codec
+        self._query(codec='rar')
+        path = os.environ.get('PATH')
+        os.environ['PATH'] = self.root
+        try:
+            self.assertRaises(CodecUnavailable, self._query, alt_name=True, codec='pigz')
+        finally:
+            os.environ['PATH'] = path
+
+    def _tasks(self, g):
+        g._ledger = JobLedger(self.output)
+        try:
+            return list(g._scene_tasks(g.scenes_low_cloud))
+        finally:
+            g._ledger.close()
+            g._ledger = None
+
+    def test_aoi_ledger(self):
+        # full bands in the ledger are not taken for clipped ones, nor the other way round
+        with self.storage:
+            g, failed = self._download()
+        self.assertEqual(self._tasks(g), [])
+
+        g = self._query(aoi='-108.,45.5,-107.5,46.')
+        tasks = self._tasks(g)
+        self.assertEqual(len(tasks), 2)
+        self.assertEqual([t.done for t in tasks], [set(), set()])
+
+        ledger = JobLedger(self.output)
+        for task in tasks:
+            key = g._ledger_key(task.scene_id)
+            self.assertEqual(key, '{}@-108.000000,45.500000,-107.500000,46.000000'.format(task.scene_id))
+            ledger.scene_finished(key, 'complete')
+        ledger.close()
+        self.assertEqual(self._tasks(g), [])
+        self.assertEqual(len(self._tasks(self._query(aoi='-108.,45.5,-107.,46.'))), 2)
+
+# ===============================================================================
@@ -0,0 +1,139 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+import subprocess
+from shutil import which
+
+from landsat.packaging import SceneArchive, CodecUnavailable, check_codec
+
+
+class SceneArchiveTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.bands, self.contents = [], {}
+        for b in range(3):
+            path = os.path.join(self.root, 'B{}.TIF'.format(b))
+            self.contents[os.path.basename(path)] = os.urandom(1024) * (b + 1)
+            with open(path, 'wb') as f:
+                f.write(self.contents[os.path.basename(path)])
+            self.bands.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _package(self, codec):
+        archive = SceneArchive(os.path.join(self.root, 'S1'), 'S1', codec=codec)
+        for path in self.bands:
+            archive.add(path)
+        archive.close()
+        self.assertFalse(os.path.exists(archive.part))
+        # each band is deleted as it is archived
+        self.assertEqual([p for p in self.bands if os.path.exists(p)], [])
+        self._check(archive.path, codec)
+        return archive.path
+
+    def _check(self, path, codec):
+        if codec == 'zst':
+            tar = tarfile.open(fileobj=io.BytesIO(subprocess.check_output(['zstd', '-q', '-d', '-c', path])))
+        else:
+            tar = tarfile.open(path)
+        with tar:
+            members = dict((m.name, tar.extractfile(m).read()) for m in tar.getmembers())
+        self.assertEqual(members, dict((os.path.join('S1', k), v) for k, v in self.contents.items()))
+
+    def _resume(self, codec):
+        # one band is archived before the scene is given up on, the rest on the rerun
+        archive = SceneArchive(os.path.join(self.root, 'S1'), 'S1', codec=codec)
+        archive.add(self.bands[0])
+        archive.abort()
+        self.assertTrue(os.path.isfile(archive.part))
+        self.assertFalse(os.path.exists(self.bands[0]))
+
+        archive = SceneArchive(os.path.join(self.root, 'S1'), 'S1', codec=codec)
+        self.assertEqual(archive.archived(), {'B0.TIF'})
+        for path in self.bands[1:]:
+            archive.add(path)
+        archive.close()
+        self._check(archive.path, codec)
+
+    def test_gz(self):
+        self.assertTrue(self._package('gz').endswith('S1.tar.gz'))
+
+    def test_none(self):
+        self.assertTrue(self._package('none').endswith('S1.tar'))
+
+    @unittest.skipUnless(which('pigz'), 'pigz is not on the PATH')
+    def test_pigz(self):
+        self.assertTrue(self._package('pigz').endswith('S1.tar.gz'))
+
+    @unittest.skipUnless(which('zstd'), 'zstd is not on the PATH')
+    def test_zst(self):
+        self.assertTrue(self._package('zst').endswith('S1.tar.zst'))
+
+    def test_resume_gz(self):
+        self._resume('gz')
+
+    def test_resume_none(self):
+        self._resume('none')
+
+    @unittest.skipUnless(which('pigz'), 'pigz is not on the PATH')
+    def test_resume_pigz(self):
+        self._resume('pigz')
+
+    @unittest.skipUnless(which('zstd'), 'zstd is not on the PATH')
+    def test_resume_zst(self):
+        self._resume('zst')
+
+    def test_unreadable_part(self):
+        # a .part cut off by a killed run is started over
+        archive = SceneArchive(os.path.join(self.root, 'S1'), 'S1', codec='gz')
+        for path in self.bands:
+            archive.add(path)
+        archive.abort()
+        with open(archive.part, 'rb') as f:
+            data = f.read()
+        with open(archive.part, 'wb') as f:
+            f.write(data[:len(data) // 2])
+        self.assertEqual(SceneArchive(os.path.join(self.root, 'S1'), 'S1', codec='gz').archived(), set())
+        self.assertFalse(os.path.exists(archive.part))
+
+    def test_abort_before_adding(self):
+        archive = SceneArchive(os.path.join(self.root, 'S1'), 'S1', codec='gz')
+        archive.archived()
+        archive.abort()
+        self.assertFalse(os.path.exists(archive.part))
+        self.assertTrue(all(os.path.exists(p) for p in self.bands))
+
+    def test_check_codec(self):
+        self.assertRaises(ValueError, check_codec, 'rar')
+        path = os.environ.get('PATH')
+        os.environ['PATH'] = self.root
+        try:
+            self.assertRaises(CodecUnavailable, check_codec, 'pigz')
+        finally:
+            os.environ['PATH'] = path
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ===============================================================================
@@ -0,0 +1,148 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import shutil
+import tempfile
+import unittest
+from argparse import Namespace
+from threading import Thread
+
+from landsat.google_download import GoogleDownload
+from landsat.landsat_cli import main
+from landsat.metrics import metrics
+from landsat.query_service import (SceneService, ServiceError, SERVICE_ENV, make_server, query_service,
+                                   read_service_file, service_candidate_scenes, write_service_file)
+from landsat.scene_query import drop_resident
+from landsat.update_landsat_metadata import SatMetaData
+from tests.storage_stand_in import StorageStandIn
+
+QUERY = {'satellite': 8, 'start': '2015-04-01', 'end': '2015-09-30', 'path': 38, 'row': 27}
+
+
+class QueryServiceTestCase(unittest.TestCase):
+    """ The query service, its client and the command line's fallback, over a stand-in catalog. """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.scenes = os.path.join(self.root, 'scenes')
+        os.mkdir(self.scenes)
+
+        storage = StorageStandIn(band_size=1024)
+        storage.add_scenes(6, path=38, row=27)
+        storage.add_scenes(4, path=39, row=27)
+        index = storage.write_index(os.path.join(self.root, 'index.csv.gz'))
+        SatMetaData(sat='landsat', scenes_dir=self.scenes).split_list(source=index)
+
+        self._env = os.environ.get(SERVICE_ENV)
+
+    def tearDown(self):
+        for server, thread in getattr(self, 'servers', []):
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        if self._env is None:
+            os.environ.pop(SERVICE_ENV, None)
+        else:
+            os.environ[SERVICE_ENV] = self._env
+        drop_resident()
+        shutil.rmtree(self.root)
+
+    def _serve(self, scenes_dir):
+        server = make_server(('127.0.0.1', 0), SceneService(scenes_dir=scenes_dir), token='secret')
+        thread = Thread(target=server.serve_forever, kwargs={'poll_interval': .05})
+        thread.daemon = True
+        thread.start()
+        self.servers = getattr(self, 'servers', []) + [(server, thread)]
+        os.environ[SERVICE_ENV] = os.path.join(self.root, 'service', 'query_service.json')
+        write_service_file(server.server_address, 'secret')
+        return server
+
+    def _local(self, **kwargs):
+        query = dict(QUERY, **kwargs)
+        return GoogleDownload(query.pop('start'), query.pop('end'), query.pop('satellite'), scenes_dir=self.scenes,
+                              **query)
+
+    def test_queries(self):
+        self._serve(self.scenes)
+        expected = self._local().candidate_scenes(return_list=True)
+        self.assertEqual(len(expected), 6)
+
+        metrics.reset()
+        self.assertEqual(query_service('candidate_scenes', QUERY)['scene_ids'], expected)
+        # the service's lazy query scans the catalog once
+        self.assertEqual(metrics.timers['candidate_scenes'][0], 1)
+        self.assertEqual(service_candidate_scenes(dict(QUERY, path=39)), self._local(path=39).candidate_scenes(
+            return_list=True))
+
+        # one query object per satellite, copied for each query
+        service = self.servers[0][0].RequestHandlerClass.service
+        self.assertEqual(list(service._queries), ['LANDSAT_8'])
+        template = service._queries['LANDSAT_8']
+        query_service('candidate_scenes', dict(QUERY, path=39))
+        self.assertIs(service._queries['LANDSAT_8'], template)
+
+        g = self._local()
+        g.select_scenes(2)
+        self.assertEqual(query_service('select_scenes', dict(QUERY, n=2))['scene_ids'],
+                         g.selected_scenes['SCENE_ID'].tolist())
+
+    def test_token(self):
+        server = self._serve(self.scenes)
+        host, port, token = read_service_file()
+        self.assertEqual((host, port, token), ('127.0.0.1', server.server_address[1], 'secret'))
+        if os.name == 'posix':
+            self.assertEqual(os.stat(os.environ[SERVICE_ENV]).st_mode & 0o777, 0o600)
+
+        # anyone without the token is turned away, and the command line queries locally
+        with self.assertRaises(ServiceError) as e:
+            query_service('candidate_scenes', QUERY, service=(host, port, 'guess'))
+        self.assertIn('token', str(e.exception))
+        write_service_file((host, port), 'guess')
+        self.assertIsNone(service_candidate_scenes(QUERY))
+
+        # without a service file there is no service
+        os.remove(os.environ[SERVICE_ENV])
+        self.assertIsNone(query_service('candidate_scenes', QUERY))
+
+    def test_missing_catalog(self):
+        self._serve(self.scenes)
+        cwd = os.getcwd()
+        with self.assertRaises(ServiceError) as e:
+            query_service('candidate_scenes', dict(QUERY, satellite=5))
+        self.assertIn('landsat --update-scenes', str(e.exception))
+        # nothing was downloaded or built inside the request
+        self.assertFalse(os.path.exists(os.path.join(self.scenes, 'LANDSAT_5')))
+        self.assertEqual(os.getcwd(), cwd)
+        self.assertIsNone(service_candidate_scenes(dict(QUERY, satellite=5)))
+
+    def test_cli_falls_back(self):
+        # a service without the catalog answers 409, one not running doesn't answer at all
+        empty = os.path.join(self.root, 'empty')
+        os.mkdir(empty)
+        self._serve(empty)
+        args = Namespace(return_list=True, update_scenes=False, incremental=False, configuration=None,
+                         scenes_dir=self.scenes, **QUERY)
+        expected = self._local().candidate_scenes(return_list=True)
+        self.assertEqual(main(args), expected)
+
+        self.servers[0][0].shutdown()
+        self.servers[0][0].server_close()
+        self.servers[0][1].join()
+        self.servers = []
+        self.assertIsNone(query_service('candidate_scenes', QUERY))
+        self.assertEqual(main(args), expected)
+
+# ===============================================================================
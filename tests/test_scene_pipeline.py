@@ -0,0 +1,157 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import time
+import shutil
+import tarfile
+import tempfile
+import unittest
+from threading import Lock, Thread
+
+from landsat.packaging import SceneArchive
+from landsat.scene_pipeline import ScenePipeline, SceneTask
+
+BAND_BYTES = 1000
+
+
+class ScenePipelineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.lock = Lock()
+        self.active = set()
+        self.most_active = 0
+        self.fail = set()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def fetch(self, url, dst):
+        scene = os.path.basename(os.path.dirname(dst))
+        with self.lock:
+            self.active.add(scene)
+            self.most_active = max(self.most_active, len(self.active))
+        time.sleep(0.01)
+        if url in self.fail:
+            raise IOError('bad band')
+        with open(dst, 'wb') as f:
+            f.write(b'0' * BAND_BYTES)
+
+    def tasks(self, n_scenes, n_bands=3):
+        for i in range(n_scenes):
+            scene_id = 'S{}'.format(i)
+            out_dir = os.path.join(self.root, scene_id)
+            os.mkdir(out_dir)
+            bands = [('{}_B{}'.format(scene_id, b), os.path.join(out_dir, 'B{}.TIF'.format(b)))
+                     for b in range(n_bands)]
+            archive = SceneArchive(out_dir, scene_id, codec='none')
+            yield SceneTask(scene_id, out_dir, bands, archive=archive)
+
+    def test_packages_every_scene(self):
+        pipeline = ScenePipeline(self.fetch, workers=4)
+        self.assertEqual(pipeline.run(self.tasks(5)), [])
+        archives = sorted(f for f in os.listdir(self.root))
+        self.assertEqual(archives, ['S{}.tar'.format(i) for i in range(5)])
+        self.assertEqual(len(tarfile.open(os.path.join(self.root, 'S0.tar')).getnames()), 3)
+
+    def test_failed_band_skips_scene(self):
+        self.fail.add('S1_B2')
+        pipeline = ScenePipeline(self.fetch, workers=2)
+        self.assertEqual(pipeline.run(self.tasks(3)), ['S1'])
+        # the exception comes back as a result too
+        self.assertEqual([(r.url, r.ok, r.error) for r in pipeline.failed], [('S1_B2', False, 'bad band')])
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'S1.tar')))
+        self.assertTrue(os.path.isfile(os.path.join(self.root, 'S2.tar')))
+        # the bands that did download are kept for a rerun, each once: in the .part if they
+        # were archived before the failure, else in the staging directory
+        archived = SceneArchive(os.path.join(self.root, 'S1'), 'S1', codec='none').archived()
+        staged = set(os.listdir(os.path.join(self.root, 'S1')))
+        self.assertEqual(sorted(archived | staged), ['B0.TIF', 'B1.TIF'])
+        self.assertEqual(archived & staged, set())
+
+    def test_failed_close_releases_scene(self):
+        class BrokenArchive(SceneArchive):
+            def _close_streams(self):
+                SceneArchive._close_streams(self)
+                if self.arcdir == 'S1':
+                    raise IOError('pigz failed')
+
+        def tasks():
+            for task in self.tasks(4):
+                task.archive = BrokenArchive(task.out_dir, task.scene_id, codec='none')
+                yield task
+
+        finished = []
+        pipeline = ScenePipeline(self.fetch, workers=1, max_scenes=1, finished=finished.append)
+        result = []
+        # with its slot never given back, the next scene would wait forever
+        runner = Thread(target=lambda: result.append(pipeline.run(tasks())))
+        runner.daemon = True
+        runner.start()
+        runner.join(30)
+        self.assertFalse(runner.is_alive())
+
+        self.assertEqual(result, [['S1']])
+        self.assertEqual([t.scene_id for t in finished], ['S0', 'S1', 'S2', 'S3'])
+        self.assertFalse(finished[1].complete)
+        # a .part the compressor failed on can't be resumed
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'S1.tar.part')))
+        self.assertTrue(os.path.isfile(os.path.join(self.root, 'S3.tar')))
+
+    def test_tasks_error_stops_stages(self):
+        def tasks():
+            for task in self.tasks(2):
+                yield task
+            raise IOError('catalog gone')
+
+        pipeline = ScenePipeline(self.fetch, workers=2)
+        errors = []
+
+        def run():
+            try:
+                pipeline.run(tasks())
+            except IOError as e:
+                errors.append(str(e))
+
+        runner = Thread(target=run)
+        runner.daemon = True
+        runner.start()
+        runner.join(30)
+        self.assertFalse(runner.is_alive())
+
+        self.assertEqual(errors, ['catalog gone'])
+        # the scenes started before the error are still packaged
+        self.assertEqual(sorted(f for f in os.listdir(self.root) if f.endswith('.tar')), ['S0.tar', 'S1.tar'])
+
+    def test_max_scenes_in_flight(self):
+        test = self
+
+        class Pipeline(ScenePipeline):
+            def _finish(self, task):
+                with test.lock:
+                    test.active.discard(task.scene_id)
+                ScenePipeline._finish(self, task)
+
+        pipeline = Pipeline(self.fetch, workers=4, max_scenes=2, max_staging_bytes=BAND_BYTES)
+        self.assertEqual(pipeline.run(self.tasks(6)), [])
+        self.assertEqual(self.most_active, 2)
+        self.assertEqual(len(os.listdir(self.root)), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ===============================================================================
@@ -0,0 +1,209 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from landsat.google_download import GoogleDownload
+from landsat.scene_query import (SCENE_COLUMNS, batch_candidate_scenes, drop_resident, load_resident,
+                                 open_catalog, scene_filter, scene_records, select_per_bin)
+from landsat.update_landsat_metadata import SatMetaData
+from tests.storage_stand_in import StorageStandIn
+
+
+def _scenes(dates, clouds, path=38, row=27):
+    dates = pd.to_datetime(dates)
+    return pd.DataFrame({'SCENE_ID': ['{}_{}_{}'.format(path, row, d.strftime('%Y%j')) for d in dates],
+                         'DATE_ACQUIRED': dates,
+                         'SENSING_TIME': dates.strftime('%Y-%m-%dT18:00:00.0000000Z'),
+                         'WRS_PATH': path, 'WRS_ROW': row, 'CLOUD_COVER': clouds})
+
+
+class SelectPerBinTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # every 16 days through 2015; the frame is shuffled, selection must not depend on its order
+        dates = pd.date_range('2015-01-02', '2015-12-31', freq='16D')
+        clouds = np.random.RandomState(0).choice([0., 5., 20., 60., 100.], len(dates))
+        self.scenes = _scenes(dates, clouds).sample(frac=1, random_state=1)
+
+    def _ids(self, selected):
+        return selected['SCENE_ID'].tolist()
+
+    def test_count_bins(self):
+        scn = self.scenes.sort_values('SENSING_TIME').reset_index(drop=True)
+        for n in [1, 3, 7, len(scn)]:
+            # the clearest (then earliest) scene of each of n equal runs in time
+            runs = [scn.iloc[(k * len(scn)) // n:((k + 1) * len(scn)) // n] for k in range(n)]
+            expected = [r.loc[r['CLOUD_COVER'].idxmin(), 'SCENE_ID'] for r in runs]
+            self.assertEqual(self._ids(select_per_bin(self.scenes, n)), expected)
+
+        # asking for more bins than scenes keeps them all
+        self.assertEqual(len(select_per_bin(self.scenes, 100)), len(scn))
+        self.assertRaises(ValueError, select_per_bin, self.scenes)
+
+    def test_month_bins(self):
+        selected = select_per_bin(self.scenes, bins='month', per_bin=2)
+        months = pd.to_datetime(selected['DATE_ACQUIRED']).dt.month
+        self.assertEqual(sorted(months.value_counts().unique().tolist()), [1, 2])
+        self.assertEqual(sorted(set(months)), list(range(1, 13)))
+        for month, chosen in selected.groupby(months):
+            pool = self.scenes[pd.to_datetime(self.scenes['DATE_ACQUIRED']).dt.month == month]
+            self.assertEqual(sorted(chosen['CLOUD_COVER']), sorted(pool['CLOUD_COVER'])[:len(chosen)])
+
+    def test_interval_bins_and_centre(self):
+        scenes = _scenes(['2015-01-01', '2015-01-09', '2015-01-16', '2015-02-05'], [0., 50., 50., 10.])
+        # 32 day bins from Jan 1: clearest, then closest to the bin's middle (Jan 17)
+        self.assertEqual(self._ids(select_per_bin(scenes, bins='32D', start='2015-01-01')),
+                         ['38_27_2015001', '38_27_2015036'])
+        self.assertEqual(self._ids(select_per_bin(scenes, bins='32D', rank='centre', start='2015-01-01')),
+                         ['38_27_2015016', '38_27_2015036'])
+        self.assertEqual(self._ids(select_per_bin(scenes, bins='32D', rank=['cloud', 'centre'], per_bin=2,
+                                                  start='2015-01-01')),
+                         ['38_27_2015001', '38_27_2015016', '38_27_2015036'])
+        self.assertRaises(ValueError, select_per_bin, scenes, bins='month', rank='sun')
+
+    def test_groups(self):
+        dates = pd.date_range('2015-01-02', '2015-12-31', freq='16D')
+        other = _scenes(dates, 10., path=39)
+        both = pd.concat([self.scenes, other])
+        selected = select_per_bin(both, 4)
+        self.assertEqual(selected['WRS_PATH'].tolist(), [38] * 4 + [39] * 4)
+        self.assertEqual(self._ids(selected[selected['WRS_PATH'] == 38]), self._ids(select_per_bin(self.scenes, 4)))
+        self.assertEqual(self._ids(selected[selected['WRS_PATH'] == 39]), self._ids(select_per_bin(other, 4)))
+
+
+class CatalogLayoutTestCase(unittest.TestCase):
+    """ The catalog's column types, and its path partitions pruned by scene_filter. """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.scenes = os.path.join(self.root, 'scenes')
+        os.mkdir(self.scenes)
+
+        storage = StorageStandIn(band_size=1024)
+        for path in [38, 39, 40]:
+            storage.add_scenes(4, path=path, row=27, start='2015-05-01', cloud=10.)
+            storage.add_scenes(4, path=path, row=28, start='2015-05-01', cloud=60.)
+        index = storage.write_index(os.path.join(self.root, 'index.csv.gz'))
+        SatMetaData(sat='landsat', scenes_dir=self.scenes).split_list(source=index)
+        self.dataset = open_catalog(self.scenes, 'LANDSAT_8')
+
+    def tearDown(self):
+        drop_resident()
+        shutil.rmtree(self.root)
+
+    def _fragments(self, where):
+        return len(list(self.dataset.get_fragments(filter=where)))
+
+    def test_schema(self):
+        import pyarrow as pa
+
+        schema = self.dataset.schema
+        self.assertEqual(schema.field('DATE_ACQUIRED').type, pa.timestamp('ms'))
+        self.assertEqual(schema.field('CLOUD_COVER').type, pa.float64())
+        self.assertTrue(pa.types.is_integer(schema.field('WRS_PATH').type))
+        self.assertTrue(pa.types.is_integer(schema.field('WRS_ROW').type))
+
+    def test_path_pruning(self):
+        start, end = datetime(2015, 1, 1), datetime(2016, 1, 1)
+        self.assertEqual(self._fragments(None), 3)
+        self.assertEqual(self._fragments(scene_filter(start, end)), 3)
+        self.assertEqual(self._fragments(scene_filter(start, end, path=39)), 1)
+        self.assertEqual(self._fragments(scene_filter(start, end, path=39, row=28)), 1)
+        self.assertEqual(self._fragments(scene_filter(start, end, path=[38, 40])), 2)
+        self.assertEqual(self._fragments(scene_filter(start, end, path=41)), 0)
+        self.assertEqual(self._fragments(scene_filter(start, end, tiles=[(38, 27), (40, 28)])), 2)
+        self.assertEqual(self._fragments(scene_filter(start, end, tiles=[])), 0)
+
+    def test_scene_columns(self):
+        # the catalog keeps every index column, queries read only SCENE_COLUMNS
+        self.assertIn('NORTH_LAT', self.dataset.schema.names)
+        where = scene_filter(datetime(2015, 1, 1), datetime(2016, 1, 1), path=39, row=27)
+        records = list(scene_records(self.dataset, where))
+        self.assertEqual(len(records), 4)
+        self.assertEqual(list(records[0]._fields), SCENE_COLUMNS)
+        self.assertEqual(load_resident(self.scenes, 'LANDSAT_8').schema.names, SCENE_COLUMNS)
+
+
+class BatchCandidateScenesTestCase(unittest.TestCase):
+    """ batch_candidate_scenes over a stand-in catalog, against GoogleDownload one job at a time. """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.scenes = os.path.join(self.root, 'scenes')
+        os.mkdir(self.scenes)
+
+        storage = StorageStandIn(band_size=1024)
+        storage.add_scenes(6, path=38, row=27, start='2015-05-01', cloud=10.)
+        storage.add_scenes(4, path=38, row=27, start='2015-05-09', cloud=50.)
+        storage.add_scenes(4, path=39, row=27, start='2015-05-08', cloud=30.)
+        storage.add_scenes(3, satellite=7, path=38, row=27, start='2015-05-05', cloud=5.)
+        index = storage.write_index(os.path.join(self.root, 'index.csv.gz'))
+        SatMetaData(sat='landsat', scenes_dir=self.scenes).split_list(source=index)
+
+        self.jobs = [{'satellite': 8, 'path': 38, 'row': 27, 'start': '2015-04-01', 'end': '2015-09-30'},
+                     {'satellite': 8, 'path': 38, 'row': 27, 'start': '2015-05-10', 'end': '2015-07-01',
+                      'max_cloud_percent': 20.},
+                     {'satellite': 8, 'path': 39, 'row': 27, 'start': '2015-04-01', 'end': '2015-09-30',
+                      'max_cloud_percent': 40.},
+                     {'satellite': 8, 'path': 39, 'row': 27, 'start': '2015-04-01', 'end': '2015-09-30',
+                      'max_cloud_percent': 20.},
+                     {'satellite': 7, 'path': 38, 'row': 27, 'start': '2015-05-01', 'end': '2015-06-01'}]
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_matches_single_queries(self):
+        result = batch_candidate_scenes(self.jobs, scenes_dir=self.scenes)
+        self.assertEqual(result['JOB'].unique().tolist(), [0, 1, 2, 4])
+
+        jobs = pd.DataFrame(self.jobs).fillna({'max_cloud_percent': 100.})
+        for job in jobs.itertuples():
+            g = GoogleDownload(job.start, job.end, job.satellite, path=job.path, row=job.row,
+                               max_cloud_percent=job.max_cloud_percent, scenes_dir=self.scenes)
+            g.candidate_scenes()
+            hits = result[result['JOB'] == job.Index]
+            self.assertEqual(hits['SCENE_ID'].tolist(), g.scenes_low_cloud['SCENE_ID'].tolist())
+            self.assertTrue((hits['SATELLITE'] == job.satellite).all())
+
+        # each job is narrowed to its own dates and cloud threshold within the shared scan
+        self.assertEqual((result['JOB'] == 0).sum(), 10)
+        second = result[result['JOB'] == 1]
+        self.assertEqual(len(second), 3)
+        self.assertTrue((second['CLOUD_COVER'] < 20.).all())
+        self.assertTrue((second['DATE_ACQUIRED'] > pd.Timestamp('2015-05-10')).all())
+        self.assertTrue((second['DATE_ACQUIRED'] < pd.Timestamp('2015-07-01')).all())
+        self.assertEqual((result['JOB'] == 4).sum(), 2)
+
+    def test_job_ids(self):
+        jobs = [dict(j, job='job-{}'.format(i)) for i, j in enumerate(self.jobs)]
+        result = batch_candidate_scenes(jobs[:2], scenes_dir=self.scenes)
+        self.assertEqual(sorted(result['JOB'].unique()), ['job-0', 'job-1'])
+        self.assertEqual((result['JOB'] == 'job-1').sum(), 3)
+
+    def test_missing_columns(self):
+        with self.assertRaises(KeyError) as e:
+            batch_candidate_scenes([{'satellite': 8, 'path': 38, 'start': '2015-04-01', 'end': '2015-09-30'}],
+                                   scenes_dir=self.scenes)
+        self.assertIn('row', str(e.exception))
+
+# ===============================================================================
@@ -0,0 +1,148 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import re
+import shutil
+import struct
+import tempfile
+import unittest
+
+from landsat.tiff_window import RemoteTiff, WindowError
+
+WIDTH, HEIGHT = 400, 300
+# 0.01 degree pixels, upper-left corner at 110 W, 45 N
+ORIGIN, SCALE = (-110., 45.), .01
+
+
+def pixel(row, col):
+    return row * 1000 + col
+
+
+def make_tiff(tile=None, rows_per_strip=7):
+    """ Little-endian uint32 GeoTIFF whose pixel values encode their position. """
+    def rows(r0, r1, c0, c1):
+        return b''.join(struct.pack('<{}I'.format(c1 - c0), *[pixel(r, c) if r < HEIGHT and c < WIDTH else 0
+                                                               for c in range(c0, c1)]) for r in range(r0, r1))
+
+    if tile:
+        blocks = [rows(r, r + tile, c, c + tile) for r in range(0, HEIGHT, tile) for c in range(0, WIDTH, tile)]
+    else:
+        blocks = [rows(r, min(r + rows_per_strip, HEIGHT), 0, WIDTH) for r in range(0, HEIGHT, rows_per_strip)]
+
+    tags = [(256, 4, [WIDTH]), (257, 4, [HEIGHT]), (258, 3, [32]), (259, 3, [1]), (262, 3, [1]),
+            (277, 3, [1]), (339, 3, [1]),
+            (33550, 12, [SCALE, SCALE, 0.]), (33922, 12, [0., 0., 0., ORIGIN[0], ORIGIN[1], 0.]),
+            (34735, 3, [1, 1, 0, 2, 1024, 0, 1, 2, 2048, 0, 1, 4326])]
+    if tile:
+        tags += [(322, 3, [tile]), (323, 3, [tile]), (324, 4, None), (325, 4, [len(b) for b in blocks])]
+    else:
+        tags += [(273, 4, None), (278, 4, [rows_per_strip]), (279, 4, [len(b) for b in blocks])]
+    tags.sort()
+
+    codes = {3: 'H', 4: 'I', 12: 'd'}
+    extra_at = 8 + 2 + 12 * len(tags) + 4
+    data_at = extra_at + sum(struct.calcsize('<{}{}'.format(len(v or blocks), codes[t])) for _, t, v in tags
+                             if struct.calcsize('<{}{}'.format(len(v or blocks), codes[t])) > 4)
+    offsets = []
+    for b in blocks:
+        offsets.append(data_at)
+        data_at += len(b)
+
+    ifd, extra = [struct.pack('<2sHIH', b'II', 42, 8, len(tags))], []
+    for tag, field_type, values in tags:
+        data = struct.pack('<{}{}'.format(len(values or offsets), codes[field_type]), *(values or offsets))
+        if len(data) > 4:
+            ifd.append(struct.pack('<HHII', tag, field_type, len(values or offsets), extra_at))
+            extra.append(data)
+            extra_at += len(data)
+        else:
+            ifd.append(struct.pack('<HHI', tag, field_type, len(values or offsets)) + data.ljust(4, b'\0'))
+    ifd.append(struct.pack('<I', 0))
+    return b''.join(ifd + extra + blocks)
+
+
+class _Response(object):
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    def close(self):
+        pass
+
+
+class _RangeSession(object):
+    """ Serves byte ranges of in-memory files, counting what was transferred. """
+
+    def __init__(self, files):
+        self.files = files
+        self.transferred = 0
+
+    def get(self, url, headers=None, timeout=None):
+        data = self.files[url]
+        start, end = [int(v) for v in re.match(r'bytes=(\d+)-(\d+)', headers['Range']).groups()]
+        if start >= len(data):
+            return _Response(416, b'')
+        self.transferred += len(data[start:end + 1])
+        return _Response(206, data[start:end + 1])
+
+
+class TiffWindowTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.dst = os.path.join(self.root, 'clip.TIF')
+        # cols 50 - 70, rows 20 - 40
+        self.aoi = (-109.5, 44.6, -109.3, 44.8)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _clip(self, source):
+        session = _RangeSession({'src': source})
+        RemoteTiff(session, 'src').extract(self.aoi, self.dst)
+        with open(self.dst, 'rb') as f:
+            clip = RemoteTiff(_RangeSession({'clip': f.read()}), 'clip')
+        return session, clip
+
+    def test_uncompressed_strips_exact_window(self):
+        source = make_tiff()
+        session, clip = self._clip(source)
+        self.assertEqual((clip.width, clip.height), (20, 20))
+        self.assertEqual(clip.tags[33922][1][3:5], [ORIGIN[0] + 50 * SCALE, ORIGIN[1] - 20 * SCALE])
+        self.assertLess(session.transferred, len(source))
+
+        strip = clip._get_blocks([(clip.tags[273][1][0], clip.tags[279][1][0])])[0]
+        values = struct.unpack('<{}I'.format(len(strip) // 4), strip)
+        self.assertEqual(values[0], pixel(20, 50))
+        self.assertEqual(values[21], pixel(21, 51))
+
+    def test_tiles_window(self):
+        _, clip = self._clip(make_tiff(tile=16))
+        # tiles 48 - 80 across and 16 - 48 down cover the window
+        self.assertEqual((clip.width, clip.height), (32, 32))
+        self.assertEqual(clip.tags[33922][1][3:5], [ORIGIN[0] + 48 * SCALE, ORIGIN[1] - 16 * SCALE])
+        tile = clip._get_blocks([(clip.tags[324][1][0], clip.tags[325][1][0])])[0]
+        self.assertEqual(struct.unpack('<I', tile[:4])[0], pixel(16, 48))
+
+    def test_outside_aoi(self):
+        self.aoi = (10., 10., 11., 11.)
+        self.assertRaises(WindowError, self._clip, make_tiff())
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ===============================================================================
@@ -0,0 +1,112 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import pyarrow.dataset as ds
+
+from landsat.update_landsat_metadata import SatMetaData
+from tests.storage_stand_in import StorageStandIn
+
+
+class OfflineMetaData(SatMetaData):
+    """ SatMetaData that leaves the WRS shapefiles alone; they come from outside the bucket. """
+
+    def get_wrs_shapefiles(self):
+        pass
+
+
+class CatalogRefreshTestCase(unittest.TestCase):
+    """ Full and incremental catalog builds from a stand-in's index.csv.gz. """
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.root = tempfile.mkdtemp()
+        self.scenes = os.path.join(self.root, 'scenes')
+        self.storage = StorageStandIn(band_size=1024)
+        self.storage.add_scenes(4, satellite=8, path=38, row=27, start='2015-05-01')
+        self.storage.add_scenes(3, satellite=8, path=39, row=27, start='2015-05-08')
+
+    def tearDown(self):
+        # update_metadata_lists works from inside the catalog directory
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root)
+
+    def _update(self, incremental=False):
+        meta = OfflineMetaData(sat='landsat', scenes_dir=self.scenes)
+        # the refresh is once a day, pretend a day has passed
+        if os.path.isfile(meta.latest):
+            os.remove(meta.latest)
+        meta.update_metadata_lists(incremental=incremental)
+        return meta
+
+    def _catalog(self, sat='LANDSAT_8'):
+        table = ds.dataset(os.path.join(self.scenes, sat), format='parquet', partitioning='hive').to_table()
+        return sorted(table['SCENE_ID'].to_pylist())
+
+    def _files(self, sat='LANDSAT_8'):
+        return sorted(os.path.relpath(os.path.join(d, f), self.scenes)
+                      for d, _, files in os.walk(os.path.join(self.scenes, sat)) for f in files)
+
+    def test_incremental_refresh(self):
+        with self.storage:
+            meta = self._update()
+            self.assertEqual(self._catalog(), sorted(s[0] for s in self.storage.scenes))
+            with open(meta.index_state) as f:
+                state = json.load(f)
+            self.assertEqual(state['watermarks'], {'LANDSAT_8': '2015-06-18'})
+            self.assertTrue(state['etag'])
+            self.assertEqual(self.storage.stats[200], 1)
+
+            # the index changed: newer scenes, a scene re-listed on the watermark date, and a
+            # new spacecraft
+            files = self._files()
+            self.storage.add_scenes(2, satellite=8, path=38, row=27, start='2015-07-04')
+            self.storage.add_scenes(2, satellite=7, path=38, row=27, start='2015-05-05')
+            self.storage.scenes.append(list(self.storage.scenes[3]))
+            self._update(incremental=True)
+
+            expected = sorted(set(s[0] for s in self.storage.scenes if s[2] == 'LANDSAT_8'))
+            self.assertEqual(self._catalog(), expected)
+            self.assertEqual(self._catalog('LANDSAT_7'), sorted(s[0] for s in self.storage.scenes[-3:-1]))
+            # only path 38 got a new file, the other partitions are untouched
+            added = sorted(set(self._files()) - set(files))
+            self.assertEqual(len(added), 1)
+            self.assertTrue(added[0].startswith(os.path.join('LANDSAT_8', 'WRS_PATH=38')))
+
+            with open(meta.index_state) as f:
+                new_state = json.load(f)
+            self.assertEqual(new_state['watermarks'], {'LANDSAT_8': '2015-07-20', 'LANDSAT_7': '2015-05-21'})
+            self.assertNotEqual(new_state['etag'], state['etag'])
+
+            # unchanged since: a 304, and the catalog and state are left as they are
+            files = self._files()
+            self._update(incremental=True)
+            self.assertEqual(self.storage.stats[304], 1)
+            self.assertEqual(self._files(), files)
+            with open(meta.index_state) as f:
+                self.assertEqual(json.load(f), new_state)
+
+    def test_incremental_without_catalog_rebuilds(self):
+        with self.storage:
+            self._update(incremental=True)
+        self.assertEqual(self._catalog(), sorted(s[0] for s in self.storage.scenes))
+        self.assertEqual(self.storage.stats[304], 0)
+
+# ===============================================================================
@@ -0,0 +1,202 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import shapely
+
+from landsat.google_download import GoogleDownload
+from landsat.scene_query import scene_filter
+from landsat.update_landsat_metadata import SatMetaData
+from landsat import wrs_index
+from landsat.wrs_index import WrsIndex, aoi_geometry, build_index, index_file, load_index
+from tests.storage_stand_in import StorageStandIn
+
+# a 2 x 2 grid of 1 degree tiles overlapping their neighbours by .2 degrees; path 38 to
+# the west, row 27 to the north
+WEST, NORTH = -108., 47.
+TILES = [(38, 27), (38, 28), (39, 27), (39, 28)]
+
+
+def _tile(path, row):
+    west, north = WEST + .8 * (path - 38), NORTH - .8 * (row - 27)
+    return shapely.box(west, north - 1., west + 1., north)
+
+
+def _grid(tiles=TILES):
+    return WrsIndex([_tile(*t) for t in tiles], [p for p, r in tiles], [r for p, r in tiles])
+
+
+def _write_grid(shapefile):
+    gpd.GeoDataFrame({'PATH': [p for p, r in TILES], 'ROW': [r for p, r in TILES]},
+                     geometry=[_tile(*t) for t in TILES], crs='EPSG:4326').to_file(shapefile)
+
+
+class WrsIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.index = _grid()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_path_rows(self):
+        # in path 38 row 27 only, in the overlap of path 38's rows, and outside the grid
+        found = self.index.path_rows([46.5, 46.1, 10.], [-107.9, -107.9, 10.])
+        self.assertEqual(found['POINT'].tolist(), [0, 1, 1])
+        self.assertEqual(list(zip(found['PATH'], found['ROW'])), [(38, 27), (38, 27), (38, 28)])
+        self.assertEqual(found['WRSPR'].tolist(), [38027, 38027, 38028])
+        self.assertEqual(self.index.path_rows([], []).shape[0], 0)
+
+    def test_load_index(self):
+        shapefile = os.path.join(self.root, 'wrs.shp')
+        _write_grid(shapefile)
+        wrs_index._loaded.clear()
+        try:
+            # a missing index is built and saved next to the shapefile, then kept for the process
+            idx = load_index(shapefile)
+            self.assertTrue(os.path.isfile(index_file(shapefile)))
+            self.assertEqual(len(idx.geometries), 4)
+            self.assertIs(load_index(shapefile), idx)
+
+            # a saved index newer than the shapefile is read instead of the shapefile
+            _grid(TILES[:2]).save(index_file(shapefile))
+            wrs_index._loaded.clear()
+            loaded = load_index(shapefile)
+            self.assertEqual(list(zip(loaded.paths, loaded.rows)), TILES[:2])
+            self.assertTrue(shapely.equals(loaded.geometries, _grid(TILES[:2]).geometries).all())
+
+            # an index older than its shapefile is rebuilt
+            stale = time.time() - 60
+            os.utime(index_file(shapefile), (stale, stale))
+            wrs_index._loaded.clear()
+            self.assertEqual(len(load_index(shapefile).geometries), 4)
+            self.assertGreater(os.path.getmtime(index_file(shapefile)), stale)
+            self.assertEqual(len(WrsIndex.load(index_file(shapefile)).geometries), 4)
+
+            self.assertIs(build_index(shapefile), load_index(shapefile))
+        finally:
+            wrs_index._loaded.clear()
+
+    def test_tiles(self):
+        # an L along the west and south edges touches three tiles, never the north-east one
+        aoi = shapely.union(shapely.box(-107.9, 45.3, -107.8, 46.9), shapely.box(-107.9, 45.3, -106.3, 45.4))
+        tiles = self.index.tiles(aoi)
+        self.assertEqual(list(zip(tiles['PATH'], tiles['ROW'])), [(38, 27), (38, 28), (39, 28)])
+        # the overlaps are counted in each tile
+        self.assertGreater(tiles['COVERAGE'].sum(), 1.)
+        self.assertEqual(self.index.tiles(shapely.box(0., 0., 1., 1.)).shape[0], 0)
+
+    def test_covering(self):
+        # inside the overlap of the two rows of path 38, either covers it
+        overlap = shapely.box(-107.9, 46.05, -107.3, 46.15)
+        self.assertEqual(self.index.covering(overlap, {(38, 27), (38, 28)}), {(38, 27)})
+        # reaching out of the overlap, both are needed
+        wider = shapely.box(-107.9, 45.5, -107.3, 46.5)
+        self.assertEqual(self.index.covering(wider, {(38, 27), (38, 28)}), {(38, 27), (38, 28)})
+        # a path/row not in the grid is kept
+        self.assertEqual(self.index.covering(overlap, {(38, 27), (40, 27)}), {(38, 27), (40, 27)})
+
+    def test_aoi_geometry(self):
+        box = shapely.box(-107.6, 46.4, -107.4, 46.6)
+        self.assertTrue(aoi_geometry('-107.6,46.4,-107.4,46.6').equals(box))
+        self.assertTrue(aoi_geometry([-107.6, 46.4, -107.4, 46.6]).equals(box))
+        self.assertRaises(ValueError, aoi_geometry, '-107.4,46.4,-107.6,46.6')
+        polygon = {'type': 'Feature', 'geometry': {'type': 'Polygon', 'coordinates': [
+            [[-107.6, 46.4], [-107.4, 46.5], [-107.5, 46.6], [-107.6, 46.4]]]}}
+        self.assertEqual(aoi_geometry(polygon).bounds, box.bounds)
+
+        geojson = os.path.join(self.root, 'aoi.geojson')
+        with open(geojson, 'w') as f:
+            json.dump({'type': 'FeatureCollection',
+                       'features': [{'type': 'Feature', 'properties': {},
+                                     'geometry': shapely.geometry.mapping(box)}]}, f)
+        self.assertTrue(aoi_geometry(geojson).equals(box))
+
+        shapefile = os.path.join(self.root, 'aoi.shp')
+        gpd.GeoDataFrame({'id': [1]}, geometry=[box.buffer(0)], crs='EPSG:4326').to_crs(epsg=32612).to_file(shapefile)
+        self.assertAlmostEqual(shapely.area(aoi_geometry(shapefile)), shapely.area(box), places=4)
+
+    def test_tile_filter(self):
+        table = pa.table({'WRS_PATH': [38, 38, 39, 39], 'WRS_ROW': [27, 28, 27, 28],
+                          'DATE_ACQUIRED': pa.array([datetime(2015, 5, 1)] * 4, pa.timestamp('ms'))})
+        where = scene_filter(datetime(2015, 1, 1), datetime(2016, 1, 1), tiles=[(38, 27), (39, 28)])
+        result = ds.dataset(table).to_table(filter=where)
+        self.assertEqual(list(zip(result['WRS_PATH'].to_pylist(), result['WRS_ROW'].to_pylist())),
+                         [(38, 27), (39, 28)])
+        # lists of paths and rows match every combination
+        where = scene_filter(datetime(2015, 1, 1), datetime(2016, 1, 1), path=[38, 39], row=[27, 28])
+        self.assertEqual(ds.dataset(table).to_table(filter=where).num_rows, 4)
+
+
+class AoiQueryTestCase(unittest.TestCase):
+    """ GoogleDownload queries by area of interest over a catalog of the test grid. """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.scenes = os.path.join(self.root, 'scenes')
+        os.mkdir(self.scenes)
+
+        self.wrs = os.path.join(self.root, 'wrs.shp')
+        _write_grid(self.wrs)
+
+        # both rows of a path are acquired on the same dates, path 39 a week later
+        storage = StorageStandIn(band_size=1024)
+        for path, row in TILES:
+            storage.add_scenes(3, path=path, row=row, start='2015-05-01' if path == 38 else '2015-05-08')
+        index = storage.write_index(os.path.join(self.root, 'index.csv.gz'))
+        SatMetaData(sat='landsat', scenes_dir=self.scenes).split_list(source=index)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _query(self, aoi, **kwargs):
+        g = GoogleDownload('2015-04-01', '2015-06-30', 8, aoi=aoi, scenes_dir=self.scenes, wrs_shapefile=self.wrs,
+                           **kwargs)
+        return g, sorted(set(zip(g.scenes_low_cloud['WRS_PATH'], g.scenes_low_cloud['WRS_ROW'])))
+
+    def test_aoi_tiles(self):
+        # crosses path 38's rows and reaches into path 39's south row only
+        aoi = shapely.box(-107.9, 45.3, -107.1, 45.5)
+        g, tiles = self._query(shapely.union(aoi, shapely.box(-107.9, 45.3, -107.8, 46.5)))
+        self.assertEqual(g.tiles, [(38, 27), (38, 28), (39, 28)])
+        self.assertEqual(tiles, [(38, 27), (38, 28), (39, 28)])
+        self.assertEqual(len(g.scenes_low_cloud), 9)
+
+    def test_drop_overlap(self):
+        # within the overlap of the rows of both paths: each date needs only one of its rows
+        aoi = '-107.5,46.05,-107.,46.15'
+        g, tiles = self._query(aoi, drop_overlap=True)
+        self.assertEqual(len(g.tiles), 4)
+        self.assertEqual(len(g.scenes_low_cloud), 6)
+        self.assertEqual(tiles, [(38, 27), (39, 27)])
+
+        streamed = sorted(r.SCENE_ID for r in g.iter_scenes())
+        self.assertEqual(streamed, sorted(g.scenes_low_cloud['SCENE_ID']))
+
+        g, tiles = self._query(aoi)
+        self.assertEqual(len(g.scenes_low_cloud), 12)
+
+# ===============================================================================